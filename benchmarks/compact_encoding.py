@@ -0,0 +1,230 @@
+"""
+Benchmark the effect of the compact encodings on the rescoring features.
+
+The percolator features of the same psms are calculated from matrices stored as float32 and from matrices stored with
+each compact encoding, and compared to the float32 features:
+
+- float32: intensities and m/z as float32 (no compactEncoding)
+- float16: intensities as float16 and m/z as float32 (compactEncoding float16)
+- uint16: intensities as uint16 and m/z as float32 (compactEncoding uint16)
+- offset_uint16: intensities as float32 and m/z as offset_uint16, which shows why m/z is not stored compactly
+
+Run it on the prediction file of a rescored raw file, e.g. mzML/<raw file>.mzML_pred.hdf5, or without arguments on a
+reproducible synthetic data set:
+
+    python benchmarks/compact_encoding.py [path/to/<raw file>.mzML_pred.hdf5]
+"""
+import argparse
+import logging
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from spectrum_fundamentals.metrics.percolator import Percolator
+
+from oktoberfest.data.compact_matrix import CompactMatrix
+from oktoberfest.data.spectra import FragmentType, Spectra
+from oktoberfest.utils.prediction_backends import FRAGMENT_CHARGES, FRAGMENT_POSITIONS, SyntheticBackend
+
+logger = logging.getLogger(__name__)
+
+# (intensity encoding, m/z encoding) of each storage, None is float32
+STORAGES: Dict[str, Tuple[Optional[str], Optional[str]]] = {
+    "float32": (None, None),
+    "float16": ("float16", None),
+    "uint16": ("uint16", None),
+    "offset_uint16": (None, "offset_uint16"),
+}
+# fragment mass tolerance in ppm used to judge the m/z quantization error
+PPM_TOLERANCE = 20
+# fragments below this m/z count as small fragments
+SMALL_FRAGMENT_MZ = 500
+AMINO_ACIDS = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+
+
+def synthetic_library(n_psms: int = 2000, seed: int = 0) -> Spectra:
+    """
+    Create a reproducible library of target and decoy psms with raw and predicted spectra.
+
+    Targets are matched by their predictions up to intensity noise, decoys by the predictions of another peptide. Raw
+    intensities are normalized to the base peak. The fragment m/z follow a mean residue mass of 110 Da with 5 ppm
+    measurement noise.
+
+    :param n_psms: number of psms
+    :param seed: seed of the random numbers
+    :return: library with the metadata needed by Percolator and RAW, PRED and MZ matrices
+    """
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(7, 31, n_psms)
+    sequences = ["".join(rng.choice(AMINO_ACIDS[AMINO_ACIDS != "K"], length - 1)) + "K" for length in lengths]
+    charges = rng.integers(2, 4, n_psms)
+    reverse = rng.random(n_psms) < 0.2
+
+    backend = SyntheticBackend()
+    predicted = backend.predict(sequences, charges.tolist(), np.full(n_psms, 0.3), models=["intensity"])["intensity"]
+    decoy_sources = rng.permutation(sequences)
+    measured = backend.predict(
+        np.where(reverse, decoy_sources, sequences).tolist(), charges.tolist(), np.full(n_psms, 0.3), models=["raw"]
+    )["raw"]["intensity"]
+    measured = np.where(measured > 0, measured * rng.lognormal(0, 0.3, measured.shape), measured)
+    # raw intensities are normalized to the base peak like annotated spectra
+    measured = np.where(measured > 0, measured / measured.max(axis=1, keepdims=True), measured)
+
+    ion_mass = FRAGMENT_POSITIONS * 110.0 + 1.007
+    mz = np.where(predicted["fragmentmz"] > 0, (ion_mass / FRAGMENT_CHARGES)[None, :], -1)
+    mz = np.where(mz > 0, mz * (1 + rng.normal(0, 5e-6, mz.shape)), mz)
+
+    predicted_irt = rng.uniform(0, 100, n_psms)
+    retention_time = np.where(reverse, rng.uniform(10, 60, n_psms), 10 + 0.5 * predicted_irt + rng.normal(0, 1, n_psms))
+    library = Spectra()
+    library.add_columns(
+        pd.DataFrame(
+            {
+                "RAW_FILE": "synthetic",
+                "SCAN_NUMBER": np.arange(n_psms),
+                "SCAN_EVENT_NUMBER": np.arange(n_psms),
+                "MODIFIED_SEQUENCE": sequences,
+                "SEQUENCE": sequences,
+                "PRECURSOR_CHARGE": charges,
+                "COLLISION_ENERGY": 30.0,
+                "FRAGMENTATION": "HCD",
+                "CALCULATED_MASS": lengths * 110.0 + 18.011,
+                "RETENTION_TIME": retention_time,
+                "PREDICTED_IRT": predicted_irt,
+                "REVERSE": reverse,
+                "SCORE": np.where(reverse, rng.uniform(0, 80, n_psms), rng.uniform(40, 200, n_psms)),
+            }
+        )
+    )
+    library.add_matrix(pd.Series(list(measured.astype(np.float32))), FragmentType.RAW)
+    library.add_matrix(pd.Series(list(predicted["intensity"])), FragmentType.PRED)
+    library.add_matrix(pd.Series(list(mz.astype(np.float32))), FragmentType.MZ)
+    return library
+
+
+def store(matrix: csr_matrix, encoding: Optional[str]) -> Tuple[csr_matrix, int]:
+    """
+    Store a matrix with an encoding and read it back.
+
+    :param matrix: float32 csr matrix
+    :param encoding: encoding of CompactMatrix, None for float32
+    :return: the matrix as read back and the bytes used to store it
+    """
+    if encoding is None:
+        return matrix, matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+    compact = CompactMatrix(matrix, encoding)
+    return compact.decode(), compact.nbytes
+
+
+def calculate_features(library: Spectra, storage: str) -> Tuple[pd.DataFrame, csr_matrix, int]:
+    """
+    Calculate the percolator features of a library with its matrices stored in a storage.
+
+    :param library: library with RAW, PRED and MZ matrices
+    :param storage: one of STORAGES
+    :return: the features, the m/z matrix as read back and the bytes used to store the matrices
+    """
+    intensity_encoding, mz_encoding = STORAGES[storage]
+    raw, raw_bytes = store(library.get_matrix(FragmentType.RAW), intensity_encoding)
+    pred, pred_bytes = store(library.get_matrix(FragmentType.PRED), intensity_encoding)
+    mz, mz_bytes = store(library.get_matrix(FragmentType.MZ), mz_encoding)
+    percolator = Percolator(
+        metadata=library.get_meta_data().copy(),
+        input_type="rescore",
+        pred_intensities=pred,
+        true_intensities=raw,
+        mz=mz,
+        all_features_flag=True,
+    )
+    percolator.calc()
+    return percolator.metrics_val, mz, raw_bytes + pred_bytes + mz_bytes
+
+
+def mz_error(reference: csr_matrix, stored: csr_matrix) -> pd.Series:
+    """
+    Measure the quantization error of stored m/z values.
+
+    :param reference: float32 m/z matrix
+    :param stored: m/z matrix as read back, with the same sparsity structure
+    :return: maximum error in Da and ppm, maximum error in ppm of small fragments and the fraction of fragments with
+        an error above PPM_TOLERANCE
+    """
+    valid = reference.data > 1
+    error = np.abs(stored.data - reference.data)[valid].astype(np.float64)
+    ppm = error / reference.data[valid] * 1e6
+    small = reference.data[valid] < SMALL_FRAGMENT_MZ
+    return pd.Series(
+        {
+            "max_error_da": error.max(initial=0),
+            "max_error_ppm": ppm.max(initial=0),
+            f"max_error_ppm_below_{SMALL_FRAGMENT_MZ}_mz": ppm[small].max(initial=0),
+            f"fraction_above_{PPM_TOLERANCE}_ppm": np.mean(ppm > PPM_TOLERANCE) if len(ppm) else 0.0,
+        }
+    )
+
+
+def compare_storages(library: Spectra) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Compare the features and m/z of every storage with the float32 storage.
+
+    :param library: library with RAW, PRED and MZ matrices
+    :return: summary per storage and the maximum absolute deviation of every feature per storage
+    """
+    reference_features, reference_mz, _ = calculate_features(library, "float32")
+    numeric = reference_features.select_dtypes(include=np.number).columns
+    summary = {}
+    deviations = {}
+    for storage in STORAGES:
+        features, mz, n_bytes = calculate_features(library, storage)
+        deviation = (features[numeric] - reference_features[numeric]).abs().max()
+        deviations[storage] = deviation
+        summary[storage] = pd.concat(
+            [
+                pd.Series(
+                    {
+                        "matrix_mb": n_bytes / 1024**2,
+                        "features_changed": int((deviation > 1e-6).sum()),
+                        "max_feature_deviation": deviation.max(),
+                        "spectral_angle_deviation": deviation.get("spectral_angle", np.nan),
+                    }
+                ),
+                mz_error(reference_mz, mz),
+            ]
+        )
+    return pd.DataFrame(summary).T, pd.DataFrame(deviations)
+
+
+def main():
+    """Run the benchmark on the given prediction file or on synthetic data and print the comparison."""
+    parser = argparse.ArgumentParser(description="Compare the rescoring features of the compact encodings.")
+    parser.add_argument("pred_path", nargs="?", help="prediction hdf5 file of a raw file, default synthetic data")
+    parser.add_argument("--psms", type=int, default=2000, help="number of synthetic psms")
+    arguments = parser.parse_args()
+    # the feature calculation logs every step and an error for every fdr estimate of a small synthetic data set
+    logging.disable(logging.ERROR)
+
+    if arguments.pred_path:
+        library = Spectra()
+        library.read_from_hdf5(arguments.pred_path, lazy=False)
+    else:
+        library = synthetic_library(arguments.psms)
+    summary, deviations = compare_storages(library)
+
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(summary.to_string(float_format="{:.6g}".format))
+        print()
+        print("Maximum absolute deviation of each feature from float32 storage:")
+        print(deviations[(deviations > 1e-6).any(axis=1)].to_string(float_format="{:.3g}".format))
+    mz_summary = summary.loc["offset_uint16"]
+    small_fragment_ppm = mz_summary[f"max_error_ppm_below_{SMALL_FRAGMENT_MZ}_mz"]
+    print()
+    print(
+        f"offset_uint16 m/z has up to {mz_summary['max_error_da']:.4f} Da of quantization error, "
+        f"{small_fragment_ppm:.1f} ppm for fragments below {SMALL_FRAGMENT_MZ} m/z, which is "
+        f"{'above' if small_fragment_ppm > PPM_TOLERANCE else 'within'} {PPM_TOLERANCE} ppm fragment tolerances."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ from spectrum_fundamentals.metrics.percolator import Percolator
 
 from .ce_calibration import CeCalibration
 from .data.spectra import FragmentType
+from .utils.prediction_checkpoint import PredictionCheckpoint
 
 logger = logging.getLogger(__name__)
 
@@ -26,8 +27,15 @@ class CalculateFeatures(CeCalibration):
         """
         self.perform_alignment(df_search)
         self.library.spectra_data["COLLISION_ENERGY"] = self.best_ce
-        self.grpc_predict(self.library)
-        self.library.write_pred_as_hdf5(self.get_pred_path())
+        checkpoint_dir = self.get_pred_checkpoint_path() if self.config.prediction_checkpoint else None
+        self.grpc_predict(self.library, checkpoint_dir=checkpoint_dir)
+        self.write_predictions()
+        if checkpoint_dir is not None:
+            PredictionCheckpoint.remove(checkpoint_dir)
+
+    def get_pred_checkpoint_path(self) -> str:
+        """Get path to the directory with the checkpointed predictions of this raw file."""
+        return self.out_path + "_pred_checkpoint"
 
     def gen_perc_metrics(self, search_type: str, file_path: Optional[str]):
         """
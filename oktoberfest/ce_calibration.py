@@ -5,16 +5,103 @@ from typing import Optional
 import numpy as np
 import pandas as pd
 from spectrum_fundamentals.annotation.annotation import annotate_spectra
-from spectrum_fundamentals.metrics.similarity import SimilarityMetrics
 from spectrum_io.raw import ThermoRaw
 from spectrum_io.search_result import Mascot, MaxQuant, MSFragger
 
 from .data.spectra import FragmentType, Spectra
 from .spectral_library import SpectralLibrary
+from .utils.ce_cache import CeCalibrationCache, file_fingerprint, frame_fingerprint
+from .utils.ce_scoring import CeGridScores
+from .utils.config import Config
 from .utils.plotting import plot_mean_sa_ce
 
 logger = logging.getLogger(__name__)
 
+ALIGNMENT_TOP_PSMS = 1000
+ALIGNMENT_CE_RANGE = (18, 50)
+ALIGNMENT_KEY_COLUMNS = ["MODIFIED_SEQUENCE", "PRECURSOR_CHARGE", "FRAGMENTATION"]
+
+
+def select_alignment_psms(spectra_data: pd.DataFrame) -> np.ndarray:
+    """
+    Select the psms used for the ce alignment.
+
+    :param spectra_data: search result or library metadata with FRAGMENTATION, REVERSE and SCORE columns
+    :return: positions of the up to 1000 highest scoring HCD target psms
+    """
+    # Remove decoy and HCD fragmented spectra
+    candidates = np.flatnonzero(((spectra_data["FRAGMENTATION"] == "HCD") & (~spectra_data["REVERSE"])).to_numpy())
+    # Select the 1000 highest scoring or all if there are less than 1000
+    scores = spectra_data["SCORE"].to_numpy()[candidates]
+    return candidates[np.argsort(-scores, kind="stable")[:ALIGNMENT_TOP_PSMS]]
+
+
+def get_alignment_library(psm_data: pd.DataFrame, collision_energies: np.ndarray) -> Spectra:
+    """
+    Repeat the prediction input of the given psms for each collision energy.
+
+    :param psm_data: metadata with the ALIGNMENT_KEY_COLUMNS of the psms
+    :param collision_energies: collision energies to predict
+    :return: Spectra with psm i at collision energy k in row k * len(psm_data) + i
+    """
+    nrow = len(psm_data)
+    alignment_library = Spectra()
+    alignment_library.spectra_data = (
+        psm_data[ALIGNMENT_KEY_COLUMNS].iloc[np.tile(np.arange(nrow), len(collision_energies))].reset_index(drop=True)
+    )
+    alignment_library.spectra_data["COLLISION_ENERGY"] = np.repeat(collision_energies, nrow)
+    return alignment_library
+
+
+def get_calibration_key(config: Config, raw_file_path: str, mzml_path: str, df_search: pd.DataFrame) -> Optional[str]:
+    """
+    Get the ce calibration cache key of a raw file and its search result.
+
+    The key must not depend on the conversion of the raw file, so the raw file is fingerprinted if it exists and the
+    mzml file only if the raw file was removed.
+
+    :param config: the config
+    :param raw_file_path: path to the raw file as given to CeCalibration
+    :param mzml_path: path to the mzml file of the raw file
+    :param df_search: search result of the raw file
+    :return: the cache key or None if neither the raw file nor the mzml file exist
+    """
+    raw_files = [path for path in [os.fspath(raw_file_path), os.fspath(mzml_path)] if os.path.isfile(path)]
+    if not raw_files:
+        return None
+    params = {
+        "raw_file": file_fingerprint(raw_files[0]),
+        "search_result": frame_fingerprint(df_search),
+        "intensity_model": config.intensity_model,
+        "tag": config.tag,
+        "top_psms": ALIGNMENT_TOP_PSMS,
+        "ce_range": ALIGNMENT_CE_RANGE,
+        "ce_search": config.ce_search,
+        "ce_search_step": config.ce_search_step,
+    }
+    return CeCalibrationCache.get_key(params)
+
+
+def get_ce_cache_path(mzml_path: str) -> str:
+    """
+    Get path to the ce calibration cache of a raw file.
+
+    :param mzml_path: path to the mzml file of the raw file
+    :return: path to the cache
+    """
+    return os.fspath(mzml_path) + ".ce_calibration.json"
+
+
+def get_coarse_ces(step: int) -> np.ndarray:
+    """
+    Get the collision energies first predicted by the adaptive ce search.
+
+    :param step: step between the collision energies, the last collision energy of the ce range is always included
+    :return: every step-th collision energy of the ce range
+    """
+    ce_range = np.arange(*ALIGNMENT_CE_RANGE)
+    return np.unique(np.append(ce_range[::step], ce_range[-1]))
+
 
 class CeCalibration(SpectralLibrary):
     """
@@ -51,6 +138,9 @@ class CeCalibration(SpectralLibrary):
         self.search_path = search_path
         self.raw_path = raw_path
         self.out_path = out_path
+        # raw_path and out_path are replaced by the mzml conversion, the ce calibration cache uses the given paths
+        self.raw_file_path = raw_path
+        self.mzml_file_path = out_path
         self.mzml_reader_package = mzml_reader_package
         self.best_ce = 0
 
@@ -142,7 +232,7 @@ class CeCalibration(SpectralLibrary):
         df_join.drop(columns=["INTENSITIES", "MZ"], inplace=True)
         # return df_annotated_spectra["INTENSITIES"]
         logger.info("Preparing library")
-        self.library.add_columns(df_join)
+        self.library.add_columns(Spectra.compact_meta_data(df_join))
         self.library.add_matrix(df_annotated_spectra["INTENSITIES"], FragmentType.RAW)
         self.library.add_matrix(df_annotated_spectra["MZ"], FragmentType.MZ)
         self.library.add_column(df_annotated_spectra["CALCULATED_MASS"], "CALCULATED_MASS")
@@ -151,53 +241,124 @@ class CeCalibration(SpectralLibrary):
         """Get path to hdf5 file."""
         return self.out_path + ".hdf5"
 
+    def get_annotation_path(self) -> str:
+        """Get path to the annotation file in the configured intermediate format."""
+        if self.config.intermediate_format == "parquet":
+            return self.out_path + ".parquet"
+        return self.get_hdf5_path()
+
     def get_pred_path(self) -> str:
-        """Get path to prediction hdf5 file."""
+        """Get path to prediction file in the configured intermediate format."""
+        if self.config.intermediate_format == "parquet":
+            return self.out_path + "_pred.parquet"
         return self.out_path + "_pred.hdf5"
 
     def write_metadata_annotation(self):
-        """Write metadata annotation as hdf5 file."""
-        self.library.write_as_hdf5(self.get_hdf5_path())
+        """Write metadata annotation as hdf5 or parquet file."""
+        if self.config.intermediate_format == "parquet":
+            self.library.write_as_parquet(self.get_annotation_path())
+        else:
+            self.library.write_as_hdf5(self.get_hdf5_path())
+
+    def write_predictions(self):
+        """Write metadata annotation and predictions as hdf5 or parquet file."""
+        if self.config.intermediate_format == "parquet":
+            self.library.write_as_parquet(self.get_pred_path())
+        else:
+            self.library.write_pred_as_hdf5(self.get_pred_path())
+
+    def get_pooled_alignment_path(self) -> str:
+        """Get path to the alignment predictions of this raw file made by ReScore.pool_alignment_predictions."""
+        return self.out_path + ".alignment_pred.npz"
 
     def _prepare_alignment_df(self):
-        self.alignment_library = Spectra()
-        self.alignment_library.spectra_data = self.library.spectra_data.copy()
-
-        # Remove decoy and HCD fragmented spectra
-        self.alignment_library.spectra_data = self.alignment_library.spectra_data[
-            (self.alignment_library.spectra_data["FRAGMENTATION"] == "HCD")
-            & (~self.alignment_library.spectra_data["REVERSE"])
-        ]
-        # Select the 1000 highest scoring or all if there are less than 1000
-        self.alignment_library.spectra_data = self.alignment_library.spectra_data.sort_values(
-            by="SCORE", ascending=False
-        ).iloc[:1000]
-
-        # Repeat dataframe for each CE
-        ce_range = range(18, 50)
-        nrow = len(self.alignment_library.spectra_data)
-        self.alignment_library.spectra_data = pd.concat([self.alignment_library.spectra_data for _ in ce_range], axis=0)
-        self.alignment_library.spectra_data["COLLISION_ENERGY"] = np.repeat(ce_range, nrow)
-        self.alignment_library.spectra_data.reset_index(inplace=True)
-
-    def _predict_alignment(self):
+        self.top_psms = self.library.select(select_alignment_psms(self.library.spectra_data))
+        self.raw_intensity = self.top_psms.get_matrix(FragmentType.RAW).toarray()
+        self.ce_range = np.arange(*ALIGNMENT_CE_RANGE)
+        self.alignment_ces = np.zeros(0, dtype=int)
+        self.pred_intensity = np.zeros((0, len(self.top_psms), 174), dtype=np.float32)
+        self._load_pooled_alignment()
+
+    def _load_pooled_alignment(self):
+        """Take the predictions of the selected psms from the pooled alignment predictions if they were made."""
+        pooled_path = self.get_pooled_alignment_path()
+        if not os.path.isfile(pooled_path):
+            return
+        logger.info(f"Using pooled alignment predictions from {pooled_path}")
+        with np.load(pooled_path, allow_pickle=False) as pooled:
+            pooled_keys = pd.DataFrame({column: pooled[column] for column in ALIGNMENT_KEY_COLUMNS})
+            top_psms_keys = self.top_psms.spectra_data[ALIGNMENT_KEY_COLUMNS].astype(pooled_keys.dtypes)
+            pooled_keys["POOLED_INDEX"] = np.arange(len(pooled_keys))
+            pooled_index = top_psms_keys.merge(pooled_keys, on=ALIGNMENT_KEY_COLUMNS, how="left")["POOLED_INDEX"]
+            found = pooled_index.notna().to_numpy()
+            self.alignment_ces = pooled["collision_energies"]
+            self.pred_intensity = np.zeros((len(self.alignment_ces), len(self.top_psms), 174), dtype=np.float32)
+            self.pred_intensity[:, found] = pooled["pred_intensity"][:, pooled_index[found].to_numpy(dtype=int)]
+
+        # psms can be missing if they were not found in the raw file, predict those that replaced them
+        if not found.all():
+            logger.info(f"Predicting {np.sum(~found)} selected psms that are missing from the pooled predictions")
+            self.alignment_library = get_alignment_library(self.top_psms.spectra_data[~found], self.alignment_ces)
+            self.grpc_predict(self.alignment_library, alignment=True)
+            self.pred_intensity[:, ~found] = (
+                self.alignment_library.get_matrix(FragmentType.PRED).toarray().reshape(len(self.alignment_ces), -1, 174)
+            )
+
+    def _predict_alignment(self, collision_energies: Optional[np.ndarray] = None):
+        """
+        Predict the selected psms at the given collision energies and add them to the prediction tensor.
+
+        :param collision_energies: collision energies to predict, default is the whole ce range. Collision energies
+            that were already predicted are skipped.
+        """
+        if collision_energies is None:
+            collision_energies = self.ce_range
+        collision_energies = np.setdiff1d(collision_energies, self.alignment_ces)
+        if len(collision_energies) == 0:
+            return
+
+        # Only the prediction input is repeated for each CE, the raw spectra are kept once
+        self.alignment_library = get_alignment_library(self.top_psms.spectra_data, collision_energies)
         self.grpc_predict(self.alignment_library, alignment=True)
 
+        # (n_ce x n_psm x 174) tensor, row i of the alignment library is psm i % n_psm at ce i // n_psm
+        nrow = len(self.top_psms)
+        pred_intensity = self.alignment_library.get_matrix(FragmentType.PRED).toarray().reshape(-1, nrow, 174)
+        alignment_ces = np.concatenate([self.alignment_ces, collision_energies])
+        order = np.argsort(alignment_ces)
+        self.alignment_ces = alignment_ces[order]
+        self.pred_intensity = np.concatenate([self.pred_intensity, pred_intensity])[order]
+
+    def _score_alignment(self) -> pd.Series:
+        """Score the predicted collision energies and return the mean spectral angle per collision energy."""
+        self.ce_scores = CeGridScores(self.raw_intensity, self.pred_intensity, self.alignment_ces)
+        return self.ce_scores.mean
+
+    def _adaptive_alignment(self):
+        """
+        Search the best collision energy from coarse to fine instead of predicting the whole ce range.
+
+        The ce range is first predicted every ceSearchStep collision energies. The step is then halved until it is 1,
+        each time predicting the collision energies one step below and above the best one so far. As the step is a
+        power of two, every collision energy between the coarse neighbours of the best one can be reached. This
+        assumes the mean spectral angle is unimodal over the ce range.
+        """
+        step = self.config.ce_search_step
+        self._predict_alignment(get_coarse_ces(step))
+        while step > 1:
+            step //= 2
+            best_ce = self._score_alignment().idxmax()
+            neighbours = np.array([best_ce - step, best_ce + step])
+            self._predict_alignment(neighbours[np.isin(neighbours, self.ce_range)])
+        logger.info(f"Predicted {len(self.alignment_ces)} of {len(self.ce_range)} collision energies")
+
     def _alignment(self):
         """
         Edit library to try different ranges of ce 15-50. then predict with the new library.
 
         Check https://gitlab.lrz.de/proteomics/prosit_tools/oktoberfest/-/blob/develop/oktoberfest/ce_calibration/grpc_alignment.py
         """
-        pred_intensity = self.alignment_library.get_matrix(FragmentType.PRED)
-        raw_intensity = self.alignment_library.get_matrix(FragmentType.RAW)
-        # return pred_intensity.toarray(), raw_intensity.toarray()
-        sm = SimilarityMetrics(pred_intensity, raw_intensity)
-        self.alignment_library.spectra_data["SPECTRAL_ANGLE"] = sm.spectral_angle(raw_intensity, pred_intensity, 0)
-
-        self.ce_alignment = self.alignment_library.spectra_data.groupby(by=["COLLISION_ENERGY"])[
-            "SPECTRAL_ANGLE"
-        ].mean()
+        self.ce_alignment = self._score_alignment()
         if "/" in self.raw_path:
             split_char = "/"
         else:
@@ -213,16 +374,38 @@ class CeCalibration(SpectralLibrary):
         self.best_ce = self.ce_alignment.idxmax()
         logger.info(f"Best collision energy: {self.best_ce}")
 
+    def get_ce_cache_path(self) -> str:
+        """Get path to the ce calibration cache."""
+        return get_ce_cache_path(self.mzml_file_path)
+
+    def _get_calibration_key(self, df_search: pd.DataFrame) -> Optional[str]:
+        """
+        Get the ce calibration cache key of this raw file and search result, see get_calibration_key.
+
+        :param df_search: search result as pd.DataFrame
+        :return: the cache key or None if neither the raw file nor the mzml file exist
+        """
+        return get_calibration_key(self.config, self.raw_file_path, self.mzml_file_path, df_search)
+
     def perform_alignment(self, df_search: pd.DataFrame):
         """
         Perform alignment and get the best CE.
 
         :param df_search: search result as pd.DataFrame
+        :raises ValueError: if the ce search is not supported
         """
-        hdf5_path = self.get_hdf5_path()
-        logger.info(f"Path to hdf5 file with annotations for {self.out_path}: {hdf5_path}")
-        if os.path.isfile(hdf5_path):
-            self.library.read_from_hdf5(hdf5_path)
+        # the cache key is computed before gen_lib converts the raw file and replaces raw_path
+        ce_cache = CeCalibrationCache(self.get_ce_cache_path())
+        cache_key = self._get_calibration_key(df_search)
+
+        annotation_path = self.get_annotation_path()
+        logger.info(f"Path to file with annotations for {self.out_path}: {annotation_path}")
+        if os.path.isfile(annotation_path):
+            if self.config.intermediate_format == "parquet":
+                self.library.read_from_parquet(annotation_path)
+            else:
+                self.library.read_from_hdf5(annotation_path)
+                self.library.spectra_data = Spectra.compact_meta_data(self.library.spectra_data)
         else:
             self.gen_lib(df_search)
             self.write_metadata_annotation()
@@ -231,7 +414,24 @@ class CeCalibration(SpectralLibrary):
         if len(hcd_df.index) == 0:
             self.best_ce = 35.0
             return
+
+        cached = None if cache_key is None else ce_cache.get(cache_key)
+        if cached is not None:
+            self.ce_alignment, self.best_ce = cached
+            logger.info(f"Using cached ce calibration from {ce_cache.path}, best collision energy: {self.best_ce}")
+            return
+
         self._prepare_alignment_df()
-        self._predict_alignment()
+        ce_search = self.config.ce_search
+        if ce_search == "adaptive":
+            self._adaptive_alignment()
+        elif ce_search == "grid":
+            self._predict_alignment()
+        else:
+            raise ValueError(f"{ce_search} is not supported as ce search, choose grid or adaptive")
         self._alignment()
         self._get_best_ce()
+        if cache_key is not None:
+            ce_cache.put(cache_key, self.ce_alignment, self.best_ce)
+        if os.path.isfile(self.get_pooled_alignment_path()):
+            os.remove(self.get_pooled_alignment_path())
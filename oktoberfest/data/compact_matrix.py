@@ -0,0 +1,139 @@
+import logging
+
+import numpy as np
+import spectrum_fundamentals.constants as c
+from scipy.sparse import csr_matrix, spmatrix
+
+logger = logging.getLogger(__name__)
+
+ENCODINGS = ["float16", "uint16", "offset_uint16"]
+UINT16_MAX = np.iinfo(np.uint16).max
+
+
+class CompactMatrix:
+    """
+    Sparse (n_psms x 174) matrix stored with reduced precision.
+
+    The csr structure is kept, but column indices are stored as uint8 and values are encoded in 16 bits, which cuts
+    the size of a stored entry from 8 to 3 bytes. Values are decoded to a float32 csr matrix on access. Entries equal to
+    EPSILON (zero intensity peaks) are preserved exactly, absent entries (invalid fragments) stay absent.
+
+    Supported encodings:
+
+    - float16: values are cast to float16
+    - uint16: values in [0, 1] are scaled to 1..65535, e.g. normalized intensities
+    - offset_uint16: values are stored as uint16 offsets from the smallest value of their row, scaled to the value
+      range of the row, e.g. mz
+    """
+
+    def __init__(self, matrix: spmatrix, encoding: str):
+        """
+        Encode a sparse matrix.
+
+        :param matrix: sparse matrix with one row per psm and 174 columns
+        :param encoding: float16, uint16 or offset_uint16
+        :raises ValueError: if the encoding is not supported
+        """
+        if encoding not in ENCODINGS:
+            raise ValueError(f"{encoding} is not supported as compact encoding, choose one of {ENCODINGS}")
+        matrix = csr_matrix(matrix)
+        self.encoding = encoding
+        self.shape = matrix.shape
+        self.indptr = matrix.indptr
+        self.indices = matrix.indices.astype(np.uint8)
+        self.offsets = np.zeros(0, dtype=np.float32)
+        self.scales = np.zeros(0, dtype=np.float32)
+
+        values = matrix.data
+        zero_peaks = values <= c.EPSILON
+        if encoding == "float16":
+            self.data = values.astype(np.float16)
+            self.data[zero_peaks] = 0
+        elif encoding == "uint16":
+            self.data = np.clip(np.rint(values * UINT16_MAX), 1, UINT16_MAX).astype(np.uint16)
+            self.data[zero_peaks] = 0
+        else:
+            self._encode_offsets(values, zero_peaks)
+
+    def _encode_offsets(self, values: np.ndarray, zero_peaks: np.ndarray):
+        """
+        Encode values as per row offsets, code 0 is reserved for EPSILON.
+
+        :param values: the csr data array
+        :param zero_peaks: mask of the entries equal to EPSILON
+        """
+        n_rows = self.shape[0]
+        row_starts = self.indptr[:-1]
+        non_empty = np.diff(self.indptr) > 0
+        minimum = np.full(n_rows, np.inf)
+        maximum = np.full(n_rows, -np.inf)
+        if non_empty.any():
+            minimum[non_empty] = np.minimum.reduceat(np.where(zero_peaks, np.inf, values), row_starts[non_empty])
+            maximum[non_empty] = np.maximum.reduceat(np.where(zero_peaks, -np.inf, values), row_starts[non_empty])
+        no_peaks = ~np.isfinite(minimum)
+        minimum[no_peaks] = 0
+        maximum[no_peaks] = 0
+        scales = (maximum - minimum) / (UINT16_MAX - 1)
+        scales[scales <= 0] = 1
+
+        row_ids = self._row_ids(0, n_rows)
+        codes = np.rint((values - minimum[row_ids]) / scales[row_ids]) + 1
+        codes[zero_peaks] = 0
+        self.data = codes.astype(np.uint16)
+        self.offsets = minimum.astype(np.float32)
+        self.scales = scales.astype(np.float32)
+
+    def _row_ids(self, start: int, stop: int) -> np.ndarray:
+        """
+        Get the row of every stored entry in rows start:stop, relative to start.
+
+        :param start: first row
+        :param stop: row after the last row
+        :return: array with the relative row index of each entry
+        """
+        return np.repeat(np.arange(stop - start, dtype=np.int32), np.diff(self.indptr[start : stop + 1]))
+
+    def _decode_values(self, start: int, stop: int) -> np.ndarray:
+        """
+        Decode the values of rows start:stop to float32.
+
+        :param start: first row
+        :param stop: row after the last row
+        :return: decoded csr data array of the rows
+        """
+        data = self.data[self.indptr[start] : self.indptr[stop]]
+        if self.encoding == "float16":
+            values = data.astype(np.float32)
+        elif self.encoding == "uint16":
+            values = data.astype(np.float32) / UINT16_MAX
+        else:
+            row_ids = self._row_ids(start, stop)
+            offsets = self.offsets[start:stop][row_ids]
+            values = offsets + (data.astype(np.float32) - 1) * self.scales[start:stop][row_ids]
+        values[data == 0] = c.EPSILON
+        return values
+
+    def decode_rows(self, start: int, stop: int) -> csr_matrix:
+        """
+        Decode rows start:stop to a float32 csr matrix.
+
+        :param start: first row
+        :param stop: row after the last row
+        :return: decoded sparse matrix
+        """
+        start, stop, _ = slice(start, stop).indices(self.shape[0])
+        stop = max(start, stop)
+        indptr = self.indptr[start : stop + 1] - self.indptr[start]
+        indices = self.indices[self.indptr[start] : self.indptr[stop]].astype(np.int32)
+        return csr_matrix(
+            (self._decode_values(start, stop), indices, indptr), shape=(stop - start, self.shape[1]), dtype=np.float32
+        )
+
+    def decode(self) -> csr_matrix:
+        """Decode the whole matrix to a float32 csr matrix."""
+        return self.decode_rows(0, self.shape[0])
+
+    @property
+    def nbytes(self) -> int:
+        """Get the number of bytes used by the encoded matrix."""
+        return sum(array.nbytes for array in [self.data, self.indices, self.indptr, self.offsets, self.scales])
@@ -1,16 +1,23 @@
+import bisect
 import logging
 from enum import Enum
-from typing import List
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
+import h5py
 import numpy as np
 import pandas as pd
-import scipy
+import scipy.sparse
 import spectrum_fundamentals.constants as c
-from scipy.sparse import coo_matrix, spmatrix
+from scipy.sparse import csr_matrix, spmatrix
 from spectrum_io.file import hdf5
 
+from .compact_matrix import CompactMatrix
+
 logger = logging.getLogger(__name__)
 
+# rows of a selection that are at most this far apart are read from hdf5 in one slice
+HDF5_ROW_GAP = 64
+
 
 class FragmentType(Enum):
     """FragmentType class to enumerate pred, raw, and mz."""
@@ -21,19 +28,108 @@ class FragmentType(Enum):
 
 
 class Spectra:
-    """Main to init spectra data."""
+    """
+    Main to init spectra data.
+
+    Metadata is kept as a pd.DataFrame in spectra_data, while raw intensities, mz and predicted intensities are each
+    stored as a single (n_psms x 174) float32 csr matrix per FragmentType in fragment_matrices. Row i of every matrix
+    belongs to row i of spectra_data. If a compact encoding is chosen, the intensity matrices are stored as
+    CompactMatrix instead and decoded to float32 by get_matrix. mz is always stored as float32, its fragment tolerances
+    are too tight for 16 bit values.
+    """
 
     INTENSITY_COLUMN_PREFIX = "INTENSITY_RAW"
     INTENSITY_PRED_PREFIX = "INTENSITY_PRED"
     MZ_COLUMN_PREFIX = "MZ_RAW"
     EPSILON = 1e-7
     COLUMNS_FRAGMENT_ION = ["Y1+", "Y1++", "Y1+++", "B1+", "B1++", "B1+++"]
+    # label columns stored as categoricals by compact_meta_data
+    COMPACT_META_DATA_COLUMNS = ["RAW_FILE", "FRAGMENTATION", "MASS_ANALYZER"]
+
+    HDF5_KEYS = {
+        FragmentType.PRED: hdf5.INTENSITY_PRED_KEY,
+        FragmentType.RAW: hdf5.INTENSITY_RAW_KEY,
+        FragmentType.MZ: hdf5.MZ_RAW_KEY,
+    }
+
+    fragment_matrices: Dict[FragmentType, Union[csr_matrix, CompactMatrix]]
+    compact_encoding: Optional[str]
+
+    def __init__(self, compact_encoding: Optional[str] = None):
+        """
+        Initialize spectra data as a pd.DataFrame and an empty fragment matrix store.
+
+        :param compact_encoding: optional encoding of the intensities (float16 or uint16) to store the raw and
+            predicted intensity matrices with reduced precision. By default and for mz, matrices are stored as float32.
+        :raises ValueError: if the compact encoding is not supported
+        """
+        if compact_encoding not in [None, "float16", "uint16"]:
+            raise ValueError(f"{compact_encoding} is not supported as compact encoding, use float16 or uint16")
+        self._spectra_data = pd.DataFrame()
+        self._staged_columns: List[pd.DataFrame] = []
+        self._hdf5_sources: Dict[FragmentType, str] = {}
+        self.fragment_matrices = {}
+        self.compact_encoding = compact_encoding
+        self._base: Optional[Spectra] = None
+        self._row_indices = np.zeros(0, dtype=np.int64)
+        self._pending_selection = False
+
+    def __len__(self) -> int:
+        """Get the number of psms."""
+        if self._pending_selection:
+            return len(self._row_indices)
+        return len(self.spectra_data)
+
+    @property
+    def spectra_data(self) -> pd.DataFrame:
+        """Get spectra data as pd.DataFrame, concatenating all column blocks staged by add_columns once."""
+        if self._pending_selection:
+            self._spectra_data = self._base.spectra_data.iloc[self._row_indices].reset_index(drop=True)
+            self._pending_selection = False
+        if self._staged_columns:
+            if len(self._spectra_data.columns) > 0:
+                self._staged_columns.insert(0, self._spectra_data)
+            if len(self._staged_columns) == 1:
+                self._spectra_data = self._staged_columns[0]
+            else:
+                self._spectra_data = pd.concat(self._staged_columns, axis=1)
+            self._staged_columns = []
+        return self._spectra_data
+
+    @spectra_data.setter
+    def spectra_data(self, spectra_data: pd.DataFrame) -> None:
+        """
+        Replace spectra data, discarding any staged column blocks.
 
-    spectra_data: pd.DataFrame
+        :param spectra_data: the new spectra data
+        """
+        self._spectra_data = spectra_data
+        self._staged_columns = []
+        self._pending_selection = False
 
-    def __init__(self):
-        """Initialize spectra data as a pd.DataFrame."""
-        self.spectra_data = pd.DataFrame()
+    def select(self, rows: Union[np.ndarray, pd.Series, List[int]]) -> "Spectra":
+        """
+        Select a subset of psms without copying the matrices.
+
+        The returned Spectra object only holds the selected row indices and a reference to this object. The meta data
+        of the selection is copied on first access to its spectra_data, matrices are only sliced when they are
+        requested through get_matrix, get_matrix_rows or one of the writers. Matrices added to the selection are
+        stored in the selection itself. The selection's spectra_data has a fresh RangeIndex.
+
+        :param rows: boolean mask with one entry per psm or integer positions of the psms to select
+        :raises ValueError: if a boolean mask does not match the number of psms
+        :return: Spectra object with the selected psms
+        """
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            if len(rows) != len(self):
+                raise ValueError(f"Boolean mask of length {len(rows)} does not match {len(self)} psms")
+            rows = np.flatnonzero(rows)
+        selection = Spectra(compact_encoding=self.compact_encoding)
+        selection._base = self
+        selection._row_indices = rows.astype(np.int64)
+        selection._pending_selection = True
+        return selection
 
     @staticmethod
     def _gen_column_names(fragment_type: FragmentType) -> List[str]:
@@ -80,91 +176,308 @@ class Spectra:
         """
         Add columns to spectra data.
 
+        The block is only staged and concatenated together with all other staged blocks on the next access to
+        spectra_data, such that adding k blocks copies the data once instead of k times.
+
         :param columns_data: a pandas data frame to add can be metrics or metadata
         """
-        # Check if columns already exist
-        self.spectra_data = pd.concat([self.spectra_data, columns_data], axis=1)
+        self._staged_columns.append(columns_data)
 
     def get_meta_data(self) -> pd.DataFrame:
-        """Get meta data with intensity, mz and intensity predictions as pd.DataFrame."""
-        columns = list(self.spectra_data.columns)
-        meta_data_columns = list(
-            filter(
-                lambda x: not x.startswith(
-                    tuple([Spectra.INTENSITY_COLUMN_PREFIX, Spectra.MZ_COLUMN_PREFIX, Spectra.INTENSITY_PRED_PREFIX])
-                ),
-                columns,
-            )
-        )
-
-        return self.spectra_data[meta_data_columns]
+        """Get meta data without intensity, mz and intensity predictions as pd.DataFrame."""
+        return self.spectra_data
+
+    @staticmethod
+    def compact_meta_data(meta_data: pd.DataFrame, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Convert meta data to a compact schema.
+
+        String columns that hold a few labels repeated over all psms are dictionary encoded as categoricals. Only
+        columns that are compared, grouped or written as they are, never transformed, are converted, so that the
+        features and the percolator input do not change: e.g. .apply(len) on a categorical sequence column returns a
+        categorical and integer columns downcast to int8 overflow under arithmetic.
+
+        :param meta_data: meta data as pd.DataFrame
+        :param columns: columns to convert, COMPACT_META_DATA_COLUMNS if not given
+        :return: meta data with compact column types
+        """
+        columns = Spectra.COMPACT_META_DATA_COLUMNS if columns is None else columns
+        compact_columns = {}
+        for name in columns:
+            if name not in meta_data or meta_data[name].dtype != object:
+                continue
+            if pd.api.types.infer_dtype(meta_data[name], skipna=True) == "string":
+                compact_columns[name] = meta_data[name].astype("category")
+        if not compact_columns:
+            return meta_data
+        return meta_data.assign(**compact_columns)
+
+    def memory_usage(self) -> pd.Series:
+        """
+        Get the number of bytes used by the index, every meta data column and every fragment matrix.
+
+        Matrices are listed under their column prefix (e.g. INTENSITY_RAW). Matrices that are still only available in
+        hdf5 or through a selection are not counted.
+
+        :return: bytes per column as pd.Series
+        """
+        usage = self.spectra_data.memory_usage(index=True, deep=True)
+        for fragment_type, matrix in self.fragment_matrices.items():
+            if isinstance(matrix, CompactMatrix):
+                nbytes = matrix.nbytes
+            else:
+                nbytes = matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+            usage[Spectra._resolve_prefix(fragment_type)] = nbytes
+        return usage
+
+    def _get_hdf5_meta_data(self) -> pd.DataFrame:
+        """Get meta data with categorical columns converted back to plain values, as required by hdf5."""
+        meta_data = self.get_meta_data()
+        categorical_columns = [
+            name for name, dtype in meta_data.dtypes.items() if isinstance(dtype, pd.CategoricalDtype)
+        ]
+        if not categorical_columns:
+            return meta_data
+        return meta_data.astype({name: meta_data[name].cat.categories.dtype for name in categorical_columns})
 
     def add_matrix_from_hdf5(self, intensity_data: pd.DataFrame, fragment_type: FragmentType) -> None:
         """
-        Concatenate intensity df as a sparse matrix to our data.
+        Add a sparse intensity df read from hdf5 to the matrix store.
 
         :param intensity_data: intensity sparse matrix
         :param fragment_type: choose predicted, raw, or mz
         """
-        # generate column names and build dataframe from sparse matrix
-        columns = self._gen_column_names(fragment_type)
-        intensity_data.columns = columns
-        self.add_columns(intensity_data)
+        self.add_sparse_matrix(intensity_data.sparse.to_coo(), fragment_type)
 
-    def add_matrix(self, intensity_data: pd.DataFrame, fragment_type: FragmentType) -> None:
+    def add_sparse_matrix(self, matrix: spmatrix, fragment_type: FragmentType) -> None:
         """
-        Concatenate intensity df as a sparse matrix to our data.
+        Store a sparse (n_psms x 174) matrix for the given fragment type.
 
-        :param intensity_data: intensity numpy array to add
+        Zero entries are invalid fragments (-1) and EPSILON marks zero intensity peaks, as produced by add_matrix.
+
+        :param matrix: sparse matrix with one row per psm in spectra_data
         :param fragment_type: choose predicted, raw, or mz
         """
-        intensity_df = intensity_data.explode()
+        self._hdf5_sources.pop(fragment_type, None)
+        if self.compact_encoding is None or fragment_type == FragmentType.MZ:
+            self.fragment_matrices[fragment_type] = csr_matrix(matrix, dtype=np.float32)
+        else:
+            self.fragment_matrices[fragment_type] = CompactMatrix(matrix, self.compact_encoding)
 
-        # reshape based on the number of fragments
-        intensity_array = intensity_df.values.astype(np.float32).reshape(-1, c.VEC_LENGTH)
+    @staticmethod
+    def _stack_intensities(intensity_data: Union[pd.Series, np.ndarray]) -> np.ndarray:
+        """
+        Stack per-psm intensities into one preallocated (n_psms x 174) float32 buffer.
+
+        Zero intensities are set to EPSILON and -1 (invalid fragments) to 0 in place, so that the buffer can be
+        converted to a sparse representation directly.
+
+        :param intensity_data: series of per-psm arrays (e.g. INTENSITIES or MZ from annotate_spectra) or a 2D array
+            with one row per psm (e.g. the intensity predictions)
+        :return: the stacked and masked intensity array
+        """
+        if isinstance(intensity_data, np.ndarray) and intensity_data.ndim == 2:
+            intensity_array = intensity_data.astype(np.float32)
+        else:
+            intensity_array = np.empty((len(intensity_data), c.VEC_LENGTH), dtype=np.float32)
+            if len(intensity_data) > 0:
+                np.stack(np.asarray(intensity_data), out=intensity_array)
 
         # Change zeros to epislon to keep the info of invalid values
         # change the -1 values to 0 (for better performance when converted to sparse representation)
         intensity_array[intensity_array == 0] = Spectra.EPSILON
         intensity_array[intensity_array == -1] = 0
+        return intensity_array
 
-        # generate column names and build dataframe from sparse matrix
-        intensity_df = pd.DataFrame.sparse.from_spmatrix(coo_matrix(intensity_array)).astype(np.float32)
-        columns = self._gen_column_names(fragment_type)
-        intensity_df.columns = columns
-        self.add_columns(intensity_df)
+    def add_matrix(self, intensity_data: Union[pd.Series, np.ndarray], fragment_type: FragmentType) -> None:
+        """
+        Add intensities as a sparse matrix to our data.
+
+        :param intensity_data: series of per-psm intensity arrays or 2D intensity numpy array to add
+        :param fragment_type: choose predicted, raw, or mz
+        """
+        self.add_sparse_matrix(self._stack_intensities(intensity_data), fragment_type)
 
-    def get_columns(self, fragment_type: FragmentType, return_column_names: bool = False) -> spmatrix:
+    def get_columns(self, fragment_type: FragmentType, return_column_names: bool = False) -> pd.DataFrame:
         """
-        Get intensities sparse matrix from dataframe.
+        Get intensities as a sparse dataframe with one named column per fragment ion.
 
         :param fragment_type: choose predicted, raw, or mz
         :param return_column_names: whether column names should be returned
-        :return: sparse matrix with the required data
+        :return: sparse dataframe with the required data
         """
-        prefix = Spectra._resolve_prefix(fragment_type)
-        logger.debug(prefix)
-        columns_to_select = list(filter(lambda c: c.startswith(prefix), self.spectra_data.columns))
         if return_column_names:
-            return scipy.sparse.csr_matrix(self.spectra_data[columns_to_select].values), columns_to_select
-        # Check if conversion is low change to coo then csr from coo
-        return self.spectra_data[columns_to_select]
+            return self.get_matrix(fragment_type, True)
+        matrix, columns = self.get_matrix(fragment_type, True)
+        return pd.DataFrame.sparse.from_spmatrix(matrix, index=self.spectra_data.index, columns=columns)
 
     def get_matrix(self, fragment_type: FragmentType, return_column_names: bool = False) -> spmatrix:
         """
-        Get intensities sparse matrix from dataframe.
+        Get intensities sparse matrix from the matrix store.
+
+        A fragment type that was never added, e.g. the predictions before they are predicted, gives a matrix without
+        columns.
 
         :param fragment_type: choose predicted, raw, or mz
         :param return_column_names: whether column names should be returned
         :return: sparse matrix with the required data
         """
-        prefix = Spectra._resolve_prefix(fragment_type)
-        logger.debug(prefix)
-        columns_to_select = list(filter(lambda c: c.startswith(prefix), self.spectra_data.columns))
+        logger.debug(fragment_type)
+        if fragment_type not in self.fragment_matrices and fragment_type in self._hdf5_sources:
+            input_file = self._hdf5_sources.pop(fragment_type)
+            logger.info(f"Loading {fragment_type.name} matrix from {input_file}")
+            self.add_sparse_matrix(self._read_sparse_hdf5(input_file, fragment_type), fragment_type)
+        if fragment_type in self.fragment_matrices:
+            matrix = self.fragment_matrices[fragment_type]
+        elif self._base is not None:
+            matrix = self._base._take_rows(fragment_type, self._row_indices)
+        else:
+            matrix = csr_matrix((len(self), 0), dtype=np.float32)
+        if matrix.shape[1] == 0:
+            return (matrix, []) if return_column_names else matrix
+        if isinstance(matrix, CompactMatrix):
+            matrix = matrix.decode()
         if return_column_names:
-            return scipy.sparse.csr_matrix(self.spectra_data[columns_to_select].values), columns_to_select
-        # Check if conversion is low change to coo then csr from coo
-        return scipy.sparse.csr_matrix(self.spectra_data[columns_to_select].values)
+            return matrix, self._gen_column_names(fragment_type)
+        return matrix
+
+    def get_matrix_rows(self, fragment_type: FragmentType, start: int, stop: int) -> csr_matrix:
+        """
+        Get the rows start:stop of an intensities sparse matrix.
+
+        If the matrix has not been loaded from hdf5 yet, only the requested rows are read from the file.
+
+        :param fragment_type: choose predicted, raw, or mz
+        :param start: first row to return
+        :param stop: row after the last row to return
+        :return: sparse matrix with the required rows
+        """
+        if fragment_type not in self.fragment_matrices and fragment_type in self._hdf5_sources:
+            return self._read_sparse_hdf5(self._hdf5_sources[fragment_type], fragment_type, (start, stop))
+        if fragment_type not in self.fragment_matrices and self._base is not None:
+            return self._base._take_rows(fragment_type, self._row_indices[start:stop])
+        if isinstance(self.fragment_matrices.get(fragment_type), CompactMatrix):
+            return self.fragment_matrices[fragment_type].decode_rows(start, stop)
+        return self.get_matrix(fragment_type)[start:stop]
+
+    def has_matrix(self, fragment_type: FragmentType) -> bool:
+        """
+        Check whether a matrix is available for the given fragment type, either loaded or pending in hdf5.
+
+        :param fragment_type: choose predicted, raw, or mz
+        :return: True if get_matrix can return this fragment type
+        """
+        if fragment_type in self.fragment_matrices or fragment_type in self._hdf5_sources:
+            return True
+        return self._base is not None and self._base.has_matrix(fragment_type)
+
+    def _take_rows(self, fragment_type: FragmentType, rows: np.ndarray) -> csr_matrix:
+        """
+        Get the given rows of an intensities sparse matrix, following selections down to the matrix they share.
+
+        :param fragment_type: choose predicted, raw, or mz
+        :param rows: integer positions of the rows
+        :return: sparse matrix with the required rows
+        """
+        if fragment_type not in self.fragment_matrices and fragment_type in self._hdf5_sources:
+            return self._read_sparse_hdf5_rows(self._hdf5_sources[fragment_type], fragment_type, rows)
+        if fragment_type in self.fragment_matrices or self._base is None:
+            matrix = self.fragment_matrices.get(fragment_type)
+            if isinstance(matrix, CompactMatrix) and len(rows) > 0:
+                first = rows.min()
+                return matrix.decode_rows(first, rows.max() + 1)[rows - first]
+            return self.get_matrix(fragment_type)[rows]
+        return self._base._take_rows(fragment_type, self._row_indices[rows])
+
+    def iter_batches(self, batch_size: int) -> Iterator["Spectra"]:
+        """
+        Iterate over consecutive batches of psms.
+
+        Each batch is a Spectra object with the corresponding rows of spectra_data and of every available matrix,
+        stored with the compact encoding of this object. Matrices that have not been loaded from hdf5 yet are read
+        batch by batch.
+
+        :param batch_size: maximum number of psms per batch
+        :yield: Spectra object for each batch
+        """
+        spectra_data = self.spectra_data
+        fragment_types = [fragment_type for fragment_type in FragmentType if self.has_matrix(fragment_type)]
+        for start in range(0, len(spectra_data), batch_size):
+            stop = start + batch_size
+            batch = Spectra(compact_encoding=self.compact_encoding)
+            batch.spectra_data = spectra_data.iloc[start:stop]
+            for fragment_type in fragment_types:
+                batch.add_sparse_matrix(self.get_matrix_rows(fragment_type, start, stop), fragment_type)
+            yield batch
+
+    @staticmethod
+    def _read_sparse_hdf5(
+        input_file: str, fragment_type: FragmentType, row_range: Optional[Tuple[int, int]] = None
+    ) -> csr_matrix:
+        """
+        Read a sparse matrix written by write_as_hdf5 directly into a csr matrix.
+
+        The coordinates are stored in row-major order, so a row range maps to one contiguous slice of the i, j and
+        values datasets which is located by binary search and read chunk-wise, without touching the rest of the file.
+
+        :param input_file: path to input file
+        :param fragment_type: choose predicted, raw, or mz
+        :param row_range: optional (start, stop) rows to read, all rows if not given
+        :return: sparse matrix with the required rows
+        """
+        group = f"sparse_{Spectra.HDF5_KEYS[fragment_type]}"
+        with h5py.File(input_file, "r") as f:
+            n_rows, n_columns = f[f"{group}/shape"][:]
+            rows = f[f"{group}/i"]
+            if row_range is None:
+                start, stop = 0, n_rows
+                first, last = 0, len(rows)
+            else:
+                start, stop = max(row_range[0], 0), min(row_range[1], n_rows)
+                first = bisect.bisect_left(rows, start)
+                last = bisect.bisect_left(rows, stop, lo=first)
+            i = rows[first:last] - start
+            j = f[f"{group}/j"][first:last]
+            values = f[f"{group}/values"][first:last].astype(np.float32)
+        return csr_matrix((values, (i, j)), shape=(max(stop - start, 0), n_columns), dtype=np.float32)
+
+    @staticmethod
+    def _read_sparse_hdf5_rows(input_file: str, fragment_type: FragmentType, rows: np.ndarray) -> csr_matrix:
+        """
+        Read the given rows of a sparse matrix written by write_as_hdf5.
+
+        The sorted rows are merged into runs of rows at most HDF5_ROW_GAP apart. Each run is one contiguous slice of the
+        row-major coordinates, located by binary search as in _read_sparse_hdf5, so only the slices around the
+        requested rows are read from the file.
+
+        :param input_file: path to input file
+        :param fragment_type: choose predicted, raw, or mz
+        :param rows: integer positions of the rows, in any order and possibly repeated
+        :return: sparse matrix with the required rows in the given order
+        """
+        group = f"sparse_{Spectra.HDF5_KEYS[fragment_type]}"
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        breaks = np.flatnonzero(np.diff(unique_rows) > HDF5_ROW_GAP) + 1
+        run_starts = unique_rows[np.r_[0, breaks]] if len(unique_rows) > 0 else unique_rows
+        run_stops = unique_rows[np.r_[breaks - 1, -1]] + 1 if len(unique_rows) > 0 else unique_rows
+        positions, columns, values = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+        with h5py.File(input_file, "r") as f:
+            n_columns = f[f"{group}/shape"][1]
+            coordinate_rows = f[f"{group}/i"]
+            first = 0
+            for start, stop in zip(run_starts, run_stops):
+                first = bisect.bisect_left(coordinate_rows, start, lo=first)
+                last = bisect.bisect_left(coordinate_rows, stop, lo=first)
+                i = coordinate_rows[first:last]
+                position = np.minimum(np.searchsorted(unique_rows, i), len(unique_rows) - 1)
+                requested = unique_rows[position] == i
+                positions.append(position[requested])
+                columns.append(f[f"{group}/j"][first:last][requested])
+                values.append(f[f"{group}/values"][first:last][requested])
+                first = last
+        coordinates = (np.concatenate(positions), np.concatenate(columns))
+        values = np.concatenate(values).astype(np.float32)
+        return csr_matrix((values, coordinates), shape=(len(unique_rows), n_columns), dtype=np.float32)[inverse]
 
     def write_as_hdf5(self, output_file: str) -> None:
         """
@@ -176,7 +489,7 @@ class Spectra:
 
         sparse_matrix_intensity_raw, columns_intensity = self.get_matrix(FragmentType.RAW, True)
         sparse_matrix_mz, columns_mz = self.get_matrix(FragmentType.MZ, True)
-        data_sets = [self.get_meta_data(), sparse_matrix_intensity_raw, sparse_matrix_mz]
+        data_sets = [self._get_hdf5_meta_data(), sparse_matrix_intensity_raw, sparse_matrix_mz]
         column_names = [columns_intensity, columns_mz]
 
         hdf5.write_file(data_sets, output_file, data_set_names, column_names)
@@ -192,17 +505,101 @@ class Spectra:
         sparse_matrix_intensity_raw, columns_intensity = self.get_matrix(FragmentType.RAW, True)
         sparse_matrix_mz, columns_mz = self.get_matrix(FragmentType.MZ, True)
         sparse_matrix_pred, columns_pred = self.get_matrix(FragmentType.PRED, True)
-        data_sets = [self.get_meta_data(), sparse_matrix_intensity_raw, sparse_matrix_mz, sparse_matrix_pred]
+        data_sets = [self._get_hdf5_meta_data(), sparse_matrix_intensity_raw, sparse_matrix_mz, sparse_matrix_pred]
         column_names = [columns_intensity, columns_mz, columns_pred]
 
         hdf5.write_file(data_sets, output_file, data_set_names, column_names)
 
-    def read_from_hdf5(self, input_file: str) -> None:
+    def read_from_hdf5(self, input_file: str, lazy: bool = True) -> None:
         """
         Read from hdf5 file.
 
+        The meta data is read immediately. If lazy is set, the intensity, mz and prediction matrices are only read
+        from the file on first access through get_matrix or get_matrix_rows.
+
         :param input_file: path to input file
+        :param lazy: whether to defer reading the matrices until they are needed
         """
         self.add_columns(hdf5.read_file(input_file, hdf5.META_DATA_KEY))
-        self.add_matrix_from_hdf5(hdf5.read_file(input_file, f"sparse_{hdf5.INTENSITY_RAW_KEY}"), FragmentType.RAW)
-        self.add_matrix_from_hdf5(hdf5.read_file(input_file, f"sparse_{hdf5.MZ_RAW_KEY}"), FragmentType.MZ)
+        with h5py.File(input_file, "r") as f:
+            fragment_types = [
+                fragment_type for fragment_type, key in Spectra.HDF5_KEYS.items() if f"sparse_{key}" in f.keys()
+            ]
+        for fragment_type in fragment_types:
+            self.fragment_matrices.pop(fragment_type, None)
+            self._hdf5_sources[fragment_type] = input_file
+            if not lazy:
+                self.get_matrix(fragment_type)
+
+    def write_as_parquet(self, output_file: str, batch_size: int = 100000, compression: str = "zstd") -> None:
+        """
+        Write meta data and all available matrices as parquet.
+
+        The meta data columns are stored as they are and each matrix as a fixed size list column of 174 float32 values
+        named after its prefix (e.g. INTENSITY_RAW). The file is written in row groups of batch_size psms such that
+        only one batch needs to be densified at a time. Requires pyarrow.
+
+        :param output_file: path to output file
+        :param batch_size: number of psms per row group
+        :param compression: parquet compression codec
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            for batch in self.iter_batches(batch_size):
+                table = pa.Table.from_pandas(batch.spectra_data, preserve_index=False)
+                for fragment_type in FragmentType:
+                    if not batch.has_matrix(fragment_type):
+                        continue
+                    values = pa.array(batch.get_matrix(fragment_type).toarray().ravel())
+                    table = table.append_column(
+                        Spectra._resolve_prefix(fragment_type),
+                        pa.FixedSizeListArray.from_arrays(values, c.VEC_LENGTH),
+                    )
+                if writer is None:
+                    writer = pq.ParquetWriter(output_file, table.schema, compression=compression)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+        logger.info(f"Data written to {output_file}")
+
+    def read_from_parquet(
+        self,
+        input_file: str,
+        columns: Optional[List[str]] = None,
+        fragment_types: Optional[List[FragmentType]] = None,
+    ) -> None:
+        """
+        Read from a parquet file written by write_as_parquet.
+
+        Only the requested columns are read from the file. The file is memory mapped and the float32 values of each
+        row group are viewed as a (n_psms x 174) array without copying before they are added to the matrix store.
+        Requires pyarrow.
+
+        :param input_file: path to input file
+        :param columns: meta data columns to read, all if not given
+        :param fragment_types: matrices to read, all available if not given
+        """
+        import pyarrow.parquet as pq
+
+        matrix_columns = {Spectra._resolve_prefix(fragment_type): fragment_type for fragment_type in FragmentType}
+        schema = pq.read_schema(input_file, memory_map=True)
+        if columns is None:
+            columns = [name for name in schema.names if name not in matrix_columns]
+        if fragment_types is None:
+            fragment_types = [fragment_type for name, fragment_type in matrix_columns.items() if name in schema.names]
+        fragment_columns = [Spectra._resolve_prefix(fragment_type) for fragment_type in fragment_types]
+
+        table = pq.read_table(input_file, columns=columns + fragment_columns, memory_map=True)
+        self.add_columns(table.select(columns).to_pandas())
+        for fragment_type, column in zip(fragment_types, fragment_columns):
+            matrices = [
+                csr_matrix(chunk.flatten().to_numpy().reshape(-1, c.VEC_LENGTH))
+                for chunk in table.column(column).chunks
+            ]
+            if len(matrices) == 0:
+                matrices = [csr_matrix((0, c.VEC_LENGTH), dtype=np.float32)]
+            self.add_sparse_matrix(scipy.sparse.vstack(matrices, format="csr"), fragment_type)
@@ -3,12 +3,25 @@ import os
 import subprocess
 from typing import List, Optional
 
+import numpy as np
 import pandas as pd
 
 from .calculate_features import CalculateFeatures
+from .ce_calibration import (
+    ALIGNMENT_CE_RANGE,
+    ALIGNMENT_KEY_COLUMNS,
+    get_alignment_library,
+    get_calibration_key,
+    get_ce_cache_path,
+    get_coarse_ces,
+    select_alignment_psms,
+)
+from .data.spectra import FragmentType, Spectra
+from .utils.ce_cache import CeCalibrationCache
 from .utils.multiprocessing_pool import JobPool
 from .utils.plotting import plot_all
 from .utils.process_step import ProcessStep
+from .utils.worker_context import init_worker_context
 
 logger = logging.getLogger(__name__)
 
@@ -35,15 +48,25 @@ def calculate_features_single(
     calc_feature_step.mark_done()
 
 
+def pool_alignment_predictions_single(
+    search_path: str, raw_path: str, out_path: str, config_path: Optional[str], raw_files: List[str]
+):
+    """Create ReScore object and predict the ce alignment spectra of the given raw files at once."""
+    re_score = ReScore(search_path=search_path, raw_path=raw_path, out_path=out_path, config_path=config_path)
+    re_score.raw_files = raw_files
+    re_score.predict_pooled_alignment()
+
+
 class ReScore(CalculateFeatures):
     """
     Main to init a re-score obj and go through the steps.
 
     1- get_raw_files
     2- split_msms
-    3- calculate_features
-    4- merge_input
-    5- rescore_with_perc
+    3- pool_alignment_predictions
+    4- calculate_features
+    5- merge_input
+    6- rescore_with_perc
     """
 
     raw_files: List[str]
@@ -119,9 +142,9 @@ class ReScore(CalculateFeatures):
         if not os.path.isdir(msms_path):
             os.makedirs(msms_path)
 
-        df_search = self._load_search()
+        df_search = Spectra.compact_meta_data(self._load_search())
         logger.info(f"Read {len(df_search.index)} PSMs from {self.search_path}")
-        for raw_file, df_search_split in df_search.groupby("RAW_FILE"):
+        for raw_file, df_search_split in df_search.groupby("RAW_FILE", observed=True):
             raw_file_path = os.path.join(self.raw_path, raw_file)
             if not (os.path.isfile(raw_file_path + ".raw") or os.path.isfile(raw_file_path + ".RAW")):
                 logger.info(f"Did not find {raw_file} in search directory, skipping this file")
@@ -141,12 +164,88 @@ class ReScore(CalculateFeatures):
 
         self.split_msms_step.mark_done()
 
+    def pool_alignment_predictions(self):
+        """
+        Predict the ce alignment spectra of all raw files at once.
+
+        With more than one thread, the predictions are made in a worker process, so that the parent process does not
+        open a connection to the prediction server before the raw files are processed in forked workers.
+        """
+        if self.config.num_threads > 1:
+            processing_pool = JobPool(processes=1, initializer=init_worker_context, initargs=(self.config_path,))
+            processing_pool.apply_async(
+                pool_alignment_predictions_single,
+                (self.search_path, self.raw_path, self.out_path, self.config_path, self.raw_files),
+            )
+            processing_pool.check_pool()
+        else:
+            self.predict_pooled_alignment()
+
+    def predict_pooled_alignment(self):
+        """
+        Predict the ce alignment spectra of all raw files in this process.
+
+        The psms selected for the alignment are gathered from all split msms files and every unique (sequence, charge,
+        fragmentation) is predicted once for the whole ce range, or for the coarse grid of the adaptive ce search which
+        every raw file then refines on its own. The predictions of each raw file are written next to its mzml file,
+        where CalculateFeatures picks them up instead of sending its own alignment predictions. Raw files whose
+        features were already calculated, whose ce calibration is cached or whose predictions were already written are
+        skipped.
+        """
+        mzml_path = self.get_mzml_folder_path()
+        if not os.path.isdir(mzml_path):
+            os.makedirs(mzml_path)
+
+        alignment_psms = {}
+        for raw_file in self.raw_files:
+            pooled_path = self._get_pooled_alignment_path(raw_file)
+            if ProcessStep(self.out_path, "calculate_features." + raw_file).is_done() or os.path.isfile(pooled_path):
+                continue
+            df_search = pd.read_csv(self._get_split_msms_path(raw_file), delimiter="\t")
+            mzml_file_path = os.path.join(mzml_path, os.path.splitext(raw_file)[0] + ".mzML")
+            raw_file_path = os.path.join(self.raw_path, raw_file)
+            cache_key = get_calibration_key(self.config, raw_file_path, mzml_file_path, df_search)
+            ce_cache = CeCalibrationCache(get_ce_cache_path(mzml_file_path))
+            if cache_key is not None and ce_cache.get(cache_key) is not None:
+                continue
+            alignment_psms[pooled_path] = df_search.iloc[select_alignment_psms(df_search)][ALIGNMENT_KEY_COLUMNS]
+        if not alignment_psms:
+            return
+
+        unique_psms = pd.concat(alignment_psms.values()).drop_duplicates(ignore_index=True)
+        logger.info(
+            f"Predicting {len(unique_psms)} unique psms for the alignment of {len(alignment_psms)} raw files, "
+            f"{sum(len(psms) for psms in alignment_psms.values())} psms in total"
+        )
+        if self.config.ce_search == "adaptive":
+            ce_range = get_coarse_ces(self.config.ce_search_step)
+        else:
+            ce_range = np.arange(*ALIGNMENT_CE_RANGE)
+        alignment_library = get_alignment_library(unique_psms, ce_range)
+        self.grpc_predict(alignment_library, alignment=True)
+        pred_intensity = alignment_library.get_matrix(FragmentType.PRED)
+
+        unique_psms["POOLED_INDEX"] = np.arange(len(unique_psms))
+        for pooled_path, psms in alignment_psms.items():
+            psms = psms.drop_duplicates().merge(unique_psms, on=ALIGNMENT_KEY_COLUMNS)
+            # row of psm i at ce k in the alignment library is k * len(unique_psms) + i
+            rows = (np.arange(len(ce_range))[:, None] * len(unique_psms) + psms["POOLED_INDEX"].to_numpy()).ravel()
+            np.savez(
+                pooled_path,
+                collision_energies=ce_range,
+                pred_intensity=pred_intensity[rows].toarray().reshape(len(ce_range), len(psms), 174),
+                MODIFIED_SEQUENCE=psms["MODIFIED_SEQUENCE"].to_numpy(dtype=str),
+                PRECURSOR_CHARGE=psms["PRECURSOR_CHARGE"].to_numpy(dtype=int),
+                FRAGMENTATION=psms["FRAGMENTATION"].to_numpy(dtype=str),
+            )
+
     def calculate_features(self):
         """Calculates percolator input features per raw file using multiprocessing."""
         num_threads = self.config.num_threads
-        self.config
         if num_threads > 1:
-            processing_pool = JobPool(processes=num_threads)
+            processing_pool = JobPool(
+                processes=num_threads, initializer=init_worker_context, initargs=(self.config_path,)
+            )
 
         mzml_path = self.get_mzml_folder_path()
         if not os.path.isdir(mzml_path):
@@ -283,6 +382,15 @@ class ReScore(CalculateFeatures):
         """
         return os.path.join(self.get_msms_folder_path(), os.path.splitext(raw_file)[0] + ".rescore")
 
+    def _get_pooled_alignment_path(self, raw_file: str) -> str:
+        """
+        Get path to the pooled alignment predictions of a raw file.
+
+        :param raw_file: path to raw file as a string
+        :return: path to the pooled alignment predictions, see CeCalibration.get_pooled_alignment_path
+        """
+        return os.path.join(self.get_mzml_folder_path(), os.path.splitext(raw_file)[0] + ".mzML.alignment_pred.npz")
+
     def get_mzml_folder_path(self) -> str:
         """Get folder path to mzml."""
         return os.path.join(self.out_path, "mzML")
@@ -1,6 +1,13 @@
+import hashlib
 import logging
 import os
+import queue
+import shutil
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
 
+import numpy as np
+import pandas as pd
 import spectrum_fundamentals.constants as c
 from spectrum_fundamentals.fragments import compute_peptide_mass
 from spectrum_fundamentals.mod_string import internal_without_mods, maxquant_to_internal
@@ -10,7 +17,12 @@ from spectrum_io.spectral_library import MSP
 from .ce_calibration import CeCalibration, SpectralLibrary
 from .data.spectra import Spectra
 from .re_score import ReScore
+from .utils.ce_cache import frame_fingerprint
 from .utils.config import Config
+from .utils.multiprocessing_pool import JobPool
+from .utils.plotting import plot_mean_sa_ce
+from .utils.prediction_checkpoint import LibraryCheckpoint, PredictionCheckpoint
+from .utils.worker_context import init_worker_context
 
 __version__ = "0.1.0"
 __copyright__ = """Copyright (c) 2020-2021 Oktoberfest dev-team. All rights reserved.
@@ -25,6 +37,9 @@ at the Technical University of Munich."""
 
 logger = logging.getLogger(__name__)
 
+# seconds the library prediction thread waits on a full queue before it checks whether the writer stopped
+QUEUE_POLL_SECONDS = 0.5
+
 
 def generate_spectral_lib(search_dir: str, config_path: str):
     """
@@ -36,93 +51,410 @@ def generate_spectral_lib(search_dir: str, config_path: str):
     """
     spec_library = SpectralLibrary(path=search_dir, out_path=search_dir, config_path=config_path)
     spec_library.gen_lib()
-    spec_library.library.spectra_data["MODIFIED_SEQUENCE"] = spec_library.library.spectra_data[
-        "MODIFIED_SEQUENCE"
-    ].apply(lambda x: "_" + x + "_")
-    models_dict = spec_library.config.models
-    spec_library.library.spectra_data["MODIFIED_SEQUENCE"] = maxquant_to_internal(
-        spec_library.library.spectra_data["MODIFIED_SEQUENCE"], fixed_mods={}
-    )
-    spec_library.library.spectra_data["SEQUENCE"] = internal_without_mods(
-        spec_library.library.spectra_data["MODIFIED_SEQUENCE"]
-    )
-    spec_library.library.spectra_data["PEPTIDE_LENGTH"] = spec_library.library.spectra_data["SEQUENCE"].apply(
-        lambda x: len(x)
+    spec_library.library.spectra_data = _preprocess_library(
+        spec_library.library.spectra_data, _get_library_fixed_mods(spec_library.config)
     )
 
-    logger.info(f"No of sequences before Filtering is {len(spec_library.library.spectra_data['PEPTIDE_LENGTH'])}")
-    spec_library.library.spectra_data = spec_library.library.spectra_data[
-        (spec_library.library.spectra_data["PEPTIDE_LENGTH"] <= 30)
-    ]
-    spec_library.library.spectra_data = spec_library.library.spectra_data[
-        (~spec_library.library.spectra_data["MODIFIED_SEQUENCE"].str.contains(r"\(ac\)"))
-    ]
-    spec_library.library.spectra_data = spec_library.library.spectra_data[
-        (~spec_library.library.spectra_data["MODIFIED_SEQUENCE"].str.contains(r"\(Acetyl \(Protein N-term\)\)"))
-    ]
-    spec_library.library.spectra_data = spec_library.library.spectra_data[
-        (~spec_library.library.spectra_data["SEQUENCE"].str.contains("U"))
-    ]
-    spec_library.library.spectra_data = spec_library.library.spectra_data[
-        spec_library.library.spectra_data["PRECURSOR_CHARGE"] <= 6
-    ]
-    spec_library.library.spectra_data = spec_library.library.spectra_data[
-        spec_library.library.spectra_data["PEPTIDE_LENGTH"] >= 7
-    ]
-    logger.info(f"No of sequences after Filtering is {len(spec_library.library.spectra_data['PEPTIDE_LENGTH'])}")
-
-    tmt_model = False
-    for _, value in models_dict.items():
-        if value:
-            if "TMT" in value:
-                tmt_model = True
-    if tmt_model and spec_library.config.tag != "":
-        unimod_tag = c.TMT_MODS[spec_library.config.tag]
-        spec_library.library.spectra_data["MODIFIED_SEQUENCE"] = maxquant_to_internal(
-            spec_library.library.spectra_data["MODIFIED_SEQUENCE"],
-            fixed_mods={"C": "C[UNIMOD:4]", "^_": f"_{unimod_tag}", "K": f"K{unimod_tag}"},
-        )
+    if spec_library.config.output_format == "msp":
+        out_lib_path = os.path.join(spec_library.results_path, "myPrositLib.msp")
+    elif spec_library.config.output_format == "spectronaut":
+        out_lib_path = os.path.join(spec_library.results_path, "myPrositLib.csv")
+    else:
+        raise ValueError(f"{spec_library.config.output_format} is not supported as spectral library type")
+    checkpoint_dir = os.path.join(spec_library.results_path, "prediction_checkpoint")
+    library_checkpoint = None
+    if spec_library.config.prediction_checkpoint:
+        library_checkpoint = _get_library_checkpoint(spec_library, checkpoint_dir)
+    else:
+        PredictionCheckpoint.remove(checkpoint_dir)
+
+    if spec_library.config.num_threads > 1:
+        _write_library_shards(spec_library, library_checkpoint, out_lib_path)
     else:
-        spec_library.library.spectra_data["MODIFIED_SEQUENCE"] = maxquant_to_internal(
-            spec_library.library.spectra_data["MODIFIED_SEQUENCE"]
+        _write_library_file(spec_library, library_checkpoint, out_lib_path)
+    PredictionCheckpoint.remove(checkpoint_dir)
+
+
+def _get_library_fixed_mods(config: Config) -> Optional[Dict[str, str]]:
+    """
+    Get the fixed modifications of the library, the TMT tag is added for TMT models.
+
+    :param config: the config
+    :return: fixed modifications for maxquant_to_internal, None for carbamidomethylation only
+    """
+    tmt_model = any(value and "TMT" in value for value in config.models.values())
+    if tmt_model and config.tag != "":
+        unimod_tag = c.TMT_MODS[config.tag]
+        return {"C": "C[UNIMOD:4]", "^_": f"_{unimod_tag}", "K": f"K{unimod_tag}"}
+    return None
+
+
+def _write_library_file(
+    spec_library: SpectralLibrary, library_checkpoint: Optional[LibraryCheckpoint], out_lib_path: str
+):
+    """
+    Append the predicted sections to the library file in the main thread.
+
+    :param spec_library: the SpectralLibrary with the preprocessed library
+    :param library_checkpoint: checkpoint of the library, None without checkpoint
+    :param out_lib_path: path to the library file
+    """
+    written = _resume_library_file(library_checkpoint, out_lib_path)
+    for start, spectra_div, grpc_output_sec in _iter_predicted_sections(spec_library, library_checkpoint, written):
+        write_library_section(
+            spectra_div.spectra_data, grpc_output_sec, spec_library.config.output_format, out_lib_path
         )
-    spec_library.library.spectra_data["MASS"] = spec_library.library.spectra_data["MODIFIED_SEQUENCE"].apply(
-        lambda x: compute_peptide_mass(x)
-    )
-    no_of_spectra = len(spec_library.library.spectra_data)
-    no_of_sections = no_of_spectra // 7000
-    for i in range(0, no_of_sections + 1):
-        spectra_div = Spectra()
-        if i < no_of_sections:
-            spectra_div.spectra_data = spec_library.library.spectra_data.iloc[i * 7000 : (i + 1) * 7000]
-            logger.info(f"Indices {i * 7000}, {(i + 1) * 7000}")
-        elif (i * 7000) < no_of_spectra:
-            spectra_div.spectra_data = spec_library.library.spectra_data.iloc[i * 7000 :]
-            logger.info(f"Last Batch from index {i * 7000}")
-            logger.info(f"Batch of size {len(spectra_div.spectra_data.index)}")
-        else:
-            break
+        if library_checkpoint is not None:
+            library_checkpoint.mark_written(start, os.path.getsize(out_lib_path))
 
-        grpc_output_sec = spec_library.grpc_predict(spectra_div)
-        if spec_library.config.output_format == "msp":
-            out_lib_msp = MSP(
-                spectra_div.spectra_data, grpc_output_sec, os.path.join(spec_library.results_path, "myPrositLib.msp")
-            )
-            out_lib_msp.prepare_spectrum()
-            out_lib_msp.write()
-        elif spec_library.config.output_format == "spectronaut":
-            out_lib_spectronaut = Spectronaut(
-                spectra_div.spectra_data, grpc_output_sec, os.path.join(spec_library.results_path, "myPrositLib.csv")
+
+def _write_library_shards(
+    spec_library: SpectralLibrary, library_checkpoint: Optional[LibraryCheckpoint], out_lib_path: str
+):
+    """
+    Format the predicted sections in a process pool into one shard file each and concatenate them in order.
+
+    The pool is started before the prediction thread, so no thread is forked.
+
+    :param spec_library: the SpectralLibrary with the preprocessed library
+    :param library_checkpoint: checkpoint of the library, None without checkpoint
+    :param out_lib_path: path to the library file
+    """
+    num_threads = spec_library.config.num_threads
+    shard_dir = os.path.join(spec_library.results_path, "library_shards")
+    extension = os.path.splitext(out_lib_path)[1]
+    written = _resume_library_shards(library_checkpoint, shard_dir, extension)
+    section_starts = set(written)
+    processing_pool = JobPool(processes=num_threads)
+    try:
+        for start, spectra_div, grpc_output_sec in _iter_predicted_sections(spec_library, library_checkpoint, written):
+            section_starts.add(start)
+            # wait for the formatting of older sections, so that at most two sections per process are pending
+            if len(processing_pool.results) >= 2 * num_threads:
+                processing_pool.results[-2 * num_threads].wait()
+            processing_pool.apply_async(
+                write_library_shard,
+                (
+                    spectra_div.spectra_data,
+                    grpc_output_sec,
+                    spec_library.config.output_format,
+                    _get_shard_path(shard_dir, start, extension),
+                    library_checkpoint.get_section_dir(start) if library_checkpoint else None,
+                ),
             )
-            out_lib_spectronaut.prepare_spectrum()
-            out_lib_spectronaut.write()
-        else:
-            raise ValueError(f"{spec_library.config.output_format} is not supported as spectral library type")
+    except BaseException:
+        processing_pool.pool.terminate()
+        raise
+    processing_pool.check_pool()
+    shard_paths = [_get_shard_path(shard_dir, start, extension) for start in sorted(section_starts)]
+    _concatenate_library_shards(shard_paths, out_lib_path, spec_library.config.output_format == "spectronaut")
+    shutil.rmtree(shard_dir)
+
+
+def _iter_predicted_sections(
+    spec_library: SpectralLibrary, library_checkpoint: Optional[LibraryCheckpoint], written: Set[int]
+) -> Iterator[Tuple[int, Spectra, dict]]:
+    """
+    Predict the sections of the library in a background thread while the caller writes the finished ones.
+
+    The queue between the threads holds at most libraryQueueDepth predicted sections, which bounds the memory held by
+    the pipeline. An exception raised by a prediction is raised again in the calling thread. If the caller fails or
+    stops early, the generator is closed and the prediction thread stops after the section it is predicting.
+
+    :param spec_library: the SpectralLibrary with the preprocessed library
+    :param library_checkpoint: checkpoint of the library, None to predict without checkpoint
+    :param written: first rows of the sections written by an earlier run, which are skipped
+    :raises BaseException: the exception raised by a prediction
+    :yield: first row, spectra and predictions of each section in library order
+    """
+    predicted_sections: queue.Queue = queue.Queue(maxsize=spec_library.config.library_queue_depth)
+    stopped = threading.Event()
+    producer = threading.Thread(
+        target=_predict_library_sections,
+        args=(spec_library, library_checkpoint, written, predicted_sections, stopped),
+        name="library_prediction",
+        daemon=True,
+    )
+    producer.start()
+    try:
+        while True:
+            predicted_section = predicted_sections.get()
+            if predicted_section is None:
+                break
+            if isinstance(predicted_section, BaseException):
+                raise predicted_section
+            yield predicted_section
+    finally:
+        stopped.set()
+    producer.join()
+
+
+def _get_library_checkpoint(spec_library: SpectralLibrary, checkpoint_dir: str) -> LibraryCheckpoint:
+    """
+    Open the checkpoint of the preprocessed library, a checkpoint of another library or setup is discarded.
+
+    :param spec_library: the SpectralLibrary with the preprocessed library
+    :param checkpoint_dir: directory of the checkpoint
+    :return: the checkpoint
+    """
+    config = spec_library.config
+    setup = f"{config.models}|{config.output_format}|{config.num_threads > 1}"
+    fingerprint = frame_fingerprint(spec_library.library.spectra_data)
+    return LibraryCheckpoint(checkpoint_dir, hashlib.sha256(f"{fingerprint}|{setup}".encode()).hexdigest())
+
+
+def _resume_library_file(library_checkpoint: Optional[LibraryCheckpoint], out_lib_path: str) -> Set[int]:
+    """
+    Truncate the library file after the sections written by an earlier run, or remove it if there are none.
+
+    :param library_checkpoint: checkpoint of the library, None without checkpoint
+    :param out_lib_path: path to the library file
+    :return: first rows of the written sections
+    """
+    starts, size = library_checkpoint.completed if library_checkpoint else ([], 0)
+    if starts and os.path.isfile(out_lib_path) and os.path.getsize(out_lib_path) >= size:
+        with open(out_lib_path, "r+b") as f:
+            f.truncate(size)
+        logger.info(f"Resuming {out_lib_path} after {len(starts)} written sections")
+        return set(starts)
+    if library_checkpoint is not None:
+        library_checkpoint.clear_written()
+    if os.path.isfile(out_lib_path):
+        os.remove(out_lib_path)
+    return set()
+
+
+def _resume_library_shards(library_checkpoint: Optional[LibraryCheckpoint], shard_dir: str, extension: str) -> Set[int]:
+    """
+    Find the shards written by an earlier run, or start with an empty shard directory if there are none.
+
+    :param library_checkpoint: checkpoint of the library, None without checkpoint
+    :param shard_dir: directory of the shard files
+    :param extension: extension of the library file
+    :return: first rows of the sections with a shard file
+    """
+    sections = library_checkpoint.sections if library_checkpoint else {}
+    written = {start for start in sections if os.path.isfile(_get_shard_path(shard_dir, start, extension))}
+    if written:
+        logger.info(f"Resuming {shard_dir} after {len(written)} written shards")
+    else:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+    os.makedirs(shard_dir, exist_ok=True)
+    return written
+
+
+def _get_shard_path(shard_dir: str, start: int, extension: str) -> str:
+    """Get path to the shard file of the section starting at row start."""
+    return os.path.join(shard_dir, f"shard_{start}{extension}")
+
+
+def _preprocess_library(spectra_data: pd.DataFrame, fixed_mods: Optional[Dict[str, str]]) -> pd.DataFrame:
+    """
+    Convert the modified sequences of a library to the internal format, filter the peptides and compute their masses.
+
+    Every distinct modified sequence is converted once, and the filters on length (7 to 30), acetylation and
+    selenocysteine are evaluated per distinct sequence, combined with the precursor charge filter (at most 6) into one
+    mask. The mass is computed once per distinct sequence that passes the filters.
+
+    :param spectra_data: library with MODIFIED_SEQUENCE in MaxQuant format and PRECURSOR_CHARGE
+    :param fixed_mods: fixed modifications for maxquant_to_internal, None for carbamidomethylation only
+    :return: the filtered library with MODIFIED_SEQUENCE in internal format, SEQUENCE, PEPTIDE_LENGTH and MASS
+    """
+    codes, unique_sequences = pd.factorize(spectra_data["MODIFIED_SEQUENCE"])
+    # variable modifications are converted first, the filters are evaluated on the result before fixed modifications
+    modified_sequences = pd.Series(maxquant_to_internal("_" + pd.Series(unique_sequences, dtype=str) + "_", {}))
+    sequences = pd.Series(internal_without_mods(modified_sequences))
+    lengths = sequences.str.len()
+    sequence_mask = (
+        lengths.between(7, 30)
+        & ~modified_sequences.str.contains(r"\(ac\)")
+        & ~modified_sequences.str.contains(r"\(Acetyl \(Protein N-term\)\)")
+        & ~sequences.str.contains("U")
+    ).to_numpy()
+
+    logger.info(f"No of sequences before Filtering is {len(spectra_data)}")
+    mask = sequence_mask[codes] & (spectra_data["PRECURSOR_CHARGE"] <= 6).to_numpy()
+    spectra_data = spectra_data[mask]
+    codes = codes[mask]
+    logger.info(f"No of sequences after Filtering is {len(spectra_data)}")
+
+    kept = np.unique(codes)
+    internal_sequences = np.empty(len(unique_sequences), dtype=object)
+    internal_sequences[kept] = maxquant_to_internal(modified_sequences.iloc[kept], fixed_mods)
+    masses = np.zeros(len(unique_sequences))
+    masses[kept] = [compute_peptide_mass(sequence) for sequence in internal_sequences[kept]]
+    return spectra_data.assign(
+        MODIFIED_SEQUENCE=internal_sequences[codes],
+        SEQUENCE=sequences.to_numpy()[codes],
+        PEPTIDE_LENGTH=lengths.to_numpy()[codes],
+        MASS=masses[codes],
+    )
+
+
+# This function cannot be a function inside generate_spectral_lib since the multiprocessing pool needs to pickle it
+def write_library_section(spectra_data: pd.DataFrame, grpc_output: dict, output_format: str, out_path: str):
+    """
+    Format a section of the spectral library and append it to a file.
+
+    :param spectra_data: metadata of the spectra of the section
+    :param grpc_output: predictions of the section
+    :param output_format: msp or spectronaut
+    :param out_path: path to the library or shard file
+    """
+    if output_format == "msp":
+        out_lib_msp = MSP(spectra_data, grpc_output, out_path)
+        out_lib_msp.prepare_spectrum()
+        out_lib_msp.write()
+    else:
+        out_lib_spectronaut = Spectronaut(spectra_data, grpc_output, out_path)
+        out_lib_spectronaut.prepare_spectrum()
+        out_lib_spectronaut.write()
+
+
+# This function cannot be a function inside generate_spectral_lib since the multiprocessing pool needs to pickle it
+def write_library_shard(
+    spectra_data: pd.DataFrame,
+    grpc_output: dict,
+    output_format: str,
+    shard_path: str,
+    checkpoint_dir: Optional[str],
+):
+    """
+    Format a section of the spectral library into its shard file and remove the checkpoint of its predictions.
+
+    The shard is written under a temporary name and renamed when complete, so an existing shard is always complete.
+
+    :param spectra_data: metadata of the spectra of the section
+    :param grpc_output: predictions of the section
+    :param output_format: msp or spectronaut
+    :param shard_path: path to the shard file
+    :param checkpoint_dir: directory of the prediction checkpoint of the section, None without checkpoint
+    """
+    tmp_path = shard_path + ".tmp"
+    if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+    write_library_section(spectra_data, grpc_output, output_format, tmp_path)
+    if os.path.isfile(tmp_path):
+        os.replace(tmp_path, shard_path)
+    else:
+        open(shard_path, "wb").close()
+    if checkpoint_dir is not None:
+        PredictionCheckpoint.remove(checkpoint_dir)
+
+
+def _concatenate_library_shards(shard_paths: List[str], out_path: str, has_header: bool):
+    """
+    Concatenate the shard files of a spectral library byte by byte.
+
+    :param shard_paths: paths to the shard files in library order, a shard without spectra may not exist
+    :param out_path: path to the library file
+    :param has_header: True if every shard starts with a header line, only the header of the first shard is kept
+    """
+    header_written = False
+    with open(out_path, "wb") as out:
+        for shard_path in shard_paths:
+            if not os.path.isfile(shard_path):
+                continue
+            with open(shard_path, "rb") as shard:
+                if has_header and header_written:
+                    shard.readline()
+                shutil.copyfileobj(shard, out, 1 << 24)
+            header_written = True
+    logger.info(f"Concatenated {len(shard_paths)} shards into {out_path}")
+
+
+def _predict_library_sections(
+    spec_library: SpectralLibrary,
+    library_checkpoint: Optional[LibraryCheckpoint],
+    written: Set[int],
+    predicted_sections: queue.Queue,
+    stopped: threading.Event,
+):
+    """
+    Predict the library in sections and put each section with its predictions in the queue.
+
+    A section holds inFlightBatches batches of the current batch size, so its batches are predicted concurrently. The
+    bounds of the sections are recorded with the checkpoint, so that a rerun resumes with the same sections. The end of
+    the library is marked by None, an exception raised by a prediction is put in the queue instead. Once stopped is
+    set by the writer, no further section is predicted or put in the queue.
+
+    :param spec_library: the SpectralLibrary with the preprocessed library
+    :param library_checkpoint: checkpoint of the library, None to predict without checkpoint
+    :param written: first rows of the sections written by an earlier run, which are skipped
+    :param predicted_sections: queue of (first row, section, predictions) tuples for the writer
+    :param stopped: event set by the writer when it does not take sections anymore
+    """
+    try:
+        sections = library_checkpoint.sections if library_checkpoint else {}
+        no_of_spectra = len(spec_library.library.spectra_data)
+        start = 0
+        while start < no_of_spectra and not stopped.is_set():
+            if start in sections:
+                stop = sections[start]
+            else:
+                stop = start + spec_library.context.batch_sizer.size * spec_library.config.in_flight_batches
+            if start in written:
+                start = stop
+                continue
+            spectra_div = Spectra()
+            spectra_div.spectra_data = spec_library.library.spectra_data.iloc[start:stop].copy()
+            logger.info(f"Predicting section with indices {start}, {start + len(spectra_div.spectra_data)}")
+
+            section_checkpoint_dir = None
+            if library_checkpoint is not None:
+                library_checkpoint.add_section(start, stop)
+                section_checkpoint_dir = library_checkpoint.get_section_dir(start)
+            grpc_output_sec = spec_library.grpc_predict(spectra_div, checkpoint_dir=section_checkpoint_dir)
+            _put_section(predicted_sections, (start, spectra_div, grpc_output_sec), stopped)
+            start = stop
+    except BaseException as e:
+        _put_section(predicted_sections, e, stopped)
+        return
+    _put_section(predicted_sections, None, stopped)
+
+
+def _put_section(predicted_sections: queue.Queue, item: Any, stopped: threading.Event):
+    """
+    Put an item in the queue of predicted sections, waiting while it is full unless the writer stopped.
+
+    :param predicted_sections: queue of predicted sections
+    :param item: predicted section, exception or None
+    :param stopped: event set by the writer when it does not take sections anymore
+    """
+    while not stopped.is_set():
+        try:
+            predicted_sections.put(item, timeout=QUEUE_POLL_SECONDS)
+            return
+        except queue.Full:
+            continue
+
+
+# This function cannot be a function inside run_ce_calibration since the multiprocessing pool needs to pickle it
+def calibrate_ce_single(
+    raw_file_path: str, df_search: pd.DataFrame, mzml_path: str, config_path: str
+) -> Tuple[str, float, Optional[pd.Series]]:
+    """
+    Create a CeCalibration object and run the CE calibration for a given raw file.
+
+    :param raw_file_path: path to the raw file
+    :param df_search: search result of the raw file
+    :param mzml_path: path to the mzml file of the raw file
+    :param config_path: path to config file
+    :return: the raw file name, its best CE and its mean spectral angle per CE (None if no spectrum is HCD)
+    """
+    logger.info(f"Calibrating CE for {raw_file_path}")
+    ce_calib = CeCalibration(search_path="", raw_path=raw_file_path, out_path=mzml_path, config_path=config_path)
+    ce_calib.perform_alignment(df_search)
+    return os.path.basename(raw_file_path), ce_calib.best_ce, getattr(ce_calib, "ce_alignment", None)
 
 
 def run_ce_calibration(msms_path: str, search_dir: str, config_path: str):
     """
-    Create a CeCalibration object and run the CE calibration.
+    Create a CeCalibration object and run the CE calibration for every raw file.
+
+    The search result is read once and split per raw file. The raw files are calibrated in parallel using numThreads
+    processes. The best CE per raw file is written to ce_calibration.tsv, the mean spectral angle curves per raw file
+    and pooled over all raw files to ce_curves.tsv and the best CE of the pooled curve to ce.txt.
 
     :param msms_path: path to msms folder
     :param search_dir: path to directory containing the msms.txt and raw files
@@ -130,7 +462,6 @@ def run_ce_calibration(msms_path: str, search_dir: str, config_path: str):
     :raises ValueError: raw_type is not supported as rawfile-type
     """
     ce_calib = CeCalibration(search_path=msms_path, raw_path=search_dir, out_path=search_dir, config_path=config_path)
-    df_search = ce_calib._load_search()
     raw_type = ce_calib.config.raw_type
     if raw_type == "thermo":
         extension = ".raw"
@@ -138,14 +469,69 @@ def run_ce_calibration(msms_path: str, search_dir: str, config_path: str):
         extension = ".mzml"
     else:
         raise ValueError(f"{raw_type} is not supported as rawfile-type")
+    raw_files = sorted(os.path.basename(f) for f in os.listdir(search_dir) if f.lower().endswith(extension))
+    logger.info(f"Found {len(raw_files)} raw files in the search directory")
 
-    ce_calib.raw_path = os.path.join(
-        ce_calib.raw_path,
-        [os.path.basename(f) for f in os.listdir(ce_calib.raw_path) if f.lower().endswith(extension)][0],
+    df_search = Spectra.compact_meta_data(ce_calib._load_search())
+    df_search_splits = dict(list(df_search.groupby("RAW_FILE", observed=True)))
+
+    mzml_path = os.path.join(search_dir, "mzML")
+    if not os.path.isdir(mzml_path):
+        os.makedirs(mzml_path)
+
+    num_threads = ce_calib.config.num_threads
+    if num_threads > 1:
+        processing_pool = JobPool(processes=num_threads, initializer=init_worker_context, initargs=(config_path,))
+    results = []
+    for raw_file in raw_files:
+        raw_file_name = os.path.splitext(raw_file)[0]
+        if raw_file_name not in df_search_splits:
+            logger.info(f"Did not find {raw_file} in the search result, skipping this file")
+            continue
+        raw_file_path = os.path.join(search_dir, raw_file)
+        if raw_type == "mzml":
+            mzml_file_path = raw_file_path
+        else:
+            mzml_file_path = os.path.join(mzml_path, raw_file_name + ".mzML")
+        args = (raw_file_path, df_search_splits[raw_file_name], mzml_file_path, config_path)
+        if num_threads > 1:
+            processing_pool.apply_async(calibrate_ce_single, args)
+        else:
+            results.append(calibrate_ce_single(*args))
+    if num_threads > 1:
+        results = processing_pool.check_pool(print_progress_every=1)
+
+    ce_table = pd.DataFrame(
+        [(raw_file, best_ce) for raw_file, best_ce, _ in results], columns=["RAW_FILE", "COLLISION_ENERGY"]
     )
-    ce_calib.perform_alignment(df_search)
+    ce_table.to_csv(os.path.join(ce_calib.results_path, "ce_calibration.tsv"), sep="\t", index=False)
+
+    best_ce = _pool_ce_curves(results, ce_calib.results_path)
+    logger.info(f"Best collision energy of the pooled curve: {best_ce}")
     with open(os.path.join(ce_calib.results_path, "ce.txt"), "w") as f:
-        f.write(str(ce_calib.best_ce))
+        f.write(str(best_ce))
+
+
+def _pool_ce_curves(results: List[Tuple[str, float, Optional[pd.Series]]], results_path: str) -> float:
+    """
+    Pool the mean spectral angle curves of all raw files and write them to ce_curves.tsv.
+
+    Every raw file is weighted equally. Curves of an adaptive ce search only cover some collision energies and are
+    linearly interpolated in between.
+
+    :param results: raw file name, best CE and mean spectral angle per CE of every raw file, see calibrate_ce_single
+    :param results_path: path to the results folder
+    :return: the best CE of the pooled curve, 35 if no raw file has HCD spectra
+    """
+    curves = {raw_file: ce_alignment for raw_file, _, ce_alignment in results if ce_alignment is not None}
+    if not curves:
+        return 35.0
+    ce_curves = pd.DataFrame(curves).sort_index()
+    ce_curves["POOLED"] = ce_curves.interpolate(method="index", limit_area="inside").mean(axis=1)
+    ce_curves.to_csv(os.path.join(results_path, "ce_curves.tsv"), sep="\t")
+    pooled_curve = ce_curves["POOLED"].rename("SPECTRAL_ANGLE")
+    plot_mean_sa_ce(sa_ce_df=pooled_curve, directory=results_path, raw_file_name="pooled_")
+    return pooled_curve.idxmax()
 
 
 def run_rescoring(msms_path: str, search_dir: str, config_path: str):
@@ -159,6 +545,7 @@ def run_rescoring(msms_path: str, search_dir: str, config_path: str):
     re_score = ReScore(search_path=msms_path, raw_path=search_dir, out_path=search_dir, config_path=config_path)
     re_score.get_raw_files()
     re_score.split_msms()
+    re_score.pool_alignment_predictions()
     re_score.calculate_features()
 
     re_score.merge_input("rescore")
@@ -1,19 +1,31 @@
+import hashlib
 import logging
 import os
-from pathlib import Path
-from typing import Optional
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
-from prosit_grpc.predictPROSIT import PROSITpredictor
+import scipy.sparse
 from spectrum_io.file import csv
 from spectrum_io.spectral_library import digest
 
-from .constants_dir import CONFIG_PATH
 from .data.spectra import FragmentType, Spectra
+from .utils.batch_sizing import get_prediction_bytes
+from .utils.ce_cache import frame_fingerprint
 from .utils.config import Config
+from .utils.prediction_backends import PredictionBackend
+from .utils.prediction_cache import PredictionCache, flatten_output, unflatten_output
+from .utils.prediction_checkpoint import PredictionCheckpoint
+from .utils.worker_context import WorkerContext, get_worker_context
 
 logger = logging.getLogger(__name__)
 
+# cache keys and cached predictions per model of a batch
+CachedPredictions = Tuple[Dict[str, List[str]], Dict[str, Dict[str, Dict[str, np.ndarray]]]]
+
 
 class SpectralLibrary:
     """
@@ -27,9 +39,11 @@ class SpectralLibrary:
     path: str
     library: Spectra
     config: Config
+    context: WorkerContext
     config_path: Optional[str]
     num_threads: int
     grpc_output: dict
+    prediction_cache: Optional[PredictionCache]
 
     def __init__(self, path: str, out_path: str, config_path: Optional[str]):
         """
@@ -40,13 +54,11 @@ class SpectralLibrary:
         :param config_path: path to configuration file
         """
         self.path = path
-        self.library = Spectra()
         self.config_path = config_path
-        self.config = Config()
-        if config_path:
-            self.config.read(config_path)
-        else:
-            self.config.read(CONFIG_PATH)
+        self.context = get_worker_context(config_path)
+        self.config = self.context.config
+        self.library = Spectra(compact_encoding=self.config.compact_encoding)
+        self.prediction_cache = self.context.prediction_cache
         self.results_path = os.path.join(out_path, "results")
         if os.path.isdir(out_path):
             if not os.path.isdir(self.results_path):
@@ -71,71 +83,257 @@ class SpectralLibrary:
                 if file.endswith(".csv"):
                     library_df = csv.read_file(os.path.join(self.path, file))
         library_df.columns = library_df.columns.str.upper()
-        self.library.add_columns(library_df)
+        self.library.add_columns(Spectra.compact_meta_data(library_df))
 
-    def grpc_predict(self, library: Spectra, alignment: bool = False):
+    def grpc_predict(self, library: Spectra, alignment: bool = False, checkpoint_dir: Optional[str] = None):
         """
-        Use grpc to predict library and add predictions to library.
+        Use the prediction backend to predict library and add predictions to library.
 
         :param library: Spectra object with the library
         :param alignment: True if alignment present
-        :return: grpc predictions if we are trying to generate spectral library
+        :param checkpoint_dir: directory in which the predictions of completed batches are checkpointed, a rerun of the
+            same request resumes after the last completed batch. The caller removes the checkpoint with
+            PredictionCheckpoint.remove once the predictions are written.
+        :return: grpc predictions if we are trying to generate spectral library, empty for an empty library
         """
-        path = Path(__file__).parent / "certificates/"
-        logger.info(path)
+        models, tmt_model = self._get_models(alignment)
+        if tmt_model:
+            library.spectra_data["FRAGMENTATION_GRPC"] = np.where(library.spectra_data["FRAGMENTATION"] == "HCD", 2, 1)
 
-        predictor = PROSITpredictor(
-            server=self.config.prosit_server,
-            path_to_ca_certificate=os.path.join(path, "Proteomicsdb-Prosit-v2.crt"),
-            path_to_certificate=os.path.join(path, "oktoberfest-production.crt"),
-            path_to_key_certificate=os.path.join(path, "oktoberfest-production.key"),
-        )
+        library.spectra_data["GRPC_SEQUENCE"] = library.spectra_data["MODIFIED_SEQUENCE"]
+        input_columns = ["GRPC_SEQUENCE", "PRECURSOR_CHARGE", "COLLISION_ENERGY"]
+        if tmt_model:
+            input_columns.append("FRAGMENTATION_GRPC")
+
+        # Predict every unique input once and broadcast the predictions back to the spectra
+        inverse = library.spectra_data.groupby(input_columns, sort=False, observed=True, dropna=False).ngroup()
+        inverse = inverse.to_numpy()
+        _, first_occurrence = np.unique(inverse, return_index=True)
+        unique_inputs = library.spectra_data[input_columns].iloc[first_occurrence]
+        logger.info(f"Predicting {len(unique_inputs)} unique inputs for {len(inverse)} spectra")
+        if len(unique_inputs) == 0:
+            if self.config.job_type == "SpectralLibraryGeneration":
+                return {}
+            library.add_sparse_matrix(scipy.sparse.csr_matrix((0, 174), dtype=np.float32), FragmentType.PRED)
+            if not alignment:
+                library.add_column(np.zeros(0, dtype=np.float32), "PREDICTED_IRT")
+            return
+
+        chunks = self._iter_checkpointed_predictions(unique_inputs, models, tmt_model, checkpoint_dir)
+        # Return only in spectral library generation otherwise add to library
+        if self.config.job_type == "SpectralLibraryGeneration":
+            return _take_predictions(_concat_predictions(list(chunks)), inverse)
+        self._add_predictions(library, chunks, inverse, models, alignment)
+
+    def _get_models(self, alignment: bool) -> Tuple[List[str], bool]:
+        """
+        Get the models to predict from the config.
 
-        models_dict = self.config.models
+        :param alignment: True to predict only the intensity model
+        :return: the models, the first one is the intensity model, and True if a TMT model is used
+        """
         models = []
         tmt_model = False
-        for _, value in models_dict.items():
+        for _, value in self.config.models.items():
             if not value:
                 continue
             tmt_model = True if "TMT" in value else tmt_model
             models.append(value)
             if alignment:
                 break
+        return models, tmt_model
 
-        if tmt_model:
-            library.spectra_data["FRAGMENTATION_GRPC"] = library.spectra_data["FRAGMENTATION"].apply(
-                lambda x: 2 if x == "HCD" else 1
-            )
+    def _iter_checkpointed_predictions(
+        self, unique_inputs: pd.DataFrame, models: List[str], tmt_model: bool, checkpoint_dir: Optional[str]
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Predict spectra in batches, resuming from and saving to the checkpoint in checkpoint_dir.
 
-        library.spectra_data["GRPC_SEQUENCE"] = library.spectra_data["MODIFIED_SEQUENCE"]
-        try:
-            predictions = predictor.predict(
-                sequences=library.spectra_data["GRPC_SEQUENCE"].values.tolist(),
-                charges=library.spectra_data["PRECURSOR_CHARGE"].values.tolist(),
-                collision_energies=library.spectra_data["COLLISION_ENERGY"].values / 100.0,
-                fragmentation=library.spectra_data["FRAGMENTATION_GRPC"].values if tmt_model else None,
-                models=models,
-                disable_progress_bar=True,
-            )
-        except BaseException:
-            logger.exception("An exception was thrown!", exc_info=True)
-            print(library.spectra_data["GRPC_SEQUENCE"])
+        :param unique_inputs: metadata of the spectra, see _predict
+        :param models: models to predict
+        :param tmt_model: True if a TMT model is used, which takes the fragmentation as input
+        :param checkpoint_dir: directory of the checkpoint, None to predict without checkpoint
+        :yield: predictions of each batch in the order of the batches, as returned by PredictionBackend.predict
+        """
+        if checkpoint_dir is None:
+            for predictions, _ in self._iter_predictions(self.context.backend, unique_inputs, 0, models, tmt_model):
+                yield predictions
+            return
 
-        # Return only in spectral library generation otherwise add to library
-        if self.config.job_type == "SpectralLibraryGeneration":
-            return predictions
-        intensities_pred = pd.DataFrame()
-        intensities_pred["intensity"] = predictions[models[0]]["intensity"].tolist()
+        fingerprint = hashlib.sha256(f"{frame_fingerprint(unique_inputs)}|{'|'.join(models)}".encode()).hexdigest()
+        checkpoint = PredictionCheckpoint(checkpoint_dir, fingerprint)
+        for _, _, predictions in checkpoint.load():
+            yield predictions
+        chunks = self._iter_predictions(self.context.backend, unique_inputs, checkpoint.completed, models, tmt_model)
+        for predictions, (start, stop) in chunks:
+            checkpoint.save(start, stop, predictions)
+            yield predictions
+
+    @staticmethod
+    def _add_predictions(
+        library: Spectra, chunks: Iterator[Dict[str, Any]], inverse: np.ndarray, models: List[str], alignment: bool
+    ):
+        """
+        Add the predicted intensities and, unless alignment, the predicted iRT and proteotypicity to the library.
 
-        library.add_matrix(intensities_pred["intensity"], FragmentType.PRED)
+        :param library: Spectra object with the library
+        :param chunks: predictions of the unique inputs in batches
+        :param inverse: position of the unique input of each spectrum of the library
+        :param models: predicted models, the first one is the intensity model
+        :param alignment: True if only the intensity model was predicted
+        """
+        batch_predictions = []
+        intensity_batches = []
+        for predictions in chunks:
+            # keep only the sparse intensity matrix of each batch to free the full prediction output early
+            batch = Spectra()
+            batch.add_matrix(predictions[models[0]]["intensity"], FragmentType.PRED)
+            intensity_batches.append(batch.get_matrix(FragmentType.PRED))
+            batch_predictions.append({model: predictions[model] for model in models[1:]})
+
+        library.add_sparse_matrix(scipy.sparse.vstack(intensity_batches, format="csr")[inverse], FragmentType.PRED)
         if alignment:
             return
+        predictions = _take_predictions(_concat_predictions(batch_predictions), inverse)
         irt_pred = predictions[models[1]]
         library.add_column(irt_pred, "PREDICTED_IRT")
         if len(models) > 2:
             proteotypicity_pred = predictions[models[2]]
             library.add_column(proteotypicity_pred, "PROTEOTYPICITY")
 
+    def _iter_predictions(
+        self, predictor: PredictionBackend, spectra_data: pd.DataFrame, start: int, models: List[str], tmt_model: bool
+    ) -> Iterator[Tuple[Dict[str, Any], Tuple[int, int]]]:
+        """
+        Predict spectra in batches with up to inFlightBatches requests sent to the server at the same time.
+
+        Requests are sent from background threads while the predictions of earlier batches are yielded, so the caller
+        can process a batch while the next ones are predicted. The size of each batch is taken from the batch sizer of
+        the worker context when the batch is sent. The prediction cache is only accessed from the calling thread.
+
+        :param predictor: the prediction backend
+        :param spectra_data: metadata of the spectra, see _predict
+        :param start: position of the first spectrum to predict
+        :param models: models to predict
+        :param tmt_model: True if a TMT model is used, which takes the fragmentation as input
+        :yield: predictions of each batch in the order of the batches, as returned by PredictionBackend.predict, and
+            the start and stop position of the batch
+        """
+        in_flight: Deque[Tuple[Optional[CachedPredictions], np.ndarray, Optional[Future], Tuple[int, int]]] = deque()
+        with ThreadPoolExecutor(max_workers=self.config.in_flight_batches) as executor:
+            while start < len(spectra_data) or in_flight:
+                if start < len(spectra_data) and len(in_flight) < self.config.in_flight_batches:
+                    stop = min(start + self.context.batch_sizer.size, len(spectra_data))
+                    batch = spectra_data.iloc[start:stop]
+                    cached, missing = self._get_cached_predictions(batch, models, tmt_model)
+                    future = None
+                    if missing.any():
+                        future = executor.submit(_timed, self._predict, predictor, batch[missing], models, tmt_model)
+                    in_flight.append((cached, missing, future, (start, stop)))
+                    start = stop
+                    continue
+                cached, missing, future, bounds = in_flight.popleft()
+                yield self._complete_predictions(cached, missing, future, models), bounds
+
+    def _get_cached_predictions(
+        self, spectra_data: pd.DataFrame, models: List[str], tmt_model: bool
+    ) -> Tuple[Optional[CachedPredictions], np.ndarray]:
+        """
+        Look up the predictions of a batch of spectra in the prediction cache.
+
+        :param spectra_data: metadata of the spectra, see _predict
+        :param models: models to predict
+        :param tmt_model: True if a TMT model is used, which takes the fragmentation as input
+        :return: the cache keys and the cached predictions per model (None without cache) and a mask of the spectra
+            that need to be predicted
+        """
+        if self.prediction_cache is None:
+            return None, np.ones(len(spectra_data), dtype=bool)
+
+        fragmentation = spectra_data["FRAGMENTATION_GRPC"] if tmt_model else [None] * len(spectra_data)
+        inputs = list(
+            zip(
+                spectra_data["GRPC_SEQUENCE"],
+                spectra_data["PRECURSOR_CHARGE"],
+                spectra_data["COLLISION_ENERGY"] / 100.0,
+                fragmentation,
+            )
+        )
+        keys = {model: [PredictionCache.get_key(model, *spectrum) for spectrum in inputs] for model in models}
+        cached = {model: self.prediction_cache.get(keys[model]) for model in models}
+        missing = np.array([any(keys[model][i] not in cached[model] for model in models) for i in range(len(inputs))])
+        logger.info(f"Found {np.sum(~missing)} of {len(inputs)} predictions in {self.prediction_cache.path}")
+        return (keys, cached), missing
+
+    def _complete_predictions(
+        self,
+        cached: Optional[CachedPredictions],
+        missing: np.ndarray,
+        future: Optional[Future],
+        models: List[str],
+    ) -> Dict[str, Any]:
+        """
+        Wait for the predictions of a batch, add them to the prediction cache and merge them with the cached ones.
+
+        :param cached: the cache keys and the cached predictions per model, None without cache
+        :param missing: mask of the spectra that were sent to the server
+        :param future: the request sent to the server with its duration, None if all predictions were cached
+        :param models: models to predict
+        :return: predictions for all spectra of the batch, as returned by PredictionBackend.predict
+        """
+        new_predictions = None
+        if future is not None:
+            new_predictions, seconds = future.result()
+            self.context.batch_sizer.record(int(missing.sum()), seconds, get_prediction_bytes(new_predictions))
+        if cached is None:
+            return new_predictions
+        keys, cached_predictions = cached
+
+        if new_predictions is not None:
+            new_records = {}
+            for model in models:
+                leaves = flatten_output(new_predictions[model])
+                for i, row in enumerate(np.flatnonzero(missing)):
+                    record = {path: leaf[i] for path, leaf in leaves.items()}
+                    cached_predictions[model][keys[model][row]] = record
+                    new_records[keys[model][row]] = record
+            self.prediction_cache.put(new_records)
+
+        predictions = {}
+        for model in models:
+            records = [cached_predictions[model][key] for key in keys[model]]
+            leaves = {path: np.stack([record[path] for record in records]) for path in records[0]}
+            predictions[model] = unflatten_output(leaves)
+        return predictions
+
+    @staticmethod
+    def _predict(
+        predictor: PredictionBackend, spectra_data: pd.DataFrame, models: List[str], tmt_model: bool
+    ) -> Dict[str, Any]:
+        """
+        Send spectra to the prediction backend.
+
+        :param predictor: the prediction backend
+        :param spectra_data: metadata of the spectra with GRPC_SEQUENCE, PRECURSOR_CHARGE, COLLISION_ENERGY and, if
+            tmt_model, FRAGMENTATION_GRPC columns
+        :param models: models to predict
+        :param tmt_model: True if a TMT model is used, which takes the fragmentation as input
+        :return: predictions for all spectra, as returned by PredictionBackend.predict
+        """
+        try:
+            return predictor.predict(
+                sequences=spectra_data["GRPC_SEQUENCE"].values.tolist(),
+                charges=spectra_data["PRECURSOR_CHARGE"].values.tolist(),
+                collision_energies=spectra_data["COLLISION_ENERGY"].values / 100.0,
+                fragmentation=spectra_data["FRAGMENTATION_GRPC"].values if tmt_model else None,
+                models=models,
+                disable_progress_bar=True,
+            )
+        except BaseException:
+            logger.exception("An exception was thrown!", exc_info=True)
+            print(spectra_data["GRPC_SEQUENCE"])
+            raise
+
     def read_fasta(self):
         """Read fasta file."""
         cmd = [
@@ -161,3 +359,48 @@ class SpectralLibrary:
             f"{self.config.max_length}",
         ]
         digest.main(cmd)
+
+
+def _timed(function: Callable, *args) -> Tuple[Any, float]:
+    """
+    Call a function and measure its duration.
+
+    :param function: the function
+    :param args: arguments of the function
+    :return: the result of the function and its duration in seconds
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def _concat_predictions(batch_predictions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Concatenate the outputs of several PredictionBackend.predict calls along the first axis.
+
+    :param batch_predictions: list of prediction outputs, each mapping a model to an array or a (nested) dict of arrays
+    :return: prediction output for all batches
+    """
+    if len(batch_predictions) == 1:
+        return batch_predictions[0]
+    predictions: Dict[str, Any] = {}
+    for key, output in batch_predictions[0].items():
+        if isinstance(output, dict):
+            predictions[key] = _concat_predictions([batch[key] for batch in batch_predictions])
+        else:
+            predictions[key] = np.concatenate([batch[key] for batch in batch_predictions])
+    return predictions
+
+
+def _take_predictions(predictions: Dict[str, Any], indices: np.ndarray) -> Dict[str, Any]:
+    """
+    Take the predictions of the given spectra along the first axis.
+
+    :param predictions: prediction output, mapping a model to an array or a (nested) dict of arrays
+    :param indices: positions of the spectra to take, may contain repeated positions
+    :return: prediction output with one entry per index
+    """
+    return {
+        key: _take_predictions(output, indices) if isinstance(output, dict) else np.asarray(output)[indices]
+        for key, output in predictions.items()
+    }
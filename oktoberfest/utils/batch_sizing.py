@@ -0,0 +1,84 @@
+import logging
+from typing import Any, Dict
+
+from .prediction_cache import flatten_output
+
+logger = logging.getLogger(__name__)
+
+# a batch taking longer than this is shrunk, so that a slow or overloaded server does not stall the pipeline
+TARGET_BATCH_SECONDS = 30.0
+# a batch is only grown if its throughput improves by at least this fraction
+MIN_THROUGHPUT_GAIN = 0.05
+
+
+def get_prediction_bytes(predictions: Dict[str, Any]) -> int:
+    """
+    Get the memory used by the output of PredictionBackend.predict.
+
+    :param predictions: predictions mapping a model to an array or a (nested) dict of arrays
+    :return: number of bytes of all arrays
+    """
+    return sum(leaf.nbytes for leaf in flatten_output(predictions).values())
+
+
+class BatchSizer:
+    """
+    Size of the batches sent to the prediction server, tuned on the measured batches.
+
+    Starting from the configured size, the size is doubled as long as the throughput (spectra per second) of a batch
+    improves and then kept at the size with the best throughput. A batch slower than TARGET_BATCH_SECONDS shrinks the
+    size proportionally. The size never exceeds the memory budget for the predictions of a batch, estimated from the
+    bytes per spectrum of the measured predictions.
+    """
+
+    def __init__(self, size: int, max_size: int, max_bytes: int, adaptive: bool = True):
+        """
+        Initialize a BatchSizer object.
+
+        :param size: initial batch size
+        :param max_size: maximum batch size
+        :param max_bytes: memory budget for the predictions of one batch in bytes
+        :param adaptive: False to keep the initial batch size
+        """
+        self.size = size
+        self.min_size = max(1, size // 8)
+        self.max_size = max(size, max_size)
+        self.max_bytes = max_bytes
+        self.adaptive = adaptive
+        self.growing = True
+        self.best_size = size
+        self.best_throughput = 0.0
+
+    def record(self, n_spectra: int, seconds: float, n_bytes: int):
+        """
+        Adjust the batch size to the measurements of a predicted batch.
+
+        Only batches of the current size are compared, smaller batches (e.g. the last one or batches partly found in the
+        prediction cache) only update the memory estimate.
+
+        :param n_spectra: number of spectra sent to the server
+        :param seconds: time until the predictions were received
+        :param n_bytes: memory used by the predictions
+        """
+        if not self.adaptive or n_spectra == 0:
+            return
+        size = self.size
+        if n_spectra == self.size:
+            throughput = n_spectra / max(seconds, 1e-6)
+            if seconds > TARGET_BATCH_SECONDS:
+                size = int(size * TARGET_BATCH_SECONDS / seconds)
+                self.growing = False
+            elif self.growing and throughput > self.best_throughput * (1 + MIN_THROUGHPUT_GAIN):
+                self.best_size, self.best_throughput = size, throughput
+                size *= 2
+            elif self.growing:
+                size = self.best_size
+                self.growing = False
+        memory_limit = int(self.max_bytes * n_spectra / max(n_bytes, 1))
+        size = max(1, min(max(self.min_size, min(size, self.max_size)), memory_limit))
+        if size != self.size:
+            logger.info(
+                f"Changing batch size from {self.size} to {size} after {n_spectra} spectra in {seconds:.2f} s "
+                f"using {n_bytes / 1024**2:.1f} MB"
+            )
+            self.size = size
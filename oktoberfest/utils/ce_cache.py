@@ -0,0 +1,111 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def file_fingerprint(path: str) -> str:
+    """
+    Fingerprint a file by its size and modification time.
+
+    Hashing the content of raw files of several gigabytes would take longer than a cached calibration saves. Editing
+    or replacing a file updates its modification time, so a changed file always gets a new fingerprint, while a copy
+    that does not preserve the modification time is only calibrated again.
+
+    :param path: path to the file
+    :return: hex digest of the fingerprint
+    """
+    stat = os.stat(path)
+    return hashlib.sha256(f"{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+
+
+def frame_fingerprint(df: pd.DataFrame) -> str:
+    """
+    Fingerprint the content of a dataframe, independent of its index.
+
+    :param df: the dataframe
+    :return: hex digest of the fingerprint
+    """
+    digest = hashlib.sha256(",".join(map(str, df.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(df.astype(str), index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+class CeCalibrationCache:
+    """
+    Store of ce calibration results in a json file.
+
+    Every entry holds the mean spectral angle curve and the best collision energy of one calibration, keyed by a hash
+    of everything the calibration depends on.
+    """
+
+    def __init__(self, path: str):
+        """
+        Initialize a CeCalibrationCache object.
+
+        :param path: path to the json file of the cache
+        """
+        self.path = path
+
+    @staticmethod
+    def get_key(params: Dict[str, Any]) -> str:
+        """
+        Get the cache key of a calibration.
+
+        :param params: json serializable parameters the calibration depends on
+        :return: the key
+        """
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def _read(self) -> Dict[str, Any]:
+        """Read all entries of the cache, an unreadable cache is treated as empty."""
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logger.warning(f"Ignoring unreadable ce calibration cache {self.path}")
+            return {}
+
+    def get(self, key: str) -> Optional[Tuple[pd.Series, float]]:
+        """
+        Get a cached calibration.
+
+        :param key: the cache key
+        :return: mean spectral angle per collision energy and best collision energy or None if not cached
+        """
+        entry = self._read().get(key)
+        if entry is None:
+            return None
+        ce_alignment = pd.Series(
+            entry["spectral_angles"],
+            index=pd.Index(entry["collision_energies"], name="COLLISION_ENERGY"),
+            name="SPECTRAL_ANGLE",
+        )
+        return ce_alignment, entry["best_ce"]
+
+    def put(self, key: str, ce_alignment: pd.Series, best_ce: float):
+        """
+        Add a calibration to the cache.
+
+        :param key: the cache key
+        :param ce_alignment: mean spectral angle per collision energy
+        :param best_ce: the best collision energy
+        """
+        entries = self._read()
+        entries[key] = {
+            "collision_energies": ce_alignment.index.tolist(),
+            "spectral_angles": ce_alignment.astype(float).tolist(),
+            "best_ce": np.asarray(best_ce).item(),
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,89 @@
+import logging
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+import spectrum_fundamentals.constants as c
+
+logger = logging.getLogger(__name__)
+
+
+class CeGridScores:
+    """
+    Spectral angles of a set of psms against their predictions over a grid of collision energies.
+
+    The spectral angle follows SimilarityMetrics.spectral_angle: only fragments predicted with an intensity above
+    EPSILON are compared, EPSILON marks zero intensity peaks and values <= 0 (0 or -1) mark invalid fragments. Spectra
+    without a fragment observed and predicted in common get a spectral angle of 0.
+    """
+
+    def __init__(self, raw_intensity: np.ndarray, pred_intensity: np.ndarray, collision_energies: Sequence[float]):
+        """
+        Score all psms at all collision energies in one pass.
+
+        :param raw_intensity: dense raw intensities of shape (n_psm, 174)
+        :param pred_intensity: dense predicted intensities of shape (n_ce, n_psm, 174)
+        :param collision_energies: the n_ce collision energies of the predictions
+        :raises ValueError: if the shapes of the inputs do not match
+        """
+        raw_intensity = np.asarray(raw_intensity)
+        pred_intensity = np.asarray(pred_intensity)
+        self.collision_energies = np.asarray(collision_energies)
+        if pred_intensity.ndim != 3 or pred_intensity.shape[1:] != raw_intensity.shape:
+            raise ValueError(
+                f"Predictions of shape {pred_intensity.shape} do not match raw spectra of shape {raw_intensity.shape}"
+            )
+        if pred_intensity.shape[0] != len(self.collision_energies):
+            raise ValueError(
+                f"Got {pred_intensity.shape[0]} prediction sets for {len(self.collision_energies)} collision energies"
+            )
+        self.spectral_angles = self.spectral_angle(raw_intensity, pred_intensity)
+
+    @staticmethod
+    def spectral_angle(raw_intensity: np.ndarray, pred_intensity: np.ndarray) -> np.ndarray:
+        """
+        Calculate the spectral angle of every psm at every collision energy.
+
+        The raw intensities are broadcast over the collision energies, so the only temporaries of size
+        n_ce x n_psm x 174 are the prediction mask and the masked predictions.
+
+        :param raw_intensity: dense raw intensities of shape (n_psm, 174)
+        :param pred_intensity: dense predicted intensities of shape (n_ce, n_psm, 174)
+        :return: spectral angles of shape (n_ce, n_psm)
+        """
+        raw_intensity = np.maximum(raw_intensity, 0, dtype=np.float64)
+        pred_mask = pred_intensity > c.EPSILON
+        pred_masked = np.where(pred_mask, pred_intensity, 0).astype(np.float64)
+
+        raw_norm = np.sqrt(np.einsum("cpi,pi->cp", pred_mask, raw_intensity**2))
+        pred_norm = np.sqrt(np.einsum("cpi,cpi->cp", pred_masked, pred_masked))
+        fragments_in_common = np.einsum("cpi,pi->cp", pred_mask, raw_intensity > c.EPSILON)
+        dot_product = np.einsum("cpi,pi->cp", pred_masked, raw_intensity)
+
+        raw_norm[raw_norm == 0] = 1
+        pred_norm[pred_norm == 0] = 1
+        dot_product = np.clip(dot_product / (raw_norm * pred_norm), -1, 1) * (fragments_in_common > 0)
+        return 1 - 2 * np.arccos(dot_product) / np.pi
+
+    @property
+    def mean(self) -> pd.Series:
+        """Get the mean spectral angle per collision energy."""
+        return pd.Series(
+            self.spectral_angles.mean(axis=1),
+            index=pd.Index(self.collision_energies, name="COLLISION_ENERGY"),
+            name="SPECTRAL_ANGLE",
+        )
+
+    @property
+    def median(self) -> pd.Series:
+        """Get the median spectral angle per collision energy."""
+        return pd.Series(
+            np.median(self.spectral_angles, axis=1),
+            index=pd.Index(self.collision_energies, name="COLLISION_ENERGY"),
+            name="SPECTRAL_ANGLE",
+        )
+
+    @property
+    def best_ce_per_psm(self) -> np.ndarray:
+        """Get the collision energy with the highest spectral angle for each psm."""
+        return self.collision_energies[np.argmax(self.spectral_angles, axis=0)]
@@ -1,5 +1,6 @@
 import json
 import logging
+from typing import Optional
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +30,62 @@ class Config:
         else:
             return 1
 
+    @property
+    def batch_size(self) -> int:
+        """Get the number of spectra sent to the prediction server per request; if not specified return 7000."""
+        if "batchSize" in self.data:
+            return self.data["batchSize"]
+        else:
+            return 7000
+
+    @property
+    def adaptive_batch_size(self) -> bool:
+        """Get whether the batch size is tuned on the measured batches; if not specified return False."""
+        if "adaptiveBatchSize" in self.data:
+            return self.data["adaptiveBatchSize"]
+        else:
+            return False
+
+    @property
+    def max_batch_size(self) -> int:
+        """Get the maximum batch size of the adaptive batch size; if not specified return the batch size."""
+        if "maxBatchSize" in self.data:
+            return self.data["maxBatchSize"]
+        else:
+            return self.batch_size
+
+    @property
+    def batch_memory(self) -> int:
+        """Get the memory budget for the predictions of one batch in MB; if not specified return 1024."""
+        if "batchMemory" in self.data:
+            return self.data["batchMemory"]
+        else:
+            return 1024
+
+    @property
+    def in_flight_batches(self) -> int:
+        """Get the number of batches sent to the prediction server at the same time; if not specified return 2."""
+        if "inFlightBatches" in self.data:
+            return self.data["inFlightBatches"]
+        else:
+            return 2
+
+    @property
+    def prediction_checkpoint(self) -> bool:
+        """Get whether predicted batches are checkpointed so that reruns resume; if not specified return False."""
+        if "predictionCheckpoint" in self.data:
+            return self.data["predictionCheckpoint"]
+        else:
+            return False
+
+    @property
+    def library_queue_depth(self) -> int:
+        """Get the number of predicted library sections waiting to be written; if not specified return 2."""
+        if "libraryQueueDepth" in self.data:
+            return self.data["libraryQueueDepth"]
+        else:
+            return 2
+
     @property
     def fasta(self) -> str:
         """Get path to fasta file from the config file."""
@@ -44,6 +101,38 @@ class Config:
         """Get prosit server from the config file."""
         return self.data["prosit_server"]
 
+    @property
+    def prediction_backend(self) -> str:
+        """Get the prediction backend (grpc, local or synthetic) from the config file; if not specified return grpc."""
+        if "predictionBackend" in self.data:
+            return self.data["predictionBackend"].lower()
+        else:
+            return "grpc"
+
+    @property
+    def local_server(self) -> str:
+        """Get the address of the local prediction server; if not specified return localhost:50505."""
+        if "localServer" in self.data:
+            return self.data["localServer"]
+        else:
+            return "localhost:50505"
+
+    @property
+    def synthetic_latency(self) -> float:
+        """Get the latency in seconds per request of the synthetic prediction backend; if not specified return 0."""
+        if "syntheticLatency" in self.data:
+            return self.data["syntheticLatency"]
+        else:
+            return 0.0
+
+    @property
+    def synthetic_throughput(self) -> float:
+        """Get the spectra per second of the synthetic prediction backend; if not specified return 0 (unlimited)."""
+        if "syntheticThroughput" in self.data:
+            return self.data["syntheticThroughput"]
+        else:
+            return 0.0
+
     @property
     def models(self) -> dict:
         """Get intensity, IRT, and proteotypicity models from the config file."""
@@ -58,6 +147,20 @@ class Config:
         else:
             return self.data["models"]
 
+    @property
+    def intensity_model(self) -> str:
+        """
+        Get the intensity model, given as "intensity" or "selectedIntensityModel" in the models.
+
+        :raises ValueError: if no intensity model is specified
+        :return: the intensity model
+        """
+        models = self.models
+        for key in ["intensity", "selectedIntensityModel"]:
+            if models.get(key):
+                return models[key]
+        raise ValueError("No intensity model specified in config file")
+
     @property
     def tag(self) -> str:
         """Get tag from the config file; if not specified return "tmt"."""
@@ -117,6 +220,62 @@ class Config:
         else:
             return ""
 
+    @property
+    def intermediate_format(self) -> str:
+        """Get format of intermediate annotation and prediction files (hdf5 or parquet); default is hdf5."""
+        if "intermediateFormat" in self.data:
+            return self.data["intermediateFormat"].lower()
+        else:
+            return "hdf5"
+
+    @property
+    def compact_encoding(self) -> Optional[str]:
+        """Get encoding (float16 or uint16) to store intensities with reduced precision; default is None."""
+        if "compactEncoding" in self.data:
+            return self.data["compactEncoding"].lower()
+        else:
+            return None
+
+    @property
+    def prediction_cache(self) -> Optional[str]:
+        """Get path to the sqlite database used to cache predictions; default is None (no cache)."""
+        if "predictionCache" in self.data:
+            return self.data["predictionCache"]
+        else:
+            return None
+
+    @property
+    def prediction_cache_size(self) -> int:
+        """Get the maximum size of the prediction cache in MB; default is 4096."""
+        if "predictionCacheSize" in self.data:
+            return self.data["predictionCacheSize"]
+        else:
+            return 4096
+
+    @property
+    def ce_search(self) -> str:
+        """Get the collision energy search of the ce calibration (grid or adaptive); default is grid."""
+        if "ceSearch" in self.data:
+            return self.data["ceSearch"].lower()
+        else:
+            return "grid"
+
+    @property
+    def ce_search_step(self) -> int:
+        """
+        Get the initial step between collision energies of the adaptive ce search; default is 8.
+
+        :raises ValueError: if the step is not a positive power of two, halving any other step skips collision energies
+        :return: the step
+        """
+        if "ceSearchStep" in self.data:
+            step = self.data["ceSearchStep"]
+            if not isinstance(step, int) or step < 1 or step & (step - 1):
+                raise ValueError(f"ceSearchStep must be a positive power of two, got {step}")
+            return step
+        else:
+            return 8
+
     @property
     def search_path(self) -> str:
         """Get search path from the config file."""
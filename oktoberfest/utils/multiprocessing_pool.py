@@ -4,7 +4,7 @@ import sys
 import traceback
 import warnings
 from multiprocessing import Pool, pool
-from typing import List
+from typing import Any, Callable, List, Optional, Sequence
 
 logger = logging.getLogger(__name__)
 
@@ -14,11 +14,21 @@ class JobPool:
 
     results: List[pool.AsyncResult]
     warning_filter: str
+    initializer: Optional[Callable]
+    initargs: Sequence[Any]
     pool: pool.Pool
 
-    def __init__(self, processes: int = 1, warning_filter: str = "default"):
-        """Initialize JobPool."""
+    def __init__(
+        self,
+        processes: int = 1,
+        warning_filter: str = "default",
+        initializer: Optional[Callable] = None,
+        initargs: Sequence[Any] = (),
+    ):
+        """Initialize JobPool, initializer(*initargs) is called once in every worker, e.g. init_worker_context."""
         self.warning_filter = warning_filter
+        self.initializer = initializer
+        self.initargs = initargs
         self.pool = Pool(processes, self.init_worker)
         self.results = []
 
@@ -29,12 +39,12 @@ class JobPool:
 
     def init_worker(self):
         """Initialize the worker."""
-        return init_worker(self.warning_filter)
+        return init_worker(self.warning_filter, self.initializer, self.initargs)
 
     def check_pool(self, print_progress_every: int = -1):
         """Check the pool."""
         try:
-            outputs = [pool.AsyncResult]
+            outputs = []
             for res in self.results:
                 outputs.append(res.get(timeout=10000))  # 10000 seconds = ~3 hours
                 if print_progress_every > 0 and len(outputs) % print_progress_every == 0:
@@ -58,8 +68,8 @@ class JobPool:
             sys.exit(1)
 
 
-def init_worker(warning_filter):
-    """Initialize worker given warning filter."""
+def init_worker(warning_filter, initializer: Optional[Callable] = None, initargs: Sequence[Any] = ()):
+    """Initialize worker given warning filter and set up the state of the worker with initializer(*initargs)."""
     # set warning_filter for the child processes
     warnings.simplefilter(warning_filter)
 
@@ -67,6 +77,9 @@ def init_worker(warning_filter):
     # interrupts instead (https://noswap.com/blog/python-multiprocessing-keyboardinterrupt)
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
+    if initializer is not None:
+        initializer(*initargs)
+
 
 def add_one(i: int) -> int:
     """Add 1 to i."""
@@ -0,0 +1,341 @@
+import argparse
+import ipaddress
+import logging
+import os
+import re
+import socket
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from multiprocessing.connection import Client, Connection, Listener
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .config import Config
+from .prediction_cache import decode_arrays, encode_arrays, flatten_output, unflatten_output
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ["grpc", "local", "synthetic"]
+# per unit of normalized collision energy, the synthetic intensity of the shortest ions of a peptide grows by a factor
+# exp(CE_TILT) relative to the longest ions
+CE_TILT = 10.0
+
+# Layout of the 174 fragments: for positions 1 to 29 the ions y+, y++, y+++, b+, b++, b+++
+FRAGMENT_POSITIONS = np.repeat(np.arange(1, 30), 6)
+FRAGMENT_TYPES = np.tile(np.repeat(np.array(["y", "b"]), 3), 29)
+FRAGMENT_CHARGES = np.tile(np.arange(1, 4), 58)
+
+# backends of each process, connections of a parent process cannot be used after a fork
+_backends: Dict[Tuple[Any, ...], "PredictionBackend"] = {}
+
+
+class PredictionBackend(ABC):
+    """
+    Interface of the prediction backends.
+
+    A backend predicts spectra, iRT and proteotypicity with the same inputs and outputs as PROSITpredictor.predict.
+    """
+
+    @abstractmethod
+    def predict(
+        self,
+        sequences: List[str],
+        charges: List[int],
+        collision_energies: np.ndarray,
+        fragmentation: Optional[np.ndarray] = None,
+        models: Sequence[str] = (),
+        disable_progress_bar: bool = True,
+    ) -> Dict[str, Any]:
+        """
+        Predict spectra.
+
+        :param sequences: modified sequences in internal format
+        :param charges: precursor charges
+        :param collision_energies: normalized collision energies, i.e. divided by 100
+        :param fragmentation: fragmentation for TMT models (2 for HCD, 1 for CID), None for other models
+        :param models: models to predict, the first one is the intensity model
+        :param disable_progress_bar: disable the progress bar of the client
+        """
+
+
+class GrpcBackend(PredictionBackend):
+    """
+    Prediction with PROSITpredictor on a Prosit gRPC server.
+
+    The thread safety of PROSITpredictor is not established, so each thread uses its own predictor and requests of
+    several threads in flight do not share a client.
+    """
+
+    def __init__(self, server: str):
+        """
+        Initialize a GrpcBackend object, the predictor of each thread connects on first use.
+
+        :param server: address of the prediction server
+        """
+        self.server = server
+        self._local = threading.local()
+
+    @property
+    def predictor(self):
+        """Get the PROSITpredictor of this thread."""
+        if getattr(self._local, "predictor", None) is None:
+            from prosit_grpc.predictPROSIT import PROSITpredictor
+
+            path = Path(__file__).parent.parent / "certificates/"
+            logger.info(path)
+            self._local.predictor = PROSITpredictor(
+                server=self.server,
+                path_to_ca_certificate=os.path.join(path, "Proteomicsdb-Prosit-v2.crt"),
+                path_to_certificate=os.path.join(path, "oktoberfest-production.crt"),
+                path_to_key_certificate=os.path.join(path, "oktoberfest-production.key"),
+            )
+        return self._local.predictor
+
+    def predict(self, *args, **kwargs) -> Dict[str, Any]:
+        """
+        Predict spectra with PROSITpredictor.predict.
+
+        :param args: positional arguments of PROSITpredictor.predict
+        :param kwargs: keyword arguments of PROSITpredictor.predict
+        :return: the predictions
+        """
+        return self.predictor.predict(*args, **kwargs)
+
+
+class SyntheticBackend(PredictionBackend):
+    """
+    In-process synthetic model with a configurable latency and throughput.
+
+    Predictions are deterministic functions of the inputs with the same shapes and layout as the Prosit outputs. With
+    increasing collision energy, the intensity shifts from the long to the short ions, so that spectra predicted at one
+    collision energy are matched best by the predictions at that collision energy and the ce calibration of such
+    spectra finds it. The model sleeps latency + n_spectra / throughput seconds per request to simulate the server.
+    """
+
+    def __init__(self, latency: float = 0.0, throughput: float = 0.0):
+        """
+        Initialize a SyntheticBackend object.
+
+        :param latency: seconds per request
+        :param throughput: spectra per second, 0 means unlimited
+        """
+        self.latency = latency
+        self.throughput = throughput
+
+    def predict(
+        self,
+        sequences: List[str],
+        charges: List[int],
+        collision_energies: np.ndarray,
+        fragmentation: Optional[np.ndarray] = None,
+        models: Sequence[str] = (),
+        disable_progress_bar: bool = True,
+    ) -> Dict[str, Any]:
+        """
+        Predict synthetic spectra, see PredictionBackend.predict.
+
+        :param sequences: modified sequences in internal format
+        :param charges: precursor charges
+        :param collision_energies: normalized collision energies, i.e. divided by 100
+        :param fragmentation: fragmentation for TMT models (2 for HCD, 1 for CID), None for other models
+        :param models: models to predict, the first one is the intensity model
+        :param disable_progress_bar: unused
+        :return: predictions of each model
+        """
+        start = time.time()
+        n_spectra = len(sequences)
+        seeds = np.array([zlib.crc32(sequence.encode()) for sequence in sequences], dtype=np.uint64)
+        seeds = seeds + np.asarray(charges, dtype=np.uint64)
+        if fragmentation is not None:
+            seeds = seeds * np.uint64(3) + np.asarray(fragmentation, dtype=np.uint64)
+
+        predictions: Dict[str, Any] = {}
+        for i, model in enumerate(models):
+            model_seeds = seeds + np.uint64(zlib.crc32(model.encode()))
+            if i == 0:
+                predictions[model] = self._predict_intensity(sequences, charges, collision_energies, model_seeds)
+            else:
+                predictions[model] = self._uniform(model_seeds, 1)[:, 0].astype(np.float32) * 100
+        if self.throughput > 0:
+            time.sleep(max(0.0, self.latency + n_spectra / self.throughput - (time.time() - start)))
+        elif self.latency > 0:
+            time.sleep(max(0.0, self.latency - (time.time() - start)))
+        return predictions
+
+    @staticmethod
+    def _uniform(seeds: np.ndarray, n: int) -> np.ndarray:
+        """Get n deterministic pseudo random numbers in [0, 1) per seed."""
+        values = (seeds[:, None] * np.uint64(2654435761) + np.arange(n, dtype=np.uint64) * np.uint64(40503)) % (1 << 32)
+        values = (values * np.uint64(2246822519)) % (1 << 32)
+        return values.astype(np.float64) / (1 << 32)
+
+    def _predict_intensity(
+        self, sequences: List[str], charges: List[int], collision_energies: np.ndarray, seeds: np.ndarray
+    ) -> Dict[str, Any]:
+        """Predict synthetic spectra, fragment m/z and annotations."""
+        lengths = np.array([len(re.sub(r"\[UNIMOD:\d+\]|[-_]", "", sequence)) for sequence in sequences])
+        charges = np.asarray(charges)
+        valid = (FRAGMENT_POSITIONS[None, :] < lengths[:, None]) & (FRAGMENT_CHARGES[None, :] <= charges[:, None])
+
+        # 1 for the shortest and -1 for the longest ions of a peptide
+        ion_length = 1 - 2 * (FRAGMENT_POSITIONS[None, :] - 1) / np.maximum(lengths[:, None] - 2, 1)
+        collision_energies = np.asarray(collision_energies, dtype=np.float64)[:, None]
+        intensity = self._uniform(seeds, 174) ** 3 * np.exp(CE_TILT / 2 * (collision_energies - 0.3) * ion_length)
+        intensity[intensity < 0.01] = 0
+        intensity = np.where(valid, intensity, -1)
+        peaks = np.where(valid, intensity, 0).max(axis=1, keepdims=True)
+        intensity = np.where(intensity > 0, intensity / np.where(peaks > 0, peaks, 1), intensity).astype(np.float32)
+
+        ion_mass = FRAGMENT_POSITIONS * 110.0 + np.where(FRAGMENT_TYPES == "y", 19.018, 1.007)
+        fragment_mz = np.where(valid, (ion_mass / FRAGMENT_CHARGES)[None, :], -1).astype(np.float32)
+        annotation = {
+            "type": np.where(valid, FRAGMENT_TYPES[None, :], "N"),
+            "number": np.where(valid, FRAGMENT_POSITIONS[None, :], 0),
+            "charge": np.where(valid, FRAGMENT_CHARGES[None, :], 0),
+        }
+        return {"intensity": intensity, "fragmentmz": fragment_mz, "annotation": annotation}
+
+
+def get_loopback_address(address: str) -> Tuple[str, int]:
+    """
+    Split the address of the local server into host and port.
+
+    :param address: host:port
+    :raises ValueError: if the host is not a loopback address, the local server is only reachable from this machine
+    :return: host and port
+    """
+    host, port = address.rsplit(":", 1)
+    host = host.strip("[]")
+    addresses = {info[4][0] for info in socket.getaddrinfo(host, int(port), proto=socket.IPPROTO_TCP)}
+    if not all(ipaddress.ip_address(ip.split("%")[0]).is_loopback for ip in addresses):
+        raise ValueError(f"{address} is not a loopback address, the local server only runs on localhost")
+    return host, int(port)
+
+
+class LocalServerBackend(PredictionBackend):
+    """
+    Prediction on a local stand-in server, see serve_local.
+
+    Requests and predictions are sent as arrays encoded by encode_arrays, no python objects are pickled. Each thread
+    uses its own connection, so that several requests can be in flight.
+    """
+
+    def __init__(self, address: str):
+        """
+        Initialize a LocalServerBackend object.
+
+        :param address: host:port of the local server, a loopback address
+        """
+        self.address = get_loopback_address(address)
+        self._local = threading.local()
+
+    def predict(
+        self,
+        sequences: List[str],
+        charges: List[int],
+        collision_energies: np.ndarray,
+        fragmentation: Optional[np.ndarray] = None,
+        models: Sequence[str] = (),
+        disable_progress_bar: bool = True,
+    ) -> Dict[str, Any]:
+        """
+        Send a request to the local server, see PredictionBackend.predict.
+
+        :param sequences: modified sequences in internal format
+        :param charges: precursor charges
+        :param collision_energies: normalized collision energies, i.e. divided by 100
+        :param fragmentation: fragmentation for TMT models (2 for HCD, 1 for CID), None for other models
+        :param models: models to predict, the first one is the intensity model
+        :param disable_progress_bar: unused
+        :return: predictions of each model
+        """
+        request = {
+            "sequences": np.asarray(sequences, dtype=str),
+            "charges": np.asarray(charges, dtype=np.int64),
+            "collision_energies": np.asarray(collision_energies, dtype=np.float64),
+            "models": np.asarray(models, dtype=str),
+        }
+        if fragmentation is not None:
+            request["fragmentation"] = np.asarray(fragmentation, dtype=np.int64)
+        if getattr(self._local, "connection", None) is None:
+            self._local.connection = Client(self.address)
+        self._local.connection.send_bytes(encode_arrays(request))
+        leaves = decode_arrays(self._local.connection.recv_bytes())
+        return unflatten_output({path: leaf.copy() for path, leaf in leaves.items()})
+
+
+def _handle_connection(connection: Connection, backend: PredictionBackend):
+    """Answer the requests of a client until it disconnects."""
+    with connection:
+        while True:
+            try:
+                request = decode_arrays(connection.recv_bytes())
+            except EOFError:
+                return
+            predictions = backend.predict(
+                sequences=request["sequences"].tolist(),
+                charges=request["charges"].tolist(),
+                collision_energies=request["collision_energies"],
+                fragmentation=request.get("fragmentation"),
+                models=request["models"].tolist(),
+            )
+            connection.send_bytes(encode_arrays(flatten_output(predictions)))
+
+
+def serve_local(address: str, latency: float = 0.0, throughput: float = 0.0):
+    """
+    Serve a SyntheticBackend to LocalServerBackend clients, every connection is handled in its own thread.
+
+    :param address: host:port to listen on, a loopback address
+    :param latency: seconds per request of the synthetic model
+    :param throughput: spectra per second of the synthetic model, 0 means unlimited
+    """
+    backend = SyntheticBackend(latency, throughput)
+    with Listener(get_loopback_address(address)) as listener:
+        logger.info(f"Serving synthetic predictions on {address}")
+        while True:
+            connection = listener.accept()
+            threading.Thread(target=_handle_connection, args=(connection, backend), daemon=True).start()
+
+
+def get_backend(config: Config) -> PredictionBackend:
+    """
+    Get the prediction backend of this process selected in the config, it is created on first use.
+
+    :param config: the config
+    :raises ValueError: if the prediction backend is not supported
+    :return: the prediction backend
+    """
+    backend_name = config.prediction_backend
+    if backend_name == "grpc":
+        params: Tuple[Any, ...] = (config.prosit_server,)
+    elif backend_name == "local":
+        params = (config.local_server,)
+    elif backend_name == "synthetic":
+        params = (config.synthetic_latency, config.synthetic_throughput)
+    else:
+        raise ValueError(f"{backend_name} is not supported as prediction backend, choose one of {BACKENDS}")
+
+    key = (os.getpid(), backend_name, *params)
+    if key not in _backends:
+        if backend_name == "grpc":
+            _backends[key] = GrpcBackend(*params)
+        elif backend_name == "local":
+            _backends[key] = LocalServerBackend(*params)
+        else:
+            _backends[key] = SyntheticBackend(*params)
+    return _backends[key]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve synthetic predictions for the local prediction backend.")
+    parser.add_argument("--address", default="localhost:50505", help="loopback host:port to listen on")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    parser.add_argument("--throughput", type=float, default=0.0, help="spectra per second, 0 means unlimited")
+    arguments = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    serve_local(arguments.address, arguments.latency, arguments.throughput)
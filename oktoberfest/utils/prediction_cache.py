@@ -0,0 +1,206 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# sqlite limits the number of parameters of a statement
+QUERY_CHUNK_SIZE = 900
+# the total size of the predictions is kept in cache_size by triggers, so that it is not summed up on every put. The
+# row is initialized with the size of the predictions of a database created before the triggers.
+CREATE_TABLES = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS predictions
+    (key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used);
+CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL);
+INSERT OR IGNORE INTO cache_size VALUES (0, (SELECT COALESCE(SUM(size), 0) FROM predictions));
+CREATE TRIGGER IF NOT EXISTS predictions_insert AFTER INSERT ON predictions
+    BEGIN UPDATE cache_size SET size = size + new.size; END;
+CREATE TRIGGER IF NOT EXISTS predictions_update AFTER UPDATE OF size ON predictions
+    BEGIN UPDATE cache_size SET size = size + new.size - old.size; END;
+CREATE TRIGGER IF NOT EXISTS predictions_delete AFTER DELETE ON predictions
+    BEGIN UPDATE cache_size SET size = size - old.size; END;
+COMMIT;
+"""
+
+
+def flatten_output(output: Any) -> Dict[str, np.ndarray]:
+    """
+    Flatten the output of a model to a dict of arrays.
+
+    :param output: array or (nested) dict of arrays with one entry per spectrum along the first axis
+    :return: dict mapping the path of each array, e.g. "annotation/type", to the array. The path of an output that is
+        not a dict is "".
+    """
+    if not isinstance(output, dict):
+        return {"": np.asarray(output)}
+    leaves = {}
+    for key, value in output.items():
+        for path, leaf in flatten_output(value).items():
+            leaves[f"{key}/{path}" if path else key] = leaf
+    return leaves
+
+
+def unflatten_output(leaves: Dict[str, np.ndarray]) -> Any:
+    """
+    Rebuild the output of a model from its flattened arrays, the inverse of flatten_output.
+
+    :param leaves: dict mapping the path of each array to the array
+    :return: array or (nested) dict of arrays
+    """
+    if "" in leaves:
+        return leaves[""]
+    output: Dict[str, Any] = {}
+    for path, leaf in leaves.items():
+        node = output
+        *parents, name = path.split("/")
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[name] = leaf
+    return output
+
+
+def encode_arrays(record: Dict[str, np.ndarray]) -> bytes:
+    """
+    Encode named arrays, e.g. the prediction of one spectrum, as a json header line followed by the raw array data.
+
+    :param record: dict mapping names to arrays, arrays of object dtype are stored as strings
+    :return: the encoded arrays
+    """
+    arrays = {}
+    for path, value in record.items():
+        arrays[path] = np.asarray(value.astype(str) if value.dtype == object else value)
+    header = [[path, array.dtype.str, list(array.shape)] for path, array in arrays.items()]
+    return json.dumps(header).encode() + b"\n" + b"".join(array.tobytes() for array in arrays.values())
+
+
+def decode_arrays(blob: bytes) -> Dict[str, np.ndarray]:
+    """
+    Decode arrays encoded by encode_arrays, no python objects are unpickled.
+
+    :param blob: the encoded arrays
+    :return: dict mapping names to read-only arrays backed by blob
+    """
+    header_end = blob.index(b"\n")
+    offset = header_end + 1
+    record = {}
+    for path, dtype, shape in json.loads(blob[:header_end]):
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        record[path] = np.frombuffer(blob, dtype=dtype, count=count, offset=offset).reshape(shape)
+        offset += count * dtype.itemsize
+    return record
+
+
+class PredictionCache:
+    """
+    Persistent cache of predictions in a sqlite database.
+
+    Every entry holds the prediction of one model for one (sequence, charge, collision energy, fragmentation). When the
+    database grows beyond its size bound, the least recently used entries are evicted. The database can be shared by
+    several processes.
+    """
+
+    def __init__(self, path: str, max_size: int):
+        """
+        Initialize a PredictionCache object.
+
+        :param path: path to the sqlite database, it is created if it does not exist
+        :param max_size: maximum size of the cached predictions in bytes
+        """
+        self.path = path
+        self.max_size = max_size
+        self._connection: Optional[sqlite3.Connection] = None
+        self._pid = -1
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """Get the connection to the database, connections are not shared with forked processes."""
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=600)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(CREATE_TABLES)
+            self._pid = os.getpid()
+        return self._connection
+
+    @property
+    def size(self) -> int:
+        """Get the total size of the cached predictions in bytes."""
+        return self.connection.execute("SELECT size FROM cache_size").fetchone()[0]
+
+    @staticmethod
+    def get_key(model: str, sequence: str, charge: int, collision_energy: float, fragmentation: Any) -> str:
+        """
+        Get the cache key of a prediction.
+
+        :param model: name of the model
+        :param sequence: modified sequence
+        :param charge: precursor charge
+        :param collision_energy: normalized collision energy as sent to the model
+        :param fragmentation: fragmentation as sent to the model, None if the model does not take it
+        :return: the key
+        """
+        return f"{model}|{sequence}|{int(charge)}|{float(collision_energy):.4f}|{fragmentation}"
+
+    def get(self, keys: List[str]) -> Dict[str, Dict[str, np.ndarray]]:
+        """
+        Get cached predictions and mark them as used.
+
+        :param keys: keys of the predictions
+        :return: dict mapping the keys found in the cache to the flattened prediction of one spectrum
+        """
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for start in range(0, len(unique_keys), QUERY_CHUNK_SIZE):
+            chunk = unique_keys[start : start + QUERY_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(f"SELECT key, value FROM predictions WHERE key IN ({placeholders})", chunk)
+            found.update({key: decode_arrays(value) for key, value in rows})
+        if found:
+            now = time.time()
+            self.connection.executemany(
+                "UPDATE predictions SET last_used = ? WHERE key = ?", [(now, key) for key in found]
+            )
+            self.connection.commit()
+        return found
+
+    def put(self, records: Dict[str, Dict[str, np.ndarray]]):
+        """
+        Add predictions to the cache and evict the least recently used ones if the cache is too large.
+
+        :param records: dict mapping keys to the flattened prediction of one spectrum
+        """
+        now = time.time()
+        rows = []
+        for key, record in records.items():
+            value = encode_arrays(record)
+            rows.append((key, value, len(value), now))
+        # an upsert instead of INSERT OR REPLACE, replaced rows do not fire the delete trigger
+        self.connection.executemany(
+            "INSERT INTO predictions VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE "
+            "SET value = excluded.value, size = excluded.size, last_used = excluded.last_used",
+            rows,
+        )
+        self.connection.commit()
+        self._evict()
+
+    def _evict(self):
+        """Delete the least recently used predictions until the cache is within its size bound."""
+        size = self.size
+        if size <= self.max_size:
+            return
+        evicted = []
+        for key, entry_size in self.connection.execute("SELECT key, size FROM predictions ORDER BY last_used"):
+            evicted.append((key,))
+            size -= entry_size
+            if size <= self.max_size:
+                break
+        self.connection.executemany("DELETE FROM predictions WHERE key = ?", evicted)
+        self.connection.commit()
+        logger.info(f"Evicted {len(evicted)} predictions from {self.path}")
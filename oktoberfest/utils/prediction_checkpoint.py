@@ -0,0 +1,216 @@
+import json
+import logging
+import os
+import shutil
+import threading
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from .prediction_cache import flatten_output, unflatten_output
+
+logger = logging.getLogger(__name__)
+
+
+def _read_json(path: str) -> Dict[str, Any]:
+    """Read a manifest, an unreadable manifest is treated as missing."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(path: str, data: Dict[str, Any]):
+    """Replace a manifest atomically, so that a crash leaves either the old or the new manifest."""
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+
+class PredictionCheckpoint:
+    """
+    Predictions of the completed chunks of a request, stored in a directory.
+
+    The directory holds one npz file per chunk and a manifest with the fingerprint of the request and the row range of
+    each chunk. A checkpoint of a different request is discarded, so a rerun only resumes identical requests.
+    """
+
+    def __init__(self, directory: str, fingerprint: str):
+        """
+        Open the checkpoint of a request, discarding the checkpoint of another request in the same directory.
+
+        :param directory: directory of the checkpoint
+        :param fingerprint: fingerprint of the inputs and models of the request
+        """
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.chunks: List[Tuple[int, int]] = []
+        manifest = _read_json(self._get_manifest_path())
+        if manifest.get("fingerprint") == fingerprint:
+            self.chunks = [tuple(chunk) for chunk in manifest["chunks"]]  # type: ignore
+        elif manifest:
+            logger.info(f"Discarding checkpoint of another request in {directory}")
+            PredictionCheckpoint.remove(directory)
+
+    def _get_manifest_path(self) -> str:
+        """Get path to the manifest."""
+        return os.path.join(self.directory, "manifest.json")
+
+    def _get_chunk_path(self, start: int, stop: int) -> str:
+        """Get path to the predictions of the rows start:stop."""
+        return os.path.join(self.directory, f"{start}_{stop}.npz")
+
+    @property
+    def completed(self) -> int:
+        """Get the number of rows from the start of the request that were predicted in consecutive chunks."""
+        position = 0
+        for start, stop in sorted(self.chunks):
+            if start != position:
+                break
+            position = stop
+        return position
+
+    def load(self) -> List[Tuple[int, int, Dict[str, Any]]]:
+        """
+        Load the predictions of the completed chunks.
+
+        :return: start, stop and predictions of the consecutive chunks from the start of the request
+        """
+        chunks = []
+        for start, stop in sorted(self.chunks):
+            if stop > self.completed:
+                break
+            with np.load(self._get_chunk_path(start, stop), allow_pickle=False) as predictions:
+                chunks.append((start, stop, unflatten_output({path: predictions[path] for path in predictions.files})))
+        if chunks:
+            logger.info(f"Resuming from checkpoint {self.directory} after {self.completed} predicted rows")
+        return chunks
+
+    def save(self, start: int, stop: int, predictions: Dict[str, Any]):
+        """
+        Save the predictions of a completed chunk.
+
+        :param start: first row of the chunk
+        :param stop: row after the last row of the chunk
+        :param predictions: predictions of the chunk, mapping a model to an array or a (nested) dict of arrays
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        leaves = {
+            path: leaf.astype(str) if leaf.dtype == object else leaf
+            for path, leaf in flatten_output(predictions).items()
+        }
+        chunk_path = self._get_chunk_path(start, stop)
+        with open(chunk_path + ".tmp", "wb") as f:
+            np.savez_compressed(f, **leaves)
+        os.replace(chunk_path + ".tmp", chunk_path)
+
+        self.chunks.append((start, stop))
+        _write_json(self._get_manifest_path(), {"fingerprint": self.fingerprint, "chunks": self.chunks})
+
+    @staticmethod
+    def remove(directory: str):
+        """
+        Remove a checkpoint once its predictions are no longer needed.
+
+        :param directory: directory of the checkpoint
+        """
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class LibraryCheckpoint:
+    """
+    Progress of a spectral library generated in sections, stored with the prediction checkpoints of the sections.
+
+    The manifest holds the fingerprint of the library, the bounds of every section and the sections written to the
+    library file with the size of the file after each of them. A rerun of the same library keeps the bounds, skips the
+    written sections and resumes the predictions of the other sections from their checkpoints. The prediction
+    checkpoint of a section is removed once the section is written, so only the sections in flight are kept on disk.
+    Sections are added by the prediction thread and marked written by the writing thread.
+    """
+
+    def __init__(self, directory: str, fingerprint: str):
+        """
+        Open the checkpoint of a library, discarding the checkpoint of another library in the same directory.
+
+        :param directory: directory of the checkpoint
+        :param fingerprint: fingerprint of the library and how it is predicted and written
+        """
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.sections: Dict[int, int] = {}
+        self.written: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        manifest = _read_json(self._get_manifest_path())
+        if manifest.get("fingerprint") == fingerprint:
+            self.sections = {start: stop for start, stop in manifest["sections"]}
+            self.written = {start: size for start, size in manifest["written"]}
+        elif os.path.isdir(directory):
+            logger.info(f"Discarding checkpoint of another library in {directory}")
+            PredictionCheckpoint.remove(directory)
+
+    def _get_manifest_path(self) -> str:
+        """Get path to the manifest."""
+        return os.path.join(self.directory, "library.json")
+
+    def _write_manifest(self):
+        """Write the manifest, the caller holds the lock."""
+        os.makedirs(self.directory, exist_ok=True)
+        _write_json(
+            self._get_manifest_path(),
+            {
+                "fingerprint": self.fingerprint,
+                "sections": sorted(self.sections.items()),
+                "written": sorted(self.written.items()),
+            },
+        )
+
+    def get_section_dir(self, start: int) -> str:
+        """
+        Get the directory of the prediction checkpoint of a section.
+
+        :param start: first row of the section
+        :return: the directory
+        """
+        return os.path.join(self.directory, f"section_{start}")
+
+    @property
+    def completed(self) -> Tuple[List[int], int]:
+        """Get the first rows of the consecutive written sections from the start of the library and the file size."""
+        starts: List[int] = []
+        position = 0
+        size = 0
+        while position in self.written and position in self.sections:
+            starts.append(position)
+            size = self.written[position]
+            position = self.sections[position]
+        return starts, size
+
+    def add_section(self, start: int, stop: int):
+        """
+        Record the bounds of a section before it is predicted.
+
+        :param start: first row of the section
+        :param stop: row after the last row of the section
+        """
+        with self._lock:
+            self.sections[start] = stop
+            self._write_manifest()
+
+    def mark_written(self, start: int, size: int):
+        """
+        Record that a section was written and remove the checkpoint of its predictions.
+
+        :param start: first row of the section
+        :param size: size of the library file after the section
+        """
+        with self._lock:
+            self.written[start] = size
+            self._write_manifest()
+        PredictionCheckpoint.remove(self.get_section_dir(start))
+
+    def clear_written(self):
+        """Forget the written sections, e.g. if the library file is missing."""
+        with self._lock:
+            self.written = {}
+            self._write_manifest()
@@ -0,0 +1,83 @@
+import logging
+import os
+from typing import Optional, Tuple
+
+from ..constants_dir import CONFIG_PATH
+from .batch_sizing import BatchSizer
+from .config import Config
+from .prediction_backends import PredictionBackend, get_backend
+from .prediction_cache import PredictionCache
+
+logger = logging.getLogger(__name__)
+
+_context: Optional["WorkerContext"] = None
+
+
+class WorkerContext:
+    """
+    State shared by all tasks of a process: the parsed config, the prediction backend, the prediction cache and the
+    batch size tuned on the batches predicted so far.
+
+    Every JobPool worker sets up its context once with init_worker_context and reuses it for all raw files it handles.
+    """
+
+    def __init__(self, config_path: str):
+        """
+        Read the config and open the prediction cache.
+
+        :param config_path: path to config file
+        """
+        self.config_path = config_path
+        self.config_version = _get_config_version(config_path)
+        self.config = Config()
+        self.config.read(config_path)
+        self.prediction_cache = None
+        if self.config.prediction_cache:
+            self.prediction_cache = PredictionCache(
+                self.config.prediction_cache, self.config.prediction_cache_size * 1024 * 1024
+            )
+        self.batch_sizer = BatchSizer(
+            self.config.batch_size,
+            self.config.max_batch_size,
+            self.config.batch_memory * 1024 * 1024,
+            adaptive=self.config.adaptive_batch_size,
+        )
+
+    @property
+    def backend(self) -> PredictionBackend:
+        """Get the prediction backend, the connection is opened on first use and kept for the life of the process."""
+        return get_backend(self.config)
+
+
+def _get_config_version(config_path: str) -> Tuple[int, int]:
+    """Get the modification time and size of the config file, a changed file is read again."""
+    stat = os.stat(config_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def init_worker_context(config_path: Optional[str]):
+    """
+    Set up the context of this process, used as JobPool initializer.
+
+    :param config_path: path to config file, the default config if None
+    """
+    global _context
+    _context = WorkerContext(config_path or CONFIG_PATH)
+    logger.info(f"Initialized worker context of process {os.getpid()}")
+
+
+def get_worker_context(config_path: Optional[str]) -> WorkerContext:
+    """
+    Get the context of this process, it is set up on first use or if the config file changed.
+
+    :param config_path: path to config file, the default config if None
+    :return: the context
+    """
+    config_path = config_path or CONFIG_PATH
+    if (
+        _context is None
+        or _context.config_path != config_path
+        or _context.config_version != _get_config_version(config_path)
+    ):
+        init_worker_context(config_path)
+    return _context  # type: ignore
@@ -0,0 +1,47 @@
+"""Test cases for the adaptive batch size."""
+from oktoberfest.utils.batch_sizing import TARGET_BATCH_SECONDS, BatchSizer
+
+MB = 1024**2
+
+
+def test_non_adaptive_keeps_size():
+    """Without adaptive batch size the configured size is kept."""
+    sizer = BatchSizer(1000, 8000, 1024 * MB, adaptive=False)
+    sizer.record(1000, 1.0, MB)
+    sizer.record(1000, 2 * TARGET_BATCH_SECONDS, 2048 * MB)
+    assert sizer.size == 1000
+
+
+def test_size_doubles_up_to_max_size():
+    """The size is doubled while the throughput improves, but not beyond max_size."""
+    sizer = BatchSizer(1000, 3000, 1024 * MB)
+    sizer.record(1000, 1.0, MB)
+    assert sizer.size == 2000
+    sizer.record(2000, 1.0, MB)
+    assert sizer.size == 3000
+
+
+def test_size_returns_to_best_throughput():
+    """Once the throughput stops improving the size with the best throughput is kept."""
+    sizer = BatchSizer(1000, 8000, 1024 * MB)
+    sizer.record(1000, 1.0, MB)
+    sizer.record(2000, 2.0, MB)
+    assert sizer.size == 1000
+    sizer.record(1000, 0.5, MB)
+    assert sizer.size == 1000
+
+
+def test_slow_batch_shrinks_to_min_size():
+    """A batch slower than TARGET_BATCH_SECONDS shrinks the size proportionally, but not below an eighth."""
+    sizer = BatchSizer(1000, 8000, 1024 * MB)
+    sizer.record(1000, 2 * TARGET_BATCH_SECONDS, MB)
+    assert sizer.size == 500
+    sizer.record(500, 100 * TARGET_BATCH_SECONDS, MB)
+    assert sizer.size == sizer.min_size == 125
+
+
+def test_memory_limit():
+    """The size is limited by the memory budget, also by batches of another size."""
+    sizer = BatchSizer(1000, 8000, 10 * MB)
+    sizer.record(100, 1.0, 2 * MB)
+    assert sizer.size == 500
@@ -0,0 +1,140 @@
+"""Test cases for the ce calibration."""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from oktoberfest import ce_calibration
+from oktoberfest.ce_calibration import CeCalibration
+from oktoberfest.data.spectra import FragmentType
+from oktoberfest.re_score import ReScore
+from oktoberfest.spectral_library import SpectralLibrary
+from oktoberfest.utils.config import Config
+from oktoberfest.utils.prediction_backends import SyntheticBackend
+
+from .test_prediction_backends import _search_result
+
+
+def _calibrate(tmp_path, monkeypatch, measured_ce: int, **config) -> CeCalibration:
+    """Calibrate synthetic raw spectra predicted at measured_ce with the synthetic backend."""
+    config_path = tmp_path / "config.json"
+    config = {
+        "jobType": "CollisionEnergyCalibration",
+        "predictionBackend": "synthetic",
+        "models": {"selectedIntensityModel": "intensity", "selectedIRTModel": "irt"},
+        **config,
+    }
+    config_path.write_text(json.dumps(config))
+
+    def gen_lib(self, df_search: pd.DataFrame):
+        intensity = SyntheticBackend().predict(
+            sequences=df_search["MODIFIED_SEQUENCE"].tolist(),
+            charges=df_search["PRECURSOR_CHARGE"].tolist(),
+            collision_energies=np.full(len(df_search), measured_ce / 100),
+            models=["intensity"],
+        )["intensity"]["intensity"]
+        self.library.add_columns(df_search)
+        self.library.add_matrix(pd.Series(list(np.maximum(intensity, 0))), FragmentType.RAW)
+
+    monkeypatch.setattr(CeCalibration, "gen_lib", gen_lib)
+    monkeypatch.setattr(CeCalibration, "write_metadata_annotation", lambda self: None)
+    monkeypatch.setattr(ce_calibration, "plot_mean_sa_ce", lambda **kwargs: None)
+    calibration = CeCalibration(
+        search_path="",
+        raw_path=str(tmp_path / "synthetic.raw"),
+        out_path=str(tmp_path / "synthetic.mzML"),
+        config_path=str(config_path),
+    )
+    calibration.perform_alignment(_search_result())
+    return calibration
+
+
+@pytest.mark.parametrize("step", [2, 4, 8, 16])
+@pytest.mark.parametrize("measured_ce", [18, 23, 30, 37, 45, 49])
+def test_adaptive_search_matches_grid(tmp_path, monkeypatch, measured_ce, step):
+    """The adaptive ce search finds the best collision energy of the whole grid with fewer predictions."""
+    grid = _calibrate(tmp_path, monkeypatch, measured_ce, ceSearch="grid")
+    adaptive = _calibrate(tmp_path, monkeypatch, measured_ce, ceSearch="adaptive", ceSearchStep=step)
+
+    assert adaptive.best_ce == grid.best_ce
+    assert len(adaptive.alignment_ces) < len(grid.alignment_ces)
+    pd.testing.assert_series_equal(adaptive.ce_alignment, grid.ce_alignment[adaptive.alignment_ces])
+
+
+@pytest.mark.parametrize("step", [0, 6, 10, -4, 2.0])
+def test_ce_search_step_must_be_power_of_two(step):
+    """Steps that halving does not reduce to 1 through every collision energy are rejected."""
+    config = Config()
+    config.data = {"ceSearchStep": step}
+    with pytest.raises(ValueError):
+        config.ce_search_step
+
+
+def test_calibration_key_depends_on_intensity_model(tmp_path):
+    """The cache key depends on the intensity model, not on the order of the models or the other models."""
+    raw_file = tmp_path / "synthetic.raw"
+    raw_file.write_bytes(b"raw")
+    search_result = _search_result()
+
+    def get_key(models):
+        config = Config()
+        config.data = {"models": models}
+        mzml_file = str(tmp_path / "synthetic.mzML")
+        return ce_calibration.get_calibration_key(config, str(raw_file), mzml_file, search_result)
+
+    key = get_key({"intensity": "Prosit_2020_intensity_hcd", "irt": "Prosit_2019_irt"})
+    assert get_key({"irt": "Prosit_2019_irt", "intensity": "Prosit_2020_intensity_hcd"}) == key
+    assert get_key({"irt": "Prosit_2020_irt_TMT", "intensity": "Prosit_2020_intensity_hcd"}) == key
+    assert get_key({"intensity": "Prosit_2020_intensity_cid", "irt": "Prosit_2019_irt"}) != key
+    assert get_key({"selectedIRTModel": "irt", "selectedIntensityModel": "Prosit_2020_intensity_hcd"}) == key
+
+
+def test_calibration_cache_hit_and_invalidation(tmp_path, monkeypatch):
+    """A calibration is reused for an unchanged raw file and repeated once the raw file changed."""
+    raw_file = tmp_path / "synthetic.raw"
+    raw_file.write_bytes(b"raw")
+    assert _calibrate(tmp_path, monkeypatch, 31).best_ce == 31
+    assert (tmp_path / "synthetic.mzML.ce_calibration.json").is_file()
+
+    # the raw spectra are replaced behind the back of the cache, an unchanged raw file gives the cached calibration
+    assert _calibrate(tmp_path, monkeypatch, 40).best_ce == 31
+    assert _calibrate(tmp_path, monkeypatch, 40, ceSearch="adaptive").best_ce == 40
+
+    raw_file.write_bytes(b"new")
+    modified = raw_file.stat().st_mtime_ns + 10**9
+    os.utime(raw_file, ns=(modified, modified))
+    assert _calibrate(tmp_path, monkeypatch, 40).best_ce == 40
+
+
+def test_pooled_alignment_predictions(tmp_path, monkeypatch):
+    """The pooled alignment predictions give the same calibration, only psms missing from them are predicted."""
+    (tmp_path / "grid").mkdir()
+    grid = _calibrate(tmp_path / "grid", monkeypatch, 31)
+
+    search_result = _search_result()
+    missing = search_result.index % 4 == 0
+    re_score = ReScore(
+        search_path="", raw_path=str(tmp_path), out_path=str(tmp_path), config_path=str(tmp_path / "grid/config.json")
+    )
+    re_score.raw_files = ["synthetic.raw"]
+    os.makedirs(re_score.get_msms_folder_path())
+    search_result[~missing].to_csv(re_score._get_split_msms_path("synthetic.raw"), sep="\t", index=False)
+    re_score.predict_pooled_alignment()
+    pooled_path = tmp_path / "mzML/synthetic.mzML.alignment_pred.npz"
+    assert pooled_path.is_file()
+
+    predicted = []
+
+    def grpc_predict(self, library, alignment=False, checkpoint_dir=None):
+        predicted.append(len(library))
+        return SpectralLibrary.grpc_predict(self, library, alignment, checkpoint_dir)
+
+    monkeypatch.setattr(CeCalibration, "grpc_predict", grpc_predict)
+    pooled = _calibrate(tmp_path / "mzML", monkeypatch, 31)
+
+    assert predicted == [np.sum(missing) * len(grid.alignment_ces)]
+    assert pooled.best_ce == grid.best_ce
+    pd.testing.assert_series_equal(pooled.ce_alignment, grid.ce_alignment)
+    assert not pooled_path.exists()
@@ -0,0 +1,71 @@
+"""Test cases for the scoring of the ce calibration."""
+import numpy as np
+import pytest
+import spectrum_fundamentals.constants as c
+from spectrum_fundamentals.metrics.similarity import SimilarityMetrics
+
+from oktoberfest.utils.ce_scoring import CeGridScores
+
+
+def _spectra(n_psms: int = 20, seed: int = 0) -> np.ndarray:
+    """Create spectra with invalid fragments (-1), zero intensity peaks (EPSILON) and observed peaks."""
+    rng = np.random.default_rng(seed)
+    spectra = rng.random((n_psms, 174))
+    spectra[rng.random(spectra.shape) < 0.3] = c.EPSILON
+    # the invalid fragments depend on the peptide, they are the same in raw and predicted spectra
+    spectra[np.random.default_rng(0).random(spectra.shape) < 0.2] = -1
+    return spectra
+
+
+def test_perfect_match_has_spectral_angle_one():
+    """A prediction equal to the raw spectrum has a spectral angle of 1."""
+    raw = _spectra()
+    scores = CeGridScores(raw, raw[None], [30])
+    np.testing.assert_allclose(scores.spectral_angles, 1)
+
+
+def test_no_fragments_in_common_has_spectral_angle_zero():
+    """A prediction without a fragment observed in the raw spectrum has a spectral angle of 0."""
+    raw = np.full((2, 174), c.EPSILON)
+    raw[:, :10] = 1
+    pred = np.full((1, 2, 174), c.EPSILON)
+    pred[0, 0, 10:20] = 1
+    scores = CeGridScores(raw, pred, [30])
+    np.testing.assert_array_equal(scores.spectral_angles, 0)
+
+
+def test_only_predicted_fragments_are_compared():
+    """Raw peaks of fragments predicted at EPSILON or invalid do not change the spectral angle."""
+    raw = np.full((1, 174), -1.0)
+    raw[0, :10] = 1
+    pred = np.full((1, 1, 174), -1.0)
+    pred[0, 0, :5] = 1
+    pred[0, 0, 5:10] = c.EPSILON
+    np.testing.assert_allclose(CeGridScores(raw, pred, [30]).spectral_angles, 1)
+
+
+def test_spectral_angle_matches_similarity_metrics():
+    """
+    The spectral angles at every collision energy are those of SimilarityMetrics.spectral_angle.
+
+    A perfect match is left out, rounding can put its normalized dot product above 1, which SimilarityMetrics turns into
+    a spectral angle of 0 instead of 1.
+    """
+    raw = _spectra(seed=0)
+    pred = np.stack([_spectra(seed=1), _spectra(seed=2), raw])
+    scores = CeGridScores(raw, pred, [20, 30, 40])
+    for ce_index in range(2):
+        np.testing.assert_allclose(
+            scores.spectral_angles[ce_index], SimilarityMetrics.spectral_angle(raw, pred[ce_index]), atol=1e-6
+        )
+    np.testing.assert_array_equal(scores.best_ce_per_psm, 40)
+    assert scores.mean.idxmax() == 40
+
+
+def test_shape_mismatch_raises():
+    """Predictions that do not match the raw spectra or the collision energies are rejected."""
+    raw = _spectra()
+    with pytest.raises(ValueError):
+        CeGridScores(raw, raw[None, :10], [30])
+    with pytest.raises(ValueError):
+        CeGridScores(raw, raw[None], [30, 31])
@@ -0,0 +1,66 @@
+"""Test cases for the compact storage of spectra matrices."""
+import numpy as np
+import pytest
+import spectrum_fundamentals.constants as c
+from scipy.sparse import csr_matrix
+
+from oktoberfest.data.compact_matrix import UINT16_MAX, CompactMatrix
+from oktoberfest.data.spectra import FragmentType, Spectra
+
+
+def _matrix(low: float, high: float, seed: int = 0) -> csr_matrix:
+    """Create a sparse matrix with absent entries, zero intensity peaks (EPSILON), an empty row and values in range."""
+    rng = np.random.default_rng(seed)
+    dense = rng.uniform(low, high, (50, 174)).astype(np.float32)
+    dense[rng.random(dense.shape) < 0.2] = c.EPSILON
+    dense[rng.random(dense.shape) < 0.3] = 0
+    dense[7] = 0
+    return csr_matrix(dense)
+
+
+@pytest.mark.parametrize(
+    "encoding, low, high, tolerance",
+    [
+        ("float16", 0, 1, lambda values: np.abs(values) * 2**-11),
+        ("uint16", 0, 1, lambda values: 0.5 / UINT16_MAX),
+        ("offset_uint16", 100, 2000, lambda values: 0.5 * 1900 / (UINT16_MAX - 1)),
+    ],
+)
+def test_round_trip(encoding, low, high, tolerance):
+    """Decoded values are within the precision of the encoding, EPSILON and absent entries are preserved."""
+    matrix = _matrix(low, high)
+    compact = CompactMatrix(matrix, encoding)
+    decoded = compact.decode()
+
+    assert decoded.dtype == np.float32
+    assert decoded.shape == matrix.shape
+    np.testing.assert_array_equal(decoded.indptr, matrix.indptr)
+    np.testing.assert_array_equal(decoded.indices, matrix.indices)
+    zero_peaks = matrix.data == c.EPSILON
+    np.testing.assert_array_equal(decoded.data[zero_peaks], c.EPSILON)
+    values = matrix.data[~zero_peaks]
+    assert np.all(np.abs(decoded.data[~zero_peaks] - values) <= tolerance(values) * 1.01)
+    assert compact.nbytes < matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+
+def test_decode_rows():
+    """Decoding a range of rows gives the same values as decoding the whole matrix."""
+    compact = CompactMatrix(_matrix(100, 2000), "offset_uint16")
+    np.testing.assert_array_equal(compact.decode_rows(5, 20).toarray(), compact.decode().toarray()[5:20])
+    assert compact.decode_rows(10, 10).shape == (0, 174)
+
+
+def test_invalid_encoding_raises():
+    """Only the supported encodings are accepted."""
+    with pytest.raises(ValueError):
+        CompactMatrix(_matrix(0, 1), "int8")
+
+
+def test_spectra_keep_mz_as_float32():
+    """Spectra with a compact encoding store the intensities compactly, but mz exactly."""
+    spectra = Spectra(compact_encoding="uint16")
+    spectra.add_sparse_matrix(_matrix(0, 1), FragmentType.RAW)
+    spectra.add_sparse_matrix(_matrix(100, 2000), FragmentType.MZ)
+
+    assert isinstance(spectra.fragment_matrices[FragmentType.RAW], CompactMatrix)
+    np.testing.assert_array_equal(spectra.get_matrix(FragmentType.MZ).toarray(), _matrix(100, 2000).toarray())
@@ -0,0 +1,85 @@
+"""Test cases for the prediction backends."""
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from oktoberfest import ce_calibration
+from oktoberfest.ce_calibration import CeCalibration
+from oktoberfest.data.spectra import FragmentType
+from oktoberfest.utils.prediction_backends import PredictionBackend, SyntheticBackend
+
+MEASURED_CE = 31
+
+
+def _search_result(n_psms: int = 200) -> pd.DataFrame:
+    """Create a search result of tryptic peptides of different lengths."""
+    rng = np.random.default_rng(0)
+    amino_acids = np.array(list("ACDEFGHILMNPQSTVWY"))
+    sequences = ["".join(rng.choice(amino_acids, length)) + "K" for length in rng.integers(6, 20, n_psms)]
+    return pd.DataFrame(
+        {
+            "RAW_FILE": "synthetic",
+            "SCAN_NUMBER": np.arange(n_psms),
+            "MODIFIED_SEQUENCE": sequences,
+            "PRECURSOR_CHARGE": rng.integers(2, 4, n_psms),
+            "FRAGMENTATION": "HCD",
+            "REVERSE": False,
+            "SCORE": rng.random(n_psms),
+        }
+    )
+
+
+def _gen_synthetic_lib(self, df_search: pd.DataFrame):
+    """Replace CeCalibration.gen_lib, the raw spectra are synthetic predictions at MEASURED_CE."""
+    intensity = SyntheticBackend().predict(
+        sequences=df_search["MODIFIED_SEQUENCE"].tolist(),
+        charges=df_search["PRECURSOR_CHARGE"].tolist(),
+        collision_energies=np.full(len(df_search), MEASURED_CE / 100),
+        models=["intensity"],
+    )["intensity"]["intensity"]
+    self.library.add_columns(df_search)
+    self.library.add_matrix(pd.Series(list(np.maximum(intensity, 0))), FragmentType.RAW)
+
+
+def test_prediction_backend_is_abstract():
+    """A backend without predict cannot be created."""
+    with pytest.raises(TypeError):
+        PredictionBackend()
+
+
+def test_synthetic_intensity_depends_on_ce():
+    """The synthetic spectra change with the collision energy and are deterministic."""
+    backend = SyntheticBackend()
+    inputs = {"sequences": ["PEPTIDEKAAGR"], "charges": [2], "models": ["intensity"]}
+    low = backend.predict(collision_energies=np.array([0.2]), **inputs)["intensity"]["intensity"]
+    high = backend.predict(collision_energies=np.array([0.4]), **inputs)["intensity"]["intensity"]
+    again = backend.predict(collision_energies=np.array([0.4]), **inputs)["intensity"]["intensity"]
+    assert not np.allclose(low, high)
+    np.testing.assert_array_equal(high, again)
+
+
+@pytest.mark.parametrize("ce_search", ["grid", "adaptive"])
+def test_synthetic_ce_calibration_finds_measured_ce(tmp_path, monkeypatch, ce_search):
+    """The ce calibration of synthetic spectra finds the collision energy they were predicted at."""
+    config_path = tmp_path / "config.json"
+    config = {
+        "jobType": "CollisionEnergyCalibration",
+        "predictionBackend": "synthetic",
+        "ceSearch": ce_search,
+        "models": {"selectedIntensityModel": "intensity", "selectedIRTModel": "irt"},
+    }
+    config_path.write_text(json.dumps(config))
+    monkeypatch.setattr(CeCalibration, "gen_lib", _gen_synthetic_lib)
+    monkeypatch.setattr(CeCalibration, "write_metadata_annotation", lambda self: None)
+    monkeypatch.setattr(ce_calibration, "plot_mean_sa_ce", lambda **kwargs: None)
+
+    calibration = CeCalibration(
+        search_path="",
+        raw_path=str(tmp_path / "synthetic.raw"),
+        out_path=str(tmp_path / "synthetic.mzML"),
+        config_path=str(config_path),
+    )
+    calibration.perform_alignment(_search_result())
+    assert calibration.best_ce == MEASURED_CE
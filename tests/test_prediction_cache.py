@@ -0,0 +1,38 @@
+"""Test cases for the prediction cache."""
+import numpy as np
+
+from oktoberfest.utils.prediction_cache import PredictionCache, encode_arrays
+
+
+def _record(value: float):
+    """Create the flattened prediction of one spectrum."""
+    return {"intensity": np.full(174, value, dtype=np.float32), "annotation/type": np.array(["y"] * 174, dtype=object)}
+
+
+def test_put_get_round_trip(tmp_path):
+    """Cached predictions are returned unchanged, missing keys are left out."""
+    cache = PredictionCache(str(tmp_path / "cache.sqlite"), 1024**2)
+    key = PredictionCache.get_key("intensity", "PEPTIDEK", 2, 0.3, "HCD")
+    cache.put({key: _record(0.5)})
+
+    found = cache.get([key, "missing"])
+    assert list(found) == [key]
+    np.testing.assert_array_equal(found[key]["intensity"], _record(0.5)["intensity"])
+    np.testing.assert_array_equal(found[key]["annotation/type"], "y")
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    """Beyond its size bound the cache evicts the least recently used predictions and tracks its size."""
+    entry_size = len(encode_arrays(_record(0)))
+    cache = PredictionCache(str(tmp_path / "cache.sqlite"), 3 * entry_size)
+    for value in range(3):
+        cache.put({f"key{value}": _record(value)})
+    cache.get(["key0"])
+    cache.put({"key3": _record(3)})
+
+    assert set(cache.get([f"key{value}" for value in range(4)])) == {"key0", "key2", "key3"}
+    assert cache.size == 3 * entry_size
+
+    cache.put({"key3": {"intensity": np.zeros(1, dtype=np.float32)}})
+    assert cache.size == 2 * entry_size + len(encode_arrays({"intensity": np.zeros(1, dtype=np.float32)}))
+    assert PredictionCache(cache.path, cache.max_size).size == cache.size
@@ -0,0 +1,252 @@
+"""Test cases for the runner."""
+import os
+import threading
+import time
+import warnings
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+from spectrum_fundamentals.fragments import compute_peptide_mass
+from spectrum_fundamentals.mod_string import internal_without_mods, maxquant_to_internal
+
+from oktoberfest import runner
+from oktoberfest.data.spectra import Spectra
+from oktoberfest.utils.config import Config
+from oktoberfest.utils.prediction_backends import SyntheticBackend
+
+
+def _spec_library(n_psms: int, section_size: int, queue_depth: int = 1, fail_at: int = -1) -> SimpleNamespace:
+    """Create a stand-in for a SpectralLibrary whose grpc_predict adds a column to each section, like the real one."""
+    library = Spectra()
+    library.spectra_data = pd.DataFrame({"MODIFIED_SEQUENCE": [f"PEPTIDE{i}K" for i in range(n_psms)]})
+    predicted = []
+
+    def grpc_predict(spectra: Spectra, checkpoint_dir=None):
+        if len(predicted) == fail_at:
+            raise RuntimeError("prediction failed")
+        spectra.spectra_data["GRPC_SEQUENCE"] = spectra.spectra_data["MODIFIED_SEQUENCE"]
+        predicted.append(len(spectra))
+        return {"irt": np.zeros(len(spectra))}
+
+    return SimpleNamespace(
+        library=library,
+        grpc_predict=grpc_predict,
+        predicted=predicted,
+        context=SimpleNamespace(batch_sizer=SimpleNamespace(size=section_size)),
+        config=SimpleNamespace(in_flight_batches=1, library_queue_depth=queue_depth),
+    )
+
+
+def _prediction_thread_finished(timeout: float = 5.0) -> bool:
+    """Wait until no library prediction thread is alive."""
+    deadline = time.time() + timeout
+    while any(thread.name == "library_prediction" for thread in threading.enumerate()):
+        if time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_sections_are_predicted_in_order():
+    """Every section is predicted once and handed to the writer in library order, without SettingWithCopyWarning."""
+    spec_library = _spec_library(n_psms=25, section_size=10)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", pd.errors.SettingWithCopyWarning)
+        sections = list(runner._iter_predicted_sections(spec_library, None, {10}))
+
+    assert [start for start, _, _ in sections] == [0, 20]
+    assert [len(spectra) for _, spectra, _ in sections] == [10, 5]
+    assert list(sections[1][1].spectra_data["GRPC_SEQUENCE"]) == [f"PEPTIDE{i}K" for i in range(20, 25)]
+    assert "GRPC_SEQUENCE" not in spec_library.library.spectra_data
+    assert _prediction_thread_finished()
+
+
+def test_failing_writer_stops_the_prediction_thread():
+    """If the writer fails, the prediction thread blocked on the full queue stops instead of predicting the rest."""
+    spec_library = _spec_library(n_psms=1000, section_size=10)
+    with pytest.raises(OSError):
+        for _ in runner._iter_predicted_sections(spec_library, None, set()):
+            time.sleep(0.2)
+            raise OSError("disk full")
+
+    assert _prediction_thread_finished()
+    assert len(spec_library.predicted) < 10
+
+
+def test_prediction_error_is_raised_in_the_writer():
+    """An exception raised by a prediction is raised again where the sections are written."""
+    spec_library = _spec_library(n_psms=50, section_size=10, fail_at=2)
+    with pytest.raises(RuntimeError, match="prediction failed"):
+        list(runner._iter_predicted_sections(spec_library, None, set()))
+    assert _prediction_thread_finished()
+
+
+def test_pool_ce_curves(tmp_path, monkeypatch):
+    """The curves of all raw files are pooled with equal weights, adaptive curves are interpolated in between."""
+    monkeypatch.setattr(runner, "plot_mean_sa_ce", lambda **kwargs: None)
+    grid = pd.Series([0.2, 0.4, 0.5, 0.3, 0.2], index=[20, 22, 24, 26, 28])
+    adaptive = pd.Series([0.2, 0.6, 0.2], index=[20, 26, 28])
+    results = [("a.raw", 24, grid), ("b.raw", 26, adaptive), ("c.raw", 35.0, None)]
+
+    assert runner._pool_ce_curves(results, str(tmp_path)) == 24
+    ce_curves = pd.read_csv(tmp_path / "ce_curves.tsv", sep="\t", index_col=0)
+    assert list(ce_curves.columns) == ["a.raw", "b.raw", "POOLED"]
+    np.testing.assert_allclose(ce_curves["POOLED"], [0.2, (0.4 + 1 / 3) / 2, (0.5 + 7 / 15) / 2, 0.45, 0.2])
+    assert runner._pool_ce_curves([("c.raw", 35.0, None)], str(tmp_path)) == 35.0
+
+
+def test_run_ce_calibration_calibrates_every_raw_file(tmp_path, monkeypatch):
+    """Every raw file of the search result is calibrated with its own psms and the results are written together."""
+    for raw_file in ["b.raw", "a.raw", "unsearched.raw"]:
+        (tmp_path / raw_file).write_bytes(b"raw")
+    config_path = tmp_path / "config.json"
+    config_path.write_text('{"jobType": "CollisionEnergyCalibration"}')
+    search_result = pd.DataFrame({"RAW_FILE": ["a", "b", "a", "other"], "SCAN_NUMBER": [1, 2, 3, 4]})
+    best_ces = {"a.raw": 30, "b.raw": 34}
+
+    def calibrate_ce_single(raw_file_path, df_search, mzml_path, config_path):
+        raw_file = os.path.basename(raw_file_path)
+        assert set(df_search["RAW_FILE"]) == {raw_file[0]}
+        assert mzml_path == str(tmp_path / "mzML" / (raw_file[0] + ".mzML"))
+        return raw_file, best_ces[raw_file], pd.Series({28: 0.3, best_ces[raw_file]: 0.5, 36: 0.2})
+
+    monkeypatch.setattr(runner, "calibrate_ce_single", calibrate_ce_single)
+    monkeypatch.setattr(runner, "plot_mean_sa_ce", lambda **kwargs: None)
+    monkeypatch.setattr(runner.CeCalibration, "_load_search", lambda self: search_result)
+    runner.run_ce_calibration("", str(tmp_path), str(config_path))
+
+    results_path = tmp_path / "results"
+    ce_table = pd.read_csv(results_path / "ce_calibration.tsv", sep="\t")
+    assert ce_table.to_dict("list") == {"RAW_FILE": ["a.raw", "b.raw"], "COLLISION_ENERGY": [30, 34]}
+    assert (results_path / "ce.txt").read_text() in ["30", "34"]
+
+
+def _write_library(out_dir, output_format: str, num_threads: int) -> bytes:
+    """Predict a library in sections of 7 spectra with the synthetic backend and write it with num_threads processes."""
+    spectra_data = pd.DataFrame(
+        {
+            "MODIFIED_SEQUENCE": [f"PEPT{'ACDEFGHIK'[:length]}IDEK" for length in range(1, 10)] * 2,
+            "PRECURSOR_CHARGE": [2, 3] * 9,
+            "COLLISION_ENERGY": 30,
+        }
+    )
+    spectra_data["MASS"] = 100.0 * spectra_data["MODIFIED_SEQUENCE"].str.len()
+    library = Spectra()
+    library.spectra_data = spectra_data
+
+    def grpc_predict(spectra: Spectra, checkpoint_dir=None):
+        return SyntheticBackend().predict(
+            sequences=spectra.spectra_data["MODIFIED_SEQUENCE"].tolist(),
+            charges=spectra.spectra_data["PRECURSOR_CHARGE"].tolist(),
+            collision_energies=spectra.spectra_data["COLLISION_ENERGY"].to_numpy() / 100.0,
+            models=["intensity", "irt"],
+        )
+
+    spec_library = SimpleNamespace(
+        library=library,
+        grpc_predict=grpc_predict,
+        results_path=str(out_dir),
+        context=SimpleNamespace(batch_sizer=SimpleNamespace(size=7)),
+        config=SimpleNamespace(
+            in_flight_batches=1, library_queue_depth=1, num_threads=num_threads, output_format=output_format
+        ),
+    )
+    out_dir.mkdir()
+    out_lib_path = str(out_dir / f"myPrositLib.{'msp' if output_format == 'msp' else 'csv'}")
+    if num_threads > 1:
+        runner._write_library_shards(spec_library, None, out_lib_path)
+        assert not (out_dir / "library_shards").exists()
+    else:
+        runner._write_library_file(spec_library, None, out_lib_path)
+    with open(out_lib_path, "rb") as out_lib:
+        return out_lib.read()
+
+
+@pytest.mark.parametrize("output_format", ["msp", "spectronaut"])
+def test_library_shards_give_the_library_file(tmp_path, output_format):
+    """The concatenated shards of a library written by several processes are the library written by one process."""
+    library_file = _write_library(tmp_path / "file", output_format, num_threads=1)
+    library_shards = _write_library(tmp_path / "shards", output_format, num_threads=2)
+    assert library_shards == library_file
+    if output_format == "spectronaut":
+        assert library_file.count(library_file.split(b"\n")[0]) == 1
+
+
+def test_concatenate_library_shards(tmp_path):
+    """Missing shards are skipped and only the header of the first shard is kept."""
+    (tmp_path / "shard_0.csv").write_bytes(b"header\na\nb\n")
+    (tmp_path / "shard_20.csv").write_bytes(b"header\nc\n")
+    shard_paths = [str(tmp_path / f"shard_{start}.csv") for start in [0, 10, 20]]
+
+    runner._concatenate_library_shards(shard_paths, str(tmp_path / "lib.csv"), has_header=True)
+    assert (tmp_path / "lib.csv").read_bytes() == b"header\na\nb\nc\n"
+    runner._concatenate_library_shards(shard_paths, str(tmp_path / "lib.msp"), has_header=False)
+    assert (tmp_path / "lib.msp").read_bytes() == b"header\na\nb\nheader\nc\n"
+
+
+def test_library_shard_without_spectra(tmp_path):
+    """A section without spectra gives an empty shard, so the shard is found as written on resume."""
+    shard_path = str(tmp_path / "shard_0.msp")
+    spectra_data = pd.DataFrame(
+        {"MODIFIED_SEQUENCE": [], "PRECURSOR_CHARGE": [], "COLLISION_ENERGY": [], "MASS": []}, dtype=float
+    )
+    predictions = SyntheticBackend().predict(
+        sequences=[], charges=[], collision_energies=np.zeros(0), models=["intensity", "irt"]
+    )
+    runner.write_library_shard(spectra_data, predictions, "msp", shard_path, None)
+    assert os.path.getsize(shard_path) == 0
+    assert not os.path.exists(shard_path + ".tmp")
+
+
+def _preprocess_library_per_row(spectra_data: pd.DataFrame, fixed_mods) -> pd.DataFrame:
+    """Convert, filter and weigh every spectrum of a library on its own."""
+    spectra_data = spectra_data.copy()
+    spectra_data["MODIFIED_SEQUENCE"] = maxquant_to_internal("_" + spectra_data["MODIFIED_SEQUENCE"] + "_", {})
+    spectra_data["SEQUENCE"] = internal_without_mods(spectra_data["MODIFIED_SEQUENCE"])
+    spectra_data["PEPTIDE_LENGTH"] = spectra_data["SEQUENCE"].str.len()
+    spectra_data = spectra_data[
+        spectra_data["PEPTIDE_LENGTH"].between(7, 30)
+        & ~spectra_data["MODIFIED_SEQUENCE"].str.contains(r"\(ac\)")
+        & ~spectra_data["MODIFIED_SEQUENCE"].str.contains(r"\(Acetyl \(Protein N-term\)\)")
+        & ~spectra_data["SEQUENCE"].str.contains("U")
+        & (spectra_data["PRECURSOR_CHARGE"] <= 6)
+    ].copy()
+    if fixed_mods is None:
+        spectra_data["MODIFIED_SEQUENCE"] = maxquant_to_internal(spectra_data["MODIFIED_SEQUENCE"])
+    else:
+        spectra_data["MODIFIED_SEQUENCE"] = maxquant_to_internal(spectra_data["MODIFIED_SEQUENCE"], fixed_mods)
+    spectra_data["MASS"] = spectra_data["MODIFIED_SEQUENCE"].apply(compute_peptide_mass)
+    return spectra_data
+
+
+@pytest.mark.parametrize("tmt_tag", [None, "tmt"])
+def test_preprocess_library_matches_per_row(tmt_tag):
+    """Converting and filtering each distinct sequence once gives the library of the conversion of every spectrum."""
+    sequences = [
+        "PEPTIDECK",
+        "M(ox)PEPTIDEK",
+        "(ac)PEPTIDEK",
+        "PEPTIDEUK",
+        "PEPK",
+        "A" * 31,
+        "LESLIECKR",
+        "CCMKLLGGR",
+    ]
+    spectra_data = pd.DataFrame(
+        {
+            "MODIFIED_SEQUENCE": sequences * 3,
+            "PRECURSOR_CHARGE": np.repeat([2, 3, 7], len(sequences)),
+            "COLLISION_ENERGY": 30,
+        }
+    )
+    config = Config()
+    config.data = {"models": {"selectedIntensityModel": "Prosit_2020_intensity_TMT"}, "tag": tmt_tag or ""}
+    fixed_mods = runner._get_library_fixed_mods(config)
+    assert (fixed_mods is None) == (tmt_tag is None)
+
+    preprocessed = runner._preprocess_library(spectra_data, fixed_mods)
+    expected = _preprocess_library_per_row(spectra_data, fixed_mods)
+    assert len(preprocessed) == 2 * 4
+    pd.testing.assert_frame_equal(preprocessed, expected)
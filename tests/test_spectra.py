@@ -0,0 +1,259 @@
+"""Test cases for the Spectra storage engine."""
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from spectrum_fundamentals.metrics.percolator import Percolator
+
+from oktoberfest.data.compact_matrix import CompactMatrix
+from oktoberfest.data.spectra import FragmentType, Spectra
+from oktoberfest.utils.prediction_backends import SyntheticBackend
+
+
+def _intensities(n_psms: int = 10, seed: int = 0) -> np.ndarray:
+    """Create intensities with invalid fragments (-1), zero intensity peaks (0) and observed peaks."""
+    rng = np.random.default_rng(seed)
+    intensities = rng.random((n_psms, 174)).astype(np.float32)
+    intensities[rng.random(intensities.shape) < 0.2] = 0
+    intensities[rng.random(intensities.shape) < 0.3] = -1
+    return intensities
+
+
+def _spectra(n_psms: int = 10) -> Spectra:
+    """Create spectra with meta data and raw, mz and predicted intensities."""
+    spectra = Spectra()
+    spectra.add_columns(
+        pd.DataFrame({"SCAN_NUMBER": np.arange(n_psms), "SEQUENCE": [f"PEPTIDE{i}K" for i in range(n_psms)]})
+    )
+    for seed, fragment_type in enumerate(FragmentType):
+        spectra.add_matrix(_intensities(n_psms, seed), fragment_type)
+    return spectra
+
+
+def _stored(intensities: np.ndarray) -> np.ndarray:
+    """Get intensities as stored by add_matrix: invalid fragments are 0 and zero intensity peaks EPSILON."""
+    stored = np.where(intensities == 0, Spectra.EPSILON, intensities)
+    return np.where(intensities == -1, 0, stored).astype(np.float32)
+
+
+def _write_hdf5(spectra: Spectra, output_file: str):
+    """Write spectra with predictions as hdf5 and wait for the writer threads of spectrum_io."""
+    spectra.write_pred_as_hdf5(output_file)
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and not thread.daemon:
+            thread.join()
+
+
+def test_matrices_are_stored_per_fragment_type():
+    """Each fragment type is stored as one csr matrix with a column per fragment ion."""
+    spectra = _spectra()
+    for seed, fragment_type in enumerate(FragmentType):
+        matrix, columns = spectra.get_matrix(fragment_type, True)
+        assert matrix.shape == (10, 174)
+        assert columns == Spectra._gen_column_names(fragment_type)
+        np.testing.assert_array_equal(matrix.toarray(), _stored(_intensities(10, seed)))
+    assert list(spectra.get_meta_data().columns) == ["SCAN_NUMBER", "SEQUENCE"]
+    assert list(spectra.get_columns(FragmentType.RAW).columns) == Spectra._gen_column_names(FragmentType.RAW)
+
+
+def test_missing_fragment_type_gives_empty_matrix():
+    """A fragment type that was never added gives a matrix without columns, like the former column store."""
+    spectra = Spectra()
+    spectra.add_columns(pd.DataFrame({"SCAN_NUMBER": np.arange(3)}))
+    spectra.add_matrix(_intensities(3), FragmentType.RAW)
+
+    assert spectra.get_matrix(FragmentType.PRED).shape == (3, 0)
+    assert spectra.get_matrix(FragmentType.PRED, True)[1] == []
+    assert spectra.get_columns(FragmentType.PRED).shape == (3, 0)
+    assert spectra.select([0, 2]).get_matrix(FragmentType.PRED).shape == (2, 0)
+    assert not spectra.has_matrix(FragmentType.PRED)
+
+
+def test_add_matrix_from_series_and_array():
+    """Per-psm arrays and a 2D array give the same matrix, an empty series gives an empty matrix."""
+    intensities = _intensities()
+    from_array = Spectra()
+    from_array.add_matrix(intensities, FragmentType.PRED)
+    from_series = Spectra()
+    from_series.add_matrix(pd.Series(list(intensities)), FragmentType.PRED)
+
+    np.testing.assert_array_equal(from_series.get_matrix(FragmentType.PRED).toarray(), _stored(intensities))
+    np.testing.assert_array_equal(from_array.get_matrix(FragmentType.PRED).toarray(), _stored(intensities))
+    np.testing.assert_array_equal(intensities, _intensities())
+    empty = Spectra()
+    empty.add_matrix(pd.Series([], dtype=object), FragmentType.RAW)
+    assert empty.get_matrix(FragmentType.RAW).shape == (0, 174)
+
+
+def test_add_columns_is_staged():
+    """Column blocks are concatenated once on the next access to spectra_data, in the order they were added."""
+    spectra = Spectra()
+    for name in ["A", "B", "C"]:
+        spectra.add_columns(pd.DataFrame({name: np.arange(3)}))
+    assert len(spectra._staged_columns) == 3
+    assert list(spectra.spectra_data.columns) == ["A", "B", "C"]
+    assert spectra._staged_columns == []
+
+    spectra.add_column(pd.Series([1, 2, 3]), "D")
+    spectra.add_columns(pd.DataFrame({"E": np.arange(3)}))
+    assert list(spectra.get_meta_data().columns) == ["A", "B", "C", "D", "E"]
+    assert len(spectra) == 3
+
+
+def test_lazy_hdf5_reads_row_ranges(tmp_path):
+    """Matrices of a lazily read hdf5 file are only read for the requested rows until they are requested as a whole."""
+    output_file = str(tmp_path / "spectra.hdf5")
+    _write_hdf5(_spectra(300), output_file)
+    spectra = Spectra()
+    spectra.read_from_hdf5(output_file)
+    expected = _spectra(300).get_matrix(FragmentType.RAW).toarray()
+
+    assert spectra.has_matrix(FragmentType.PRED) and spectra.fragment_matrices == {}
+    np.testing.assert_array_equal(spectra.get_matrix_rows(FragmentType.RAW, 100, 250).toarray(), expected[100:250])
+    assert spectra.get_matrix_rows(FragmentType.RAW, 290, 400).shape == (10, 174)
+    assert spectra.fragment_matrices == {}
+    np.testing.assert_array_equal(spectra.get_matrix(FragmentType.RAW).toarray(), expected)
+    assert list(spectra.fragment_matrices) == [FragmentType.RAW]
+
+
+def test_selection_of_lazy_hdf5_reads_only_selected_rows(tmp_path, monkeypatch):
+    """A selection of a lazily read hdf5 file reads the slices around the selected rows, not the whole matrix."""
+    output_file = str(tmp_path / "spectra.hdf5")
+    _write_hdf5(_spectra(300), output_file)
+    spectra = Spectra()
+    spectra.read_from_hdf5(output_file)
+    expected = _spectra(300).get_matrix(FragmentType.MZ).toarray()
+
+    def read_whole_matrix(*args):
+        raise AssertionError("the whole matrix was read")
+
+    monkeypatch.setattr(Spectra, "_read_sparse_hdf5", staticmethod(read_whole_matrix))
+    rows = np.array([250, 3, 4, 5, 120, 3, 299])
+    selection = spectra.select(rows)
+    np.testing.assert_array_equal(selection.get_matrix(FragmentType.MZ).toarray(), expected[rows])
+    assert selection.get_matrix_rows(FragmentType.MZ, 1, 3).shape == (2, 174)
+    assert spectra.select([]).get_matrix(FragmentType.MZ).shape == (0, 174)
+    assert spectra.fragment_matrices == {}
+
+
+def test_iter_batches_keeps_compact_encoding():
+    """Batches hold consecutive rows of every matrix, stored with the compact encoding of the spectra."""
+    spectra = Spectra(compact_encoding="float16")
+    spectra.add_columns(pd.DataFrame({"SCAN_NUMBER": np.arange(10)}))
+    spectra.add_matrix(_intensities(10), FragmentType.PRED)
+    batches = list(spectra.iter_batches(4))
+
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+    assert all(isinstance(batch.fragment_matrices[FragmentType.PRED], CompactMatrix) for batch in batches)
+    assert [batch.spectra_data["SCAN_NUMBER"].iloc[0] for batch in batches] == [0, 4, 8]
+    np.testing.assert_array_equal(
+        batches[1].get_matrix(FragmentType.PRED).toarray(), spectra.get_matrix(FragmentType.PRED)[4:8].toarray()
+    )
+
+
+def test_parquet_round_trip(tmp_path):
+    """Meta data and matrices written as parquet in several row groups are read back unchanged."""
+    pytest.importorskip("pyarrow")
+    output_file = str(tmp_path / "spectra.parquet")
+    spectra = _spectra(25)
+    spectra.write_as_parquet(output_file, batch_size=10)
+
+    read = Spectra()
+    read.read_from_parquet(output_file)
+    pd.testing.assert_frame_equal(read.get_meta_data(), spectra.get_meta_data())
+    for fragment_type in FragmentType:
+        np.testing.assert_array_equal(
+            read.get_matrix(fragment_type).toarray(), spectra.get_matrix(fragment_type).toarray()
+        )
+
+    subset = Spectra()
+    subset.read_from_parquet(output_file, columns=["SEQUENCE"], fragment_types=[FragmentType.RAW])
+    assert list(subset.get_meta_data().columns) == ["SEQUENCE"]
+    assert subset.has_matrix(FragmentType.RAW) and not subset.has_matrix(FragmentType.PRED)
+
+
+def test_select_is_a_view():
+    """A selection shares the matrices of its spectra, its own matrices and meta data do not change the spectra."""
+    spectra = _spectra()
+    selection = spectra.select(np.arange(10) % 3 == 0)
+    expected = spectra.get_matrix(FragmentType.RAW)[[0, 3, 6, 9]].toarray()
+
+    assert len(selection) == 4
+    assert selection.fragment_matrices == {}
+    np.testing.assert_array_equal(selection.get_matrix(FragmentType.RAW).toarray(), expected)
+    np.testing.assert_array_equal(selection.get_matrix_rows(FragmentType.RAW, 1, 3).toarray(), expected[1:3])
+    assert list(selection.spectra_data.index) == [0, 1, 2, 3]
+
+    nested = selection.select([3, 1])
+    np.testing.assert_array_equal(nested.get_matrix(FragmentType.RAW).toarray(), expected[[3, 1]])
+    assert list(nested.spectra_data["SCAN_NUMBER"]) == [9, 3]
+
+    selection.add_matrix(np.zeros((4, 174), dtype=np.float32), FragmentType.PRED)
+    selection.add_column(pd.Series([1, 2, 3, 4]), "FLAG")
+    assert spectra.get_matrix(FragmentType.PRED).nnz > 0
+    assert "FLAG" not in spectra.spectra_data
+    with pytest.raises(ValueError):
+        spectra.select(np.ones(3, dtype=bool))
+
+
+def _percolator_input(n_psms: int = 200) -> Spectra:
+    """Create the meta data and matrices of a rescoring, with peptides identified in several scans and raw files."""
+    rng = np.random.default_rng(0)
+    peptides = ["".join(rng.choice(list("ACDEFGHILMNPQSTVWY"), length)) + "K" for length in rng.integers(6, 20, 40)]
+    sequences = rng.choice(peptides, n_psms).tolist()
+    charges = rng.integers(2, 4, n_psms)
+    reverse = rng.random(n_psms) < 0.3
+    predictions = SyntheticBackend().predict(sequences, charges.tolist(), np.full(n_psms, 0.3), models=["intensity"])
+    raw = predictions["intensity"]["intensity"] * np.where(reverse, 0.2, 1)[:, None] + rng.random((n_psms, 174)) * 0.1
+    spectra = Spectra()
+    spectra.add_columns(
+        pd.DataFrame(
+            {
+                "RAW_FILE": rng.choice(["run1", "run2"], n_psms),
+                "SCAN_NUMBER": np.arange(n_psms) * 7,
+                "MODIFIED_SEQUENCE": sequences,
+                "SEQUENCE": sequences,
+                "PRECURSOR_CHARGE": charges,
+                "COLLISION_ENERGY": 30.0,
+                "MASS_ANALYZER": "FTMS",
+                "FRAGMENTATION": "HCD",
+                "CALCULATED_MASS": np.array([len(sequence) for sequence in sequences]) * 110.0 + 18.011,
+                "RETENTION_TIME": rng.uniform(10, 60, n_psms),
+                "PREDICTED_IRT": rng.uniform(0, 100, n_psms),
+                "REVERSE": reverse,
+                "SCORE": np.where(reverse, rng.uniform(0, 80, n_psms), rng.uniform(40, 200, n_psms)),
+            }
+        )
+    )
+    spectra.add_matrix(np.where(predictions["intensity"]["intensity"] < 0, -1, raw), FragmentType.RAW)
+    spectra.add_matrix(predictions["intensity"]["intensity"], FragmentType.PRED)
+    spectra.add_matrix(predictions["intensity"]["fragmentmz"], FragmentType.MZ)
+    return spectra
+
+
+@pytest.mark.parametrize("input_type", ["rescore", "original"])
+def test_compact_meta_data_keeps_percolator_input(tmp_path, input_type):
+    """The percolator input calculated from compact meta data is the same as from the original meta data."""
+    spectra = _percolator_input()
+    compact_meta_data = Spectra.compact_meta_data(spectra.get_meta_data())
+    assert isinstance(compact_meta_data["RAW_FILE"].dtype, pd.CategoricalDtype)
+    assert compact_meta_data["MODIFIED_SEQUENCE"].dtype == object
+    assert compact_meta_data["PRECURSOR_CHARGE"].dtype == spectra.get_meta_data()["PRECURSOR_CHARGE"].dtype
+
+    tabs = []
+    for meta_data in [spectra.get_meta_data(), compact_meta_data]:
+        percolator = Percolator(
+            metadata=meta_data.copy(),
+            pred_intensities=spectra.get_matrix(FragmentType.PRED),
+            true_intensities=spectra.get_matrix(FragmentType.RAW),
+            mz=spectra.get_matrix(FragmentType.MZ),
+            input_type=input_type,
+            all_features_flag=True,
+        )
+        percolator.calc()
+        tab = tmp_path / f"{len(tabs)}.tab"
+        percolator.write_to_file(str(tab))
+        tabs.append(tab.read_text())
+    assert tabs[0] == tabs[1]
@@ -0,0 +1,92 @@
+"""Test cases for the predictions of the spectral library."""
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from oktoberfest.data.spectra import FragmentType, Spectra
+from oktoberfest.spectral_library import SpectralLibrary
+from oktoberfest.utils.prediction_backends import SyntheticBackend
+
+MODELS = {"selectedIntensityModel": "intensity", "selectedIRTModel": "irt"}
+
+
+def _library_data() -> pd.DataFrame:
+    """Create prediction input in which most spectra share their input with another spectrum."""
+    rng = np.random.default_rng(0)
+    peptides = pd.DataFrame(
+        {
+            "MODIFIED_SEQUENCE": ["PEPTIDEK", "AAGGLLR", "LESLIEK", "VVMMCCK"],
+            "PRECURSOR_CHARGE": [2, 2, 3, 2],
+        }
+    )
+    spectra_data = peptides.iloc[rng.integers(0, len(peptides), 40)].reset_index(drop=True)
+    spectra_data["COLLISION_ENERGY"] = rng.choice([25, 30], len(spectra_data))
+    spectra_data["FRAGMENTATION"] = "HCD"
+    return spectra_data
+
+
+def _predict(tmp_path, monkeypatch, job_type: str, spectra_data: pd.DataFrame):
+    """Predict the spectra with the synthetic backend and return the predicted spectra and the predictions."""
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps({"jobType": job_type, "predictionBackend": "synthetic", "models": MODELS}))
+    predicted = []
+    predict = SyntheticBackend.predict
+
+    def count_predict(self, sequences, **kwargs):
+        predicted.append(len(sequences))
+        return predict(self, sequences, **kwargs)
+
+    monkeypatch.setattr(SyntheticBackend, "predict", count_predict)
+    spectral_library = SpectralLibrary(path=str(tmp_path), out_path=str(tmp_path), config_path=str(config_path))
+    library = Spectra()
+    library.add_columns(spectra_data)
+    return library, spectral_library.grpc_predict(library), sum(predicted)
+
+
+def _expected_predictions(spectra_data: pd.DataFrame):
+    """Predict every spectrum on its own."""
+    return SyntheticBackend().predict(
+        sequences=spectra_data["MODIFIED_SEQUENCE"].tolist(),
+        charges=spectra_data["PRECURSOR_CHARGE"].tolist(),
+        collision_energies=spectra_data["COLLISION_ENERGY"].to_numpy() / 100.0,
+        models=list(MODELS.values()),
+    )
+
+
+def test_unique_inputs_are_predicted_once(tmp_path, monkeypatch):
+    """Spectra with the same input share one prediction, which equals the prediction of each spectrum on its own."""
+    spectra_data = _library_data()
+    library, _, n_predicted = _predict(tmp_path, monkeypatch, "Rescoring", spectra_data)
+    expected = _expected_predictions(spectra_data)
+
+    n_unique = len(spectra_data.drop_duplicates(["MODIFIED_SEQUENCE", "PRECURSOR_CHARGE", "COLLISION_ENERGY"]))
+    assert n_predicted == n_unique < len(spectra_data)
+    expected_intensity = Spectra()
+    expected_intensity.add_matrix(expected["intensity"]["intensity"], FragmentType.PRED)
+    np.testing.assert_array_equal(
+        library.get_matrix(FragmentType.PRED).toarray(), expected_intensity.get_matrix(FragmentType.PRED).toarray()
+    )
+    np.testing.assert_array_equal(library.spectra_data["PREDICTED_IRT"], expected["irt"])
+
+
+def test_unique_predictions_are_returned_per_spectrum(tmp_path, monkeypatch):
+    """The predictions returned for the spectral library generation have one entry per spectrum."""
+    spectra_data = _library_data()
+    _, predictions, n_predicted = _predict(tmp_path, monkeypatch, "SpectralLibraryGeneration", spectra_data)
+    expected = _expected_predictions(spectra_data)
+
+    assert n_predicted < len(spectra_data)
+    for key in ["intensity", "fragmentmz"]:
+        np.testing.assert_array_equal(predictions["intensity"][key], expected["intensity"][key])
+    for key, annotation in expected["intensity"]["annotation"].items():
+        np.testing.assert_array_equal(predictions["intensity"]["annotation"][key], annotation)
+    np.testing.assert_array_equal(predictions["irt"], expected["irt"])
+
+
+@pytest.mark.parametrize("job_type", ["Rescoring", "SpectralLibraryGeneration"])
+def test_empty_library(tmp_path, monkeypatch, job_type):
+    """An empty library is not sent to the backend."""
+    _, _, n_predicted = _predict(tmp_path, monkeypatch, job_type, _library_data().iloc[:0])
+    assert n_predicted == 0
@@ -0,0 +1,66 @@
+"""Test cases for the worker context."""
+import json
+import os
+
+import pytest
+
+from oktoberfest.utils import worker_context
+from oktoberfest.utils.worker_context import get_worker_context, init_worker_context
+
+
+def _write_config(path, **config) -> str:
+    """Write a config file and return its path."""
+    path.write_text(json.dumps({"jobType": "Rescoring", "predictionBackend": "synthetic", **config}))
+    return str(path)
+
+
+@pytest.fixture(autouse=True)
+def _no_context(monkeypatch):
+    """Start every test without a context of this process."""
+    monkeypatch.setattr(worker_context, "_context", None)
+
+
+def test_context_is_reused(tmp_path):
+    """The context is set up once and its state is kept for the later tasks of the process."""
+    config_path = _write_config(tmp_path / "config.json", batchSize=100)
+    context = get_worker_context(config_path)
+    context.batch_sizer.size = 50
+    assert get_worker_context(config_path) is context
+    assert get_worker_context(config_path).batch_sizer.size == 50
+
+
+def test_context_is_set_up_again_for_a_changed_config(tmp_path):
+    """A changed config file or another config path give a new context with the new config."""
+    config_path = _write_config(tmp_path / "config.json", batchSize=100)
+    context = get_worker_context(config_path)
+
+    _write_config(tmp_path / "config.json", batchSize=2000)
+    modified = os.stat(config_path).st_mtime_ns + 10**9
+    os.utime(config_path, ns=(modified, modified))
+    changed = get_worker_context(config_path)
+    assert changed is not context
+    assert changed.config.batch_size == 2000
+
+    other_path = _write_config(tmp_path / "other.json", batchSize=2000)
+    other = get_worker_context(other_path)
+    assert other is not changed
+    assert other.config_path == other_path
+
+
+def test_default_config(tmp_path, monkeypatch):
+    """Without a config path, the context is set up from the default config."""
+    config_path = _write_config(tmp_path / "config.json")
+    monkeypatch.setattr(worker_context, "CONFIG_PATH", config_path)
+    init_worker_context(None)
+    context = get_worker_context(None)
+    assert context.config_path == config_path
+    assert get_worker_context(config_path) is context
+
+
+def test_prediction_cache_is_opened_once(tmp_path):
+    """The prediction cache of the config is opened with the context and shared by its tasks."""
+    config_path = _write_config(tmp_path / "config.json", predictionCache=str(tmp_path / "cache.sqlite"))
+    context = get_worker_context(config_path)
+    assert context.prediction_cache is not None
+    assert get_worker_context(config_path).prediction_cache is context.prediction_cache
+    assert get_worker_context(_write_config(tmp_path / "other.json")).prediction_cache is None